@@ -2,93 +2,212 @@
 #   XMPP/AP Bridge - XMPP Bot   #
 #################################
 
-from time import sleep
 import os
+import time
+import signal
 from argparse import ArgumentParser
 import asyncio
+from functools import partial
+import logging
 import slixmpp
-from lib_bridge import UserRegistrar, UserManager, LanguageManager, ParseSend, InitBridge, ConfigLoader, LogError
+from lib_bridge import UserRegistrar, UserManager, LanguageManager, ParseSend, InitBridge, ConfigLoader, LogManager, LogEvent, Backoff, RosterStore, Admission, inbound_lane, discover_multicast, chat_messages
 
 CONFIG_FILE = os.getenv("XMPP_BRIDGE_CONFIG_FILE", "/usr/local/etc/xmpp-bridge-config.yml")
 
 
-class BridgeBot(slixmpp.ClientXMPP):
+# Handlers of the bridge bot, whether it connects as a client of its XMPP account or as a component of the server
 
-    def __init__(self, jid, password, config):
-        slixmpp.ClientXMPP.__init__(self, jid, password)
-        self.add_event_handler("session_start", self.start)
-        self.add_event_handler("message", self.message)
-        self.add_event_handler("presence_subscribe", self.subscribe_request)
-        self.add_event_handler("presence_unsubscribe", self.unsubscribe_request)
-        self._config = config
+class BridgeHandlers:
 
-
-    async def start(self, event): # Initialize connection
-        try:
-            self.send_presence()
-            await self.get_roster()
-        except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
-            LogError(self._config.log_file, ">> Error when registering XMPP Bridge", e).log()
+    async def run_forever(self): # Connect, then reconnect with jittered backoff, resuming the stream if the server allows
+        backoff = Backoff(1, self._config.reconnect_max)
+        while True: # This will loop forever until killed or crashes
+            started = time.monotonic()
+            self.connect(*self._config.xmpp_server)
+            await self.disconnected
+            if time.monotonic() - started > backoff.cap: backoff.reset() # Was stable, retry promptly
+            delay = backoff.next()
+            LogEvent(f">> Disconnected from XMPP Bridge on main event loop, will try to reconnect in {delay:.1f} seconds...", "disconnected from server", level=logging.WARNING).log()
+            await asyncio.sleep(delay)
 
 
-    async def subscribe_request(self, presence): # Event subscribe: try and register user
+    async def subscribe_request(self, presence): # Event subscribe: try and register user, unless the registration lane is full
         jid_from = presence["from"].bare.lower()
+        lane = inbound_lane(self._config, 1, jid_from)
+        if self._capture: self._capture.record(1, "subscribe", jid_from, lane)
+        if self._admission.submit(lane, partial(self._register, jid_from, lane)): return
+        self.send_presence_subscription(pto=jid_from, ptype="unsubscribed") # So that the user can request it again
+        self._admission.busy(jid_from, partial(self._busy, jid_from))
+
+
+    async def _register(self, jid_from, lane):
         language = LanguageManager(1, jid_from, self._config)
-        language.get_language()
+        await language.get_language_async()
 
         register = UserRegistrar(self, 1, jid_from, True, language.lang, self._config)
-        register.register_user()
+        await self._admission.blocking(lane, register.register_user) # Blocking lookups and database, off the event loop
 
         try:
             self.send_presence_subscription(pto=jid_from, ptype=("unsubscribed", "subscribed")[register.success])
-            mess = self.Message()
-            mess["to"] = jid_from
-            mess["type"] = "chat"
-            mess["body"] = register.reply_text
-            mess["lang"] = register.lang
-            mess.send()
+            chat_messages(self, [jid_from], register.reply_text, register.lang)[0][0].send()
 
         except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
-            LogError(self._config.log_file, f">> Error when processing XMPP Bridge subscribe request to {jid_from}", e).log()
+            LogEvent(">> Error when processing XMPP Bridge subscribe request", e, jid_from, 1).log()
 
 
-    async def unsubscribe_request(self, presence): # Event unsubscribe: unregister user
+    async def unsubscribe_request(self, presence): # Event unsubscribe: unregister user, never shed as the user is gone anyway
         jid_from = presence["from"].bare.lower()
+        if self._capture: self._capture.record(1, "unsubscribe", jid_from, None)
         language = LanguageManager(1, jid_from, self._config)
-        language.get_language()
+        await language.get_language_async()
 
         unregister = UserManager(self, 1, jid_from, True, language.lang, self._config)
-        unregister.unregister_user() # Unsubscribed is sent from unregister_user so no need to send it again
+        await self.loop.run_in_executor(None, unregister.unregister_user) # Unsubscribed is sent from unregister_user so no need to send it again
 
         try:
-            mess = self.Message()
-            mess["to"] = jid_from
-            mess["type"] = "chat"
-            mess["body"] = unregister.reply_text
-            mess["lang"] = language.lang
-            mess.send()
+            chat_messages(self, [jid_from], unregister.reply_text, language.lang)[0][0].send()
 
         except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
-            LogError(self._config.log_file, f">> Error when processing XMPP Bridge unsubscribe request from {jid_from}", e).log()
+            LogEvent(">> Error when processing XMPP Bridge unsubscribe request", e, jid_from, 1).log()
 
 
-    def message(self, msg): # Event receiving a message
+    async def message(self, msg): # Event receiving a message, queued in its lane
         if msg["type"] in ("chat", "normal"): # We ignore types: error, headline, groupchat
             jid_from = msg["from"].bare.lower()
-            message_content = msg["body"]
-            from_id = msg["id"]
+            lane = inbound_lane(self._config, 1, jid_from, msg["body"])
+            if self._capture: self._capture.record(1, "message", jid_from, lane, msg["body"])
+            if not self._admission.submit(lane, partial(self._parse, msg, jid_from, lane, time.time())): # Received now, for delivery latency
+                self._admission.busy(jid_from, partial(self._busy, jid_from))
+
+
+    async def _parse(self, msg, jid_from, lane, received):
+        message_content = msg["body"]
+        from_id = msg["id"]
+
+        language = LanguageManager(1, jid_from, self._config)
+        await language.get_language_async()
+
+        parser = ParseSend(self, 1, jid_from, message_content, from_id, None, language.lang, self._config, received)
+        await self._admission.blocking(lane, parser.parse_send) # Parse message and execute command or send message, Mastodon calls may wait for rate limit budget
+
+        if parser.response: # Reply to XMPP sender only if error or command returns a message
+            try:
+                msg.reply(parser.response).send()
+            except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
+                LogEvent(">> Error when responding to XMPP user from XMPP Bridge", e, jid_from, 1).log()
+
+
+    async def _busy(self, jid_from): # Event shed: ask the sender to try again later, from the busy worker
+        language = LanguageManager(1, jid_from, self._config)
+        await language.get_language_async()
+        try:
+            chat_messages(self, [jid_from], self._config.messages["busy"][language.lang], language.lang)[0][0].send()
+        except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
+            LogEvent(">> Error when replying busy to XMPP user from XMPP Bridge", e, jid_from, 1).log()
+
+
+class BridgeBot(BridgeHandlers, slixmpp.ClientXMPP):
+
+    def __init__(self, jid, password, config):
+        slixmpp.ClientXMPP.__init__(self, jid, password)
+        self.add_event_handler("session_start", self.start)
+        self.add_event_handler("message", self.message)
+        self.add_event_handler("presence_subscribe", self.subscribe_request)
+        self.add_event_handler("presence_unsubscribe", self.unsubscribe_request)
+        self.add_event_handler("disconnected", self.keep_unacked)
+        self.add_event_handler("session_resumed", self.resumed)
+        self._config = config
+        self._admission = Admission(config, 1, self.loop)
+        self._capture = config.traffic_capture()
+        RosterStore(config.storage_backend()).attach(self) # Roster kept locally, only changes fetched on connection
+        self._unacked = [] # Messages not acknowledged by the server when the connection was lost
 
-            language = LanguageManager(1, jid_from, self._config)
-            language.get_language()
 
-            parser = ParseSend(self, 1, jid_from, message_content, from_id, None, language.lang, self._config)
-            parser.parse_send() # Parse message and execute command or send message
+    def keep_unacked(self, event): # Cleared by the plugin if the stream cannot be resumed, so keep them to send again
+        self._unacked = [s for _, s in self.plugin['xep_0198'].unacked_queue if isinstance(s, slixmpp.Message)]
 
-            if parser.response: # Reply to XMPP sender only if error or command returns a message
-                try:
-                    msg.reply(parser.response).send()
-                except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
-                    LogError(self._config.log_file, f">> Error when responding to XMPP user {jid_from} from XMPP Bridge", e).log()
+
+    def resumed(self, event): # Unacked stanzas already sent again by the plugin
+        self._unacked = []
+        LogEvent(">> XMPP Bridge stream resumed", level=logging.INFO).log()
+
+
+    async def start(self, event): # Initialize connection
+        try:
+            self.send_presence()
+            await self.get_roster()
+            await discover_multicast(self) # Known before messages to several recipients are sent through this session
+        except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
+            LogEvent(">> Error when registering XMPP Bridge", e).log()
+        for mess in self._unacked: # New session after a failed resumption: messages possibly lost are sent again
+            self.send(mess)
+        if self._unacked: LogEvent(f">> XMPP Bridge sent again {len(self._unacked)} messages unacknowledged before disconnection", level=logging.INFO).log()
+        self._unacked = []
+
+
+# Bridge bot as an external component (XEP-0114) of a local server: the bot JID is an address of the component domain
+# and the component secret is the bot password. No roster is kept, neither by the server nor in memory: registered users
+# are those subscribed, and presence is sent to them on connection and in answer to their probes
+
+class BridgeComponent(BridgeHandlers, slixmpp.ComponentXMPP):
+
+    PAGE = 500 # Users sent presence between two yields to the event loop
+
+    def __init__(self, jid, secret, config):
+        slixmpp.ComponentXMPP.__init__(self, slixmpp.JID(jid).domain, secret)
+        self.boundjid = slixmpp.JID(jid) # Presences and messages are sent from the bot address, not the bare domain
+        self.server_domain = config.xmpp_instance
+        for event, handler in (("presence_subscribe", self._handle_subscribe), ("presence_unsubscribe", self._handle_unsubscribe),
+                               ("presence_probe", self._handle_probe)): # Roster state of every contact, replaced by the users table
+            self.del_event_handler(event, handler)
+        self.add_filter("in", self.addressed)
+        self.add_event_handler("session_start", self.start)
+        self.add_event_handler("message", self.message)
+        self.add_event_handler("presence_subscribe", self.subscribe_request)
+        self.add_event_handler("presence_unsubscribe", self.unsubscribe_request)
+        self.add_event_handler("presence_probe", self.probe)
+        self._config = config
+        self._admission = Admission(config, 1, self.loop)
+        self._capture = config.traffic_capture()
+
+
+    def _handle_presence(self, presence): # Replaces the roster update of every presence received
+        if presence["type"] in ("subscribe", "unsubscribe", "probe"): self.event("presence_" + presence["type"], presence)
+
+
+    def addressed(self, stanza): # Messages and presences to other addresses of the component domain are dropped
+        if isinstance(stanza, (slixmpp.Message, slixmpp.Presence)) and stanza["to"].bare != self.boundjid.bare: return None
+        return stanza
+
+
+    async def start(self, event): # Initialize connection
+        try:
+            await discover_multicast(self)
+        except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
+            LogEvent(">> Error when registering XMPP Bridge", e).log()
+        users, after = self._config.storage_backend().users, ""
+        while page := users.page(1, after, self.PAGE): # Online users see the bot available, without waiting for their next probe
+            for user in page: self.send_presence(pto=user.req_user)
+            after = page[-1].req_user
+            await asyncio.sleep(0)
+
+
+    async def probe(self, presence): # Available to registered users, unsubscribed for the others
+        entry = self._config.storage_backend().users.get(1, presence["from"].bare.lower())
+        self.send_presence(pto=presence["from"].bare, ptype=None if entry and entry.revoke_date is None else "unsubscribed")
+
+
+def bridge_session(config): # Bot session of the configured XMPP mode, shared through the configuration
+    if config.xmpp_mode == "component":
+        xmpp = BridgeComponent(config.ap_bridge_jid, config.ap_bridge_pass, config)
+    else:
+        xmpp = BridgeBot(config.ap_bridge_jid, config.ap_bridge_pass, config)
+        xmpp.register_plugin('xep_0198') # Stream Management: acks and resumption, unacked stanzas sent again on resume
+    xmpp.register_plugin('xep_0030') # Service Discovery
+    xmpp.register_plugin('xep_0199') # XMPP Ping
+    xmpp.register_plugin('xep_0033') # Extended Stanza Addressing: one stanza for several recipients
+    config.xmpp_session = xmpp # Maintenance jobs unsubscribe users through the running session
+    return xmpp
 
 
 if __name__ == '__main__':
@@ -98,15 +217,13 @@ if __name__ == '__main__':
     args = parser.parse_args()
     config = ConfigLoader(args.config if args.config else CONFIG_FILE)
     config.load()
+    if config.xmpp_mode == "component": parser.error("xmpp-mode component runs only with both bots in one process, start unified-bridge.py")
+    LogManager(config).start()
 
     InitBridge(None, 1, config).initialize()
 
-    xmpp = BridgeBot(config.ap_bridge_jid, config.ap_bridge_pass, config)
-    xmpp.register_plugin('xep_0030') # Service Discovery
-    xmpp.register_plugin('xep_0199') # XMPP Ping
+    xmpp = bridge_session(config)
 
-    while True: # This will loop forever until killed or crashes, manage restart or error from OS systemd
-        xmpp.connect()
-        asyncio.get_event_loop().run_until_complete(xmpp.disconnected)
-        LogError(config.log_file, ">> Disconnected from XMPP Bridge on main event loop, will try to reconnect in 10 seconds...", "disconnected from server").log()
-        sleep(10) # Try and reconnected after 10 seconds, loops forever (until error or killed)
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGHUP, config.reload) # systemctl reload: new configuration, same XMPP session
+    loop.run_until_complete(xmpp.run_forever())
@@ -0,0 +1,196 @@
+#######################################
+# XMPP/AP Bridge - Database benchmark #
+#######################################
+
+# Builds a SQLite database of configurable size with the bridge schema (as created by InitBridge.initialize()), times
+# every storage call made by LanguageManager, UserRegistrar, InstructionProcessor, MessageSender and the retention code,
+# and checks with EXPLAIN QUERY PLAN that the statements run on the message hot path search an index instead of
+# scanning a table. SQL is captured from the calls themselves, so new or changed queries are covered without listing them
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import tempfile
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from lib_bridge import SqliteStorage, UserRow, BlockRow, InstbRow, CommRow, epoch
+
+LANGS = ("en", "fr", "de", "es", "it", "nl", "pt")
+STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class DatabaseBench:
+
+    def __init__(self, args):
+        self.args = args
+        self.dir = tempfile.mkdtemp(prefix="bridge-dbbench-")
+        self.database_file = args.database or os.path.join(self.dir, "bridge.db")
+        self.rng = random.Random(args.seed)
+        self.now = epoch()
+        self.users = [] # (type, req_user) of active users
+        self.comm = [] # Sample of comm rows, for id lookups
+        self.failures = []
+        self.results = []
+
+    def _user(self, i):
+        return (i % 2, f"user{i}@domain{i % self.args.domains}.test")
+
+    def build(self): # Bulk load in one transaction, then backfill counters as an upgraded database would
+        storage = SqliteStorage(self.database_file, cache_size=0)
+        storage.create_schema()
+        conn = storage.conn()
+        if conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]:
+            print(f"Using existing database {self.database_file}")
+            self.users = conn.execute("SELECT type, req_user FROM users WHERE revoke_date IS NULL").fetchall()
+            self.comm = [CommRow._make(r) for r in conn.execute("SELECT *, rowid FROM comm ORDER BY RANDOM() LIMIT 1000")]
+            return storage
+        rng, now, a = self.rng, self.now, self.args
+        t = time.perf_counter()
+        rows = []
+        for i in range(a.users):
+            user_type, user = self._user(i)
+            revoked = rng.random() < a.revoked
+            rows.append(UserRow(user_type, user, now - int(rng.uniform(0, 730) * 86400), rng.randint(1, 3), rng.choice(LANGS),
+                                now - int(rng.uniform(0, 365) * 86400) if revoked else None, ("Mastodon", "XMPP")[user_type], str(i)))
+            if not revoked: self.users.append((user_type, user))
+        conn.executemany("INSERT INTO users(type, req_user, req_date, nb_reg, lang, revoke_date, app, acc_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.executemany("INSERT INTO blocks(type, blocking, blocked, block_date) VALUES (?, ?, ?, ?)",
+                         (BlockRow(*rng.choice(self.users), self._user(rng.randrange(a.users))[1], now - int(rng.uniform(0, 365) * 86400))
+                          for _ in range(a.blocks)))
+        conn.executemany("INSERT INTO instb(type, blocked, block_date) VALUES (?, ?, ?)",
+                         (InstbRow(rng.randrange(2), f"spam{i}@domain{i % a.domains}.test", now - int(rng.uniform(0, 365) * 86400))
+                          for i in range(a.instb)))
+        comm = []
+        for i in range(a.comm):
+            user_type, user = rng.choice(self.users)
+            from_date = now - int(rng.uniform(0, a.comm_days * 86400))
+            row = CommRow(user_type, user, rng.choice(self.users)[1], from_date, f"from{i}", f"to{i}", from_date * 1000, from_date * 1000 + int(rng.expovariate(1 / 500)))
+            comm.append(row)
+            if len(comm) == 100000:
+                conn.executemany("INSERT INTO comm(type, user, from_u, from_date, id_from, id_to, recv_ms, sent_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [r[:8] for r in comm])
+                self.comm += rng.sample(comm, 100)
+                comm = []
+        conn.executemany("INSERT INTO comm(type, user, from_u, from_date, id_from, id_to, recv_ms, sent_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [r[:8] for r in comm])
+        self.comm += comm[:100]
+        conn.executemany("INSERT INTO ledger(type, msg_key, seen_date) VALUES (?, ?, ?)",
+                         ((rng.randrange(2), f"user{i}@domain.test/{i}", now - int(rng.uniform(0, 48) * 3600)) for i in range(a.ledger)))
+        conn.commit()
+        storage.counters.backfill()
+        print(f"Built {self.database_file} in {time.perf_counter() - t:.1f} s: {a.users} users ({len(self.users)} active), {a.blocks} blocks, "
+              f"{a.instb} instance blocks, {a.comm} comm rows, {a.ledger} ledger rows, {os.path.getsize(self.database_file) / 2**20:.0f} MiB")
+        return storage
+
+    def operations(self): # (caller, name, on the hot path, call(storage, sample user, sample comm row))
+        new = lambda: f"new{self.rng.randrange(10**9)}@domain{self.rng.randrange(self.args.domains)}.test"
+        return (
+            ("LanguageManager", "users.get", True, lambda s, u, c: s.users.get(*u)),
+            ("LanguageManager", "users.set_lang", True, lambda s, u, c: s.users.set_lang(*u, self.rng.choice(LANGS))),
+            ("UserRegistrar", "instb.get", True, lambda s, u, c: s.instb.get(*u)),
+            ("UserRegistrar", "counters.get active", True, lambda s, u, c: s.counters.get("active", u[0])),
+            ("UserRegistrar", "users.save new", True, lambda s, u, c: s.users.save(UserRow(u[0], new(), self.now, 1, "en", None, "Mastodon", "0"))),
+            ("InstructionProcessor", "blocks.get", True, lambda s, u, c: s.blocks.get(*u, c.from_u)),
+            ("InstructionProcessor", "blocks.of_user", True, lambda s, u, c: s.blocks.of_user(*u)),
+            ("InstructionProcessor", "blocks.add", True, lambda s, u, c: s.blocks.add(BlockRow(*u, c.from_u, self.now))),
+            ("InstructionProcessor", "blocks.delete", True, lambda s, u, c: s.blocks.delete(*u, c.from_u)),
+            ("InstructionProcessor", "instb.add", True, lambda s, u, c: s.instb.add(InstbRow(u[0], new(), self.now))),
+            ("InstructionProcessor", "instb.delete", True, lambda s, u, c: s.instb.delete(u[0], new())),
+            ("InstructionProcessor", "revoke_user", True, lambda s, u, c: s.revoke_user(*u, self.now)),
+            ("InstructionProcessor", "counters.total", True, lambda s, u, c: s.counters.total("bridged", u[0], "2000-01-01")),
+            ("InstructionProcessor", "counters.top", False, lambda s, u, c: s.counters.top("domain", 5)),
+            ("InstructionProcessor", "users.active", False, lambda s, u, c: s.users.active()), # Admin listing of all users
+            ("InstructionProcessor", "instb.all", False, lambda s, u, c: s.instb.all()),
+            ("InstructionProcessor", "comm.latencies", False, lambda s, u, c: s.comm.latencies(u[0], self.now - 3600)), # Status command
+            ("MessageSender", "comm.recent_from", True, lambda s, u, c: s.comm.recent_from(1 - c.type, c.from_u, 10, self.now - 3600)),
+            ("MessageSender", "comm.by_id_to", True, lambda s, u, c: s.comm.by_id_to(c.type, c.id_to)),
+            ("MessageSender", "comm.by_id_from", True, lambda s, u, c: s.comm.by_id_from(c.type, c.id_from)),
+            ("MessageSender", "comm.last_to", True, lambda s, u, c: s.comm.last_to(c.type, c.user, self.now - 3600)),
+            ("MessageSender", "comm.add", True, lambda s, u, c: s.comm.add(c._replace(from_date=self.now, id_from="new", id_to="new"))),
+            ("ProcessedLedger", "ledger.seen", True, lambda s, u, c: s.ledger.seen(u[0], f"{u[1]}/{self.rng.randrange(10**6)}")),
+            ("ProcessedLedger", "ledger.add", True, lambda s, u, c: s.ledger.add(u[0], f"{u[1]}/{self.rng.randrange(10**9)}", self.now)),
+            ("ProcessedLedger", "ledger.expire", False, lambda s, u, c: s.ledger.expire(self.now - 48 * 3600)),
+            ("InitBridge", "users.revoked", False, lambda s, u, c: s.users.revoked(u[0], self.now - 30 * 86400)),
+            ("InitBridge", "users.page", False, lambda s, u, c: s.users.page(*u, 100)),
+            ("InitBridge", "purge_user", False, lambda s, u, c: s.purge_user(*u)),
+            ("InitBridge", "comm.oldest_date", False, lambda s, u, c: s.comm.oldest_date(u[0])),
+            ("InitBridge", "comm.expire", False, lambda s, u, c: s.comm.expire(u[0], self.now - self.args.comm_days * 86400)),
+            ("InitBridge", "instb.of_type", False, lambda s, u, c: s.instb.of_type(u[0])))
+
+    def plan(self, conn, sql): # Details of EXPLAIN QUERY PLAN, e.g. "SEARCH users USING INDEX users_key (type=? AND req_user=?)"
+        try: return [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+        except sqlite3.Error as e: return [f"ERROR {e}"]
+
+    def run(self, storage):
+        conn = storage.conn()
+        print(f"\n{'caller':<21}{'operation':<22}{'hot':>4}{'mean us':>10}{'p95 us':>10}  plan")
+        for caller, name, hot, call in self.operations():
+            if self.args.filter and self.args.filter not in name: continue
+            statements = []
+            conn.set_trace_callback(statements.append)
+            call(storage, self.rng.choice(self.users), self.rng.choice(self.comm))
+            conn.set_trace_callback(None)
+            plans = {}
+            for sql in statements:
+                if sql.lstrip().upper().startswith(STATEMENTS): plans[sql] = self.plan(conn, sql)
+            details = sorted(set(d for p in plans.values() for d in p))
+            scans = [d for d in details if d.startswith("SCAN") and not d.startswith("SCAN CONSTANT ROW")]
+            if hot and scans: self.failures.append(f"{caller} {name}: " + "; ".join(scans))
+            times = []
+            for _ in range(self.args.iterations if hot else max(self.args.iterations // 20, 1)):
+                u, c = self.rng.choice(self.users), self.rng.choice(self.comm)
+                t = time.perf_counter()
+                call(storage, u, c)
+                times.append(time.perf_counter() - t)
+            mean, p95 = sum(times) / len(times), percentile(times, 95)
+            print(f"{caller[:20]:<21}{name[:21]:<22}{'yes' if hot else '':>4}{mean * 1e6:>10.0f}{p95 * 1e6:>10.0f}  {' | '.join(details) or '-'}")
+            self.results.append({"caller": caller, "operation": name, "hot": hot, "mean_us": round(mean * 1e6, 1),
+                                 "p95_us": round(p95 * 1e6, 1), "plan": details})
+        if self.failures:
+            print("\nHot path statements scanning a table:")
+            for f in self.failures: print("  " + f)
+        else: print("\nAll hot path statements use an index")
+        if self.args.json:
+            with open(self.args.json, "w") as f:
+                json.dump({"sizes": {k: getattr(self.args, k) for k in ("users", "comm", "blocks", "instb", "ledger")},
+                           "operations": self.results, "scans": self.failures}, f, indent=2)
+        return not self.failures
+
+    def cleanup(self):
+        if self.args.keep or self.args.database: print(f"Database kept in {self.database_file}")
+        else: shutil.rmtree(self.dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = "XMPP/AP Bridge - database scale benchmark and query plan checks")
+    parser.add_argument("--users", type=int, default=100000, help="rows in users (default 100000)")
+    parser.add_argument("--revoked", type=float, default=0.1, help="share of revoked users (default 0.1)")
+    parser.add_argument("--domains", type=int, default=1000, help="distinct user domains (default 1000)")
+    parser.add_argument("--comm", type=int, default=1000000, help="rows in comm (default 1000000)")
+    parser.add_argument("--comm-days", type=float, default=30, help="days covered by comm rows (default 30)")
+    parser.add_argument("--blocks", type=int, default=20000, help="rows in blocks (default 20000)")
+    parser.add_argument("--instb", type=int, default=1000, help="rows in instb (default 1000)")
+    parser.add_argument("--ledger", type=int, default=100000, help="rows in ledger (default 100000)")
+    parser.add_argument("--iterations", type=int, default=200, help="timed calls per hot path operation, 1/20 of it for others (default 200)")
+    parser.add_argument("--filter", help="only run operations whose name contains this text")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default 1)")
+    parser.add_argument("--database", help="build (or reuse if it has users) this database file instead of a temporary one")
+    parser.add_argument("--check", action="store_true", help="exit with error if a hot path statement scans a table")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary database")
+    args = parser.parse_args()
+
+    bench = DatabaseBench(args)
+    ok = bench.run(bench.build())
+    bench.cleanup()
+    if args.check and not ok: sys.exit(1)
@@ -0,0 +1,151 @@
+#######################################
+# XMPP/AP Bridge - Parser benchmark   #
+#######################################
+
+# Checks ContentParser against the golden outputs of a versioned corpus (parser_corpus.json), then measures
+# per-message parse time and memory allocations, so that parser optimisations can be proven not to change extraction.
+# With --fuzz, compares the linear time matchers with the plain regular expressions they replace on random inputs, and
+# checks that parse time of adversarial messages grows linearly with their size, up to the inbound size limits
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import tracemalloc
+from types import SimpleNamespace
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from lib_bridge import ContentParser, EMAIL_PATTERN, DOMAIN_PATTERN
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser_corpus.json")
+SET_FIELDS = ("command_list", "lang_list", "xmpp_jid_list", "ap_addr_list") # Built from sets, compared sorted
+LIST_FIELDS = ("dom_list", "flag_aps", "parsed")
+REFERENCE = {"email": (EMAIL_PATTERN, re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b', re.MULTILINE)),
+             "domain": (DOMAIN_PATTERN, re.compile(r'[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b', re.MULTILINE))}
+FUZZ_ALPHABET = "aaZb9.-.@_%+ \néx:!=/"
+ADVERSARIAL = { # Inputs which made the unanchored scans quadratic, by size in characters
+    "dots": lambda n: "a." * (n // 2),
+    "letters": lambda n: "a" * n,
+    "at-dots": lambda n: "a@" + "a." * (n // 2 - 1),
+    "digit-tld": lambda n: "a.aa1" * (n // 5),
+    "prefixes": lambda n: "@xmpp:!" * (n // 7),
+    "mentions": lambda n: "@a@b.cc " * (n // 8),
+    "nested-tags": lambda n: "<b>" * (n // 3),
+    "links": lambda n: '<a href="https://b.cc/@a" class="mention">@a</a>' * (n // 48)}
+
+
+def extract(case, config):
+    content = ContentParser(case["user_type"], case["input"], config)
+    content.parse_content()
+    result = {k: sorted(getattr(content, k)) for k in SET_FIELDS}
+    result.update({k: getattr(content, k) for k in LIST_FIELDS})
+    return result
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class ParserBench:
+
+    def __init__(self, args):
+        self.args = args
+        with open(args.corpus) as f:
+            self.corpus = json.load(f)
+        self.config = SimpleNamespace(**self.corpus["config"])
+        self.cases = [c for c in self.corpus["cases"] if not args.filter or args.filter in c["name"]]
+
+    def update(self): # Regenerate golden outputs from the current implementation, review the diff before committing
+        for case in self.corpus["cases"]: case["expected"] = extract(case, self.config)
+        with open(self.args.corpus, "w") as f:
+            json.dump(self.corpus, f, indent=1, ensure_ascii=False)
+            f.write("\n")
+        print(f"Golden outputs updated for {len(self.corpus['cases'])} cases (corpus version {self.corpus['version']})")
+
+    def check(self):
+        failures = 0
+        for case in self.cases:
+            got = extract(case, self.config)
+            for field, expected in case.get("expected", {}).items():
+                if got[field] != expected:
+                    failures += 1
+                    print(f"MISMATCH {case['name']} {field}:\n  expected {expected!r}\n  got      {got[field]!r}")
+        print(f"Corpus version {self.corpus['version']}: {len(self.cases) - failures}/{len(self.cases)} cases match golden outputs")
+        return not failures
+
+    def fuzz(self):
+        rng = random.Random(self.args.seed)
+        failures = 0
+        for _ in range(self.args.fuzz):
+            text = "".join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randrange(40)))
+            for name, (linear, plain) in REFERENCE.items():
+                if linear.findall(text) != plain.findall(text) or linear.sub("", text) != plain.sub("", text):
+                    failures += 1
+                    print(f"MISMATCH {name} matcher on {text!r}")
+        print(f"Matchers: {self.args.fuzz} random inputs, {failures} differences with the plain regular expressions")
+
+        print(f"\n{'adversarial input':<22}{'type':>5}{'chars':>8}{'ms':>9}{'us/char':>9}")
+        for name, make in ADVERSARIAL.items():
+            for user_type, limit in enumerate((self.args.max_html, self.args.max_text)):
+                sizes = [limit // 16, limit]
+                times = []
+                for n in sizes:
+                    text = make(n)
+                    if not user_type: text = "<p>" + text + "</p>"
+                    t = time.perf_counter()
+                    ContentParser(user_type, text, self.config).parse_content()
+                    times.append(time.perf_counter() - t)
+                    print(f"{name:<22}{user_type:>5}{len(text):>8}{times[-1] * 1e3:>9.1f}{times[-1] / len(text) * 1e6:>9.2f}")
+                if times[1] > self.args.max_ms / 1e3 or times[1] / sizes[1] > 4 * max(times[0] / sizes[0], 1e-7): # Super-linear or too slow
+                    failures += 1
+                    print(f"SLOW {name} for type {user_type}: {times[1] * 1e3:.1f} ms at the inbound limit of {limit} characters")
+        return not failures
+
+    def bench(self):
+        print(f"\n{'case':<30}{'bytes':>7}{'mean us':>10}{'p95 us':>10}{'peak KiB':>10}")
+        total = []
+        for case in self.cases:
+            for _ in range(self.args.warmup): extract(case, self.config)
+            times = []
+            for _ in range(self.args.iterations):
+                t = time.perf_counter()
+                ContentParser(case["user_type"], case["input"], self.config).parse_content()
+                times.append(time.perf_counter() - t)
+            tracemalloc.start() # Separate pass so that tracing overhead does not distort timings
+            base = tracemalloc.get_traced_memory()[0]
+            ContentParser(case["user_type"], case["input"], self.config).parse_content()
+            peak = tracemalloc.get_traced_memory()[1] - base
+            tracemalloc.stop()
+            total += times
+            mean = sum(times) / len(times)
+            print(f"{case['name'][:29]:<30}{len(case['input'].encode()):>7}{mean * 1e6:>10.1f}{percentile(times, 95) * 1e6:>10.1f}{peak / 1024:>10.1f}")
+        print(f"\nAll cases: {len(total)} parses, mean {sum(total) / len(total) * 1e6:.1f} us, p95 {percentile(total, 95) * 1e6:.1f} us, "
+              f"p99 {percentile(total, 99) * 1e6:.1f} us per message")
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = "XMPP/AP Bridge - ContentParser golden corpus check and micro-benchmark")
+    parser.add_argument("--corpus", default=CORPUS_FILE, help="corpus file (default benchmarks/parser_corpus.json)")
+    parser.add_argument("--check", action="store_true", help="only check golden outputs, exit with error on mismatch")
+    parser.add_argument("--update", action="store_true", help="regenerate golden outputs from the current implementation")
+    parser.add_argument("--filter", help="only run cases whose name contains this text")
+    parser.add_argument("--iterations", type=int, default=200, help="timed parses per case (default 200)")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed parses per case before timing (default 20)")
+    parser.add_argument("--fuzz", type=int, default=0, help="only compare matchers on this number of random inputs and time adversarial inputs")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of --fuzz (default 1)")
+    parser.add_argument("--max-html", type=int, default=65536, help="max-inbound-html of the bridge configuration (default 65536)")
+    parser.add_argument("--max-text", type=int, default=16384, help="max-inbound-text of the bridge configuration (default 16384)")
+    parser.add_argument("--max-ms", type=float, default=1000, help="worst parse time allowed at the inbound limits with --fuzz (default 1000 ms)")
+    args = parser.parse_args()
+
+    bench = ParserBench(args)
+    if args.update: bench.update()
+    elif args.fuzz: sys.exit(0 if bench.fuzz() else 1)
+    elif not bench.check(): sys.exit(1)
+    elif not args.check: bench.bench()
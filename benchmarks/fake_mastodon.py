@@ -0,0 +1,223 @@
+#######################################
+# XMPP/AP Bridge - Fake Mastodon API  #
+#######################################
+
+# Local stand-in for the Mastodon API endpoints used by the bridge, for benchmarks only
+# Serves accounts, relationships, statuses, notifications, nodeinfo and the user streaming endpoint (server-sent events)
+# Optionally enforces a rate limit per window like Mastodon, with X-RateLimit-* headers and 429 errors
+
+import json
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+def iso_now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class FakeMastodon:
+
+    def __init__(self, domain, bot_name, host="127.0.0.1", port=0, on_status=None, rate_limit=0, rate_window=300):
+        self.domain = domain
+        self.bot_name = bot_name # Local username of the bridge bot account
+        self.on_status = on_status # Callback(status, timestamp) for every status posted by the bridge
+        self.statuses = []
+        self.notifications = []
+        self.follows = set()
+        self.request_count = 0
+        self.rate_limit = rate_limit # API calls allowed per window, 0 for no limit
+        self.rate_window = rate_window
+        self.rate_limited = 0 # Calls rejected with 429
+        self._window = (0, 0) # (window start, calls in window)
+        self._accounts = {}
+        self._by_id = {}
+        self._next_id = 1000
+        self._streams = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self.base_url = f"http://{host}:{self._server.server_address[1]}"
+        self.account(bot_name + "@" + domain, bot=True)
+
+    def _new_id(self):
+        with self._lock:
+            self._next_id += 1
+            return str(self._next_id)
+
+    def account(self, acct, bot=False, note=""): # Get or create an account, acct is always user@domain
+        if acct in self._accounts: return self._accounts[acct]
+        username, domain = acct.split("@", 1)
+        a = {"id": self._new_id(), "username": username, "acct": username if domain == self.domain else acct,
+             "display_name": username, "locked": False, "bot": bot, "group": False, "note": note,
+             "url": f"https://{domain}/@{username}", "created_at": iso_now(), "followers_count": 0,
+             "following_count": 0, "statuses_count": 10, "avatar": "", "header": "", "fields": [], "emojis": []}
+        self._accounts[acct] = a
+        self._by_id[a["id"]] = a
+        return a
+
+    def status(self, acct, content, in_reply_to_id=None, visibility="direct"):
+        return {"id": self._new_id(), "created_at": iso_now(), "content": content, "in_reply_to_id": in_reply_to_id,
+                "sensitive": False, "spoiler_text": "", "media_attachments": [], "poll": None, "mentions": [],
+                "url": f"https://{self.domain}/statuses/{self._next_id}", "language": "en", "visibility": visibility,
+                "account": self.account(acct), "tags": [], "emojis": [], "reblog": None}
+
+    def notify(self, ntype, acct, content=None, in_reply_to_id=None): # Push a notification to all connected streams
+        n = {"id": self._new_id(), "type": ntype, "created_at": iso_now(), "account": self.account(acct)}
+        if ntype == "mention": n["status"] = self.status(acct, content, in_reply_to_id)
+        with self._lock:
+            self.notifications.append(n)
+            streams = list(self._streams)
+        for q in streams: q.put(n)
+        return n
+
+    @property
+    def stream_count(self):
+        with self._lock:
+            return len(self._streams)
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def drop_streams(self): # Close every streaming connection, as on a server restart
+        with self._lock:
+            for q in self._streams: q.put(None)
+
+    def stop(self):
+        self.drop_streams()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def rate_headers(self): # Count a call, returns (allowed, headers)
+        if not self.rate_limit: return True, {}
+        with self._lock:
+            now = time.time()
+            start, count = self._window
+            if now - start >= self.rate_window: start, count = now, 0
+            count += 1
+            self._window = (start, count)
+        reset = datetime.fromtimestamp(start + self.rate_window, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+        allowed = count <= self.rate_limit
+        if not allowed: self.rate_limited += 1
+        return allowed, {"X-RateLimit-Limit": str(self.rate_limit), "X-RateLimit-Remaining": str(max(self.rate_limit - count, 0)), "X-RateLimit-Reset": reset}
+
+    def _instance(self):
+        return {"uri": self.domain, "domain": self.domain, "title": "Fake", "version": "4.3.0", "api_versions": {"mastodon": 2}, "description": "",
+                "urls": {"streaming_api": self.base_url}, "configuration": {"statuses": {"max_characters": 500},
+                "urls": {"streaming": self.base_url}}, "contact_account": None, "rules": [], "languages": ["en"]}
+
+    def _route(self, method, path, params): # Returns (status code, JSON body)
+        parts = path.strip("/").split("/")
+        self.request_count += 1
+        if path in ("/api/v1/instance", "/api/v2/instance"): return 200, self._instance()
+        if path == "/api/v1/accounts/verify_credentials": return 200, self.account(self.bot_name + "@" + self.domain)
+        if path == "/api/v1/timelines/public": return 200, []
+        if path == "/api/v1/instance/domain_blocks": return 200, []
+        if path == "/.well-known/nodeinfo":
+            return 200, {"links": [{"rel": "http://nodeinfo.diaspora.software/ns/schema/2.0", "href": self.base_url + "/nodeinfo/2.0"}]}
+        if path == "/nodeinfo/2.0": return 200, {"version": "2.0", "software": {"name": "mastodon", "version": "4.3.0"}}
+        if path == "/api/v1/accounts/lookup":
+            return 200, self.account(params["acct"][0] if "@" in params["acct"][0] else params["acct"][0] + "@" + self.domain)
+        if path == "/api/v1/accounts/relationships":
+            ids = params.get("id[]", params.get("id", []))
+            return 200, [{"id": i, "following": i in self.follows, "requested": False, "followed_by": True,
+                          "requested_by": False, "blocking": False, "muting": False} for i in ids]
+        if path == "/api/v1/notifications": # Newest first, min_id pages forward from the oldest after it
+            limit = int(params.get("limit", ["40"])[0])
+            if "min_id" in params:
+                after = int(params["min_id"][0])
+                with self._lock:
+                    found = [n for n in self.notifications if int(n["id"]) > after][:limit]
+                return 200, list(reversed(found))
+            since = int(params.get("since_id", ["0"])[0])
+            with self._lock:
+                found = [n for n in self.notifications if int(n["id"]) > since]
+            return 200, list(reversed(found))[:limit]
+        if path == "/api/v1/statuses" and method == "POST":
+            st = self.status(self.bot_name + "@" + self.domain, params.get("status", [""])[0],
+                             params.get("in_reply_to_id", [None])[0], params.get("visibility", ["direct"])[0])
+            self.statuses.append(st)
+            if self.on_status: self.on_status(st, time.monotonic())
+            return 200, st
+        if len(parts) == 5 and parts[:3] == ["api", "v1", "accounts"] and parts[3] in self._by_id:
+            acc_id = parts[3]
+            if parts[4] == "follow":
+                self.follows.add(acc_id)
+                return 200, {"id": acc_id, "following": True, "requested": False, "followed_by": True, "requested_by": False}
+            if parts[4] == "unfollow":
+                self.follows.discard(acc_id)
+                return 200, {"id": acc_id, "following": False, "requested": False, "followed_by": True, "requested_by": False}
+            if parts[4] == "remove_from_followers":
+                return 200, {"id": acc_id, "following": acc_id in self.follows, "requested": False, "followed_by": False, "requested_by": False}
+            if parts[4] == "statuses":
+                acct = self._by_id[acc_id]["acct"]
+                acct = acct if "@" in acct else acct + "@" + self.domain
+                return 200, [self.status(acct, "<p>Hello</p>", visibility="public") for _ in range(int(params.get("limit", ["20"])[0]))]
+        if len(parts) == 5 and parts[:3] == ["api", "v1", "follow_requests"]: return 200, {"id": parts[3]}
+        return 404, {"error": "Record not found"}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args): pass
+
+            def _params(self):
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                path = url.path.rstrip("/") or "/"
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    body = self.rfile.read(length).decode()
+                    if "json" in (self.headers.get("Content-Type") or ""):
+                        params.update({k: v if isinstance(v, list) else [v] for k, v in json.loads(body).items()})
+                    else: params.update(parse_qs(body))
+                return path, params
+
+            def _serve(self, method):
+                path, params = self._params()
+                if path == "/api/v1/streaming/user": return self._stream()
+                allowed, headers = fake.rate_headers()
+                code, body = fake._route(method, path, params) if allowed else (429, {"error": "Too many requests"})
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                for k, v in headers.items(): self.send_header(k, v)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self): # Server-sent events until the client goes away or the server stops
+                q = queue.Queue()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                with fake._lock:
+                    fake._streams.append(q)
+                try:
+                    self.wfile.write(b":)\n") # Sent by Mastodon on connection
+                    self.wfile.flush()
+                    while True:
+                        try: n = q.get(timeout=5)
+                        except queue.Empty:
+                            self.wfile.write(b":thump\n\n")
+                            self.wfile.flush()
+                            continue
+                        if n is None: break
+                        self.wfile.write(b"event: notification\ndata: " + json.dumps(n).encode() + b"\n\n")
+                        self.wfile.flush()
+                except OSError: pass
+                finally:
+                    with fake._lock:
+                        fake._streams.remove(q)
+
+            def do_GET(self): self._serve("GET")
+            def do_POST(self): self._serve("POST")
+            def do_DELETE(self): self._serve("DELETE")
+
+        return Handler
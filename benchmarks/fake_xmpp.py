@@ -0,0 +1,304 @@
+#######################################
+# XMPP/AP Bridge - Fake XMPP server   #
+#######################################
+
+# Minimal local XMPP server stand-in, for benchmarks only: STARTTLS, SASL PLAIN, resource binding, roster,
+# presence and message routing between connected sessions; stanzas to users without a session are recorded as delivered
+# Stream management (XEP-0198): acks, and sessions lost without closing their stream are kept to be resumed
+# Roster versioning (XEP-0237): roster requests with the current version get an empty result, changes are pushed
+# Multicast (XEP-0033), if enabled: messages to the server domain are delivered to each of their addresses
+# External components (XEP-0114), if given: handshake on a port of their own, stanzas to their domain routed to them
+
+import asyncio
+import base64
+import hashlib
+import itertools
+import ssl
+import time
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+
+NS_CLIENT = "jabber:client"
+NS_COMPONENT = "jabber:component:accept"
+NS_STREAM = "http://etherx.jabber.org/streams"
+NS_TLS = "urn:ietf:params:xml:ns:xmpp-tls"
+NS_SASL = "urn:ietf:params:xml:ns:xmpp-sasl"
+NS_BIND = "urn:ietf:params:xml:ns:xmpp-bind"
+NS_ROSTER = "jabber:iq:roster"
+NS_DISCO_INFO = "http://jabber.org/protocol/disco#info"
+NS_SM = "urn:xmpp:sm:3"
+NS_ROSTERVER = "urn:xmpp:features:rosterver"
+NS_ADDRESS = "http://jabber.org/protocol/address"
+
+
+def tag(name, ns=NS_CLIENT):
+    return "{" + ns + "}" + name
+
+
+class Session:
+
+    def __init__(self, server, reader, writer, component=False):
+        self.server = server
+        self.component = component
+        self.reader = reader
+        self.writer = writer
+        self.jid = None # Full JID once bound
+        self.user = None
+        self.available = False
+        self.tls = False
+        self.seq = 0
+        self.sm_id = None # Stream management enabled when set
+        self.handled = 0 # Stanzas received from the client
+        self.sent = 0 # Stanzas sent to the client
+        self.unacked = [] # (number, stanza) sent and not yet acknowledged by the client
+        self.interested = False # Requested the roster, so receives roster pushes
+
+    @property
+    def bare(self):
+        return self.jid.split("/")[0] if self.jid else None
+
+    def send(self, data):
+        if not self.writer.is_closing(): self.writer.write(data.encode())
+
+    def stanza(self, data): # Send a stanza, kept until acknowledged when stream management is enabled
+        if self.sm_id:
+            self.sent += 1
+            self.unacked.append((self.sent, data))
+        self.send(data)
+
+    def _open_stream(self):
+        if self.component: # No features, the component proves its secret with a handshake
+            self.sid = str(next(self.server.ids))
+            return self.send(f"<?xml version='1.0'?><stream:stream xmlns='{NS_COMPONENT}' xmlns:stream='{NS_STREAM}' id='{self.sid}'>")
+        self.send(f"<?xml version='1.0'?><stream:stream xmlns='{NS_CLIENT}' xmlns:stream='{NS_STREAM}' "
+                  f"id='{next(self.server.ids)}' from='{self.server.domain}' version='1.0'>")
+        if not self.tls: features = f"<starttls xmlns='{NS_TLS}'><required/></starttls>"
+        elif not self.user: features = f"<mechanisms xmlns='{NS_SASL}'><mechanism>PLAIN</mechanism></mechanisms>"
+        else: features = (f"<bind xmlns='{NS_BIND}'/><session xmlns='urn:ietf:params:xml:ns:xmpp-session'><optional/></session>"
+                          + f"<ver xmlns='{NS_ROSTERVER}'/>" + (f"<sm xmlns='{NS_SM}'/>" if self.server.stream_management else ""))
+        self.send(f"<stream:features>{features}</stream:features>")
+
+    async def run(self):
+        restart = True
+        closed = False
+        try:
+            while restart:
+                restart = False
+                parser = ET.XMLPullParser(events=("start", "end"))
+                depth = 0
+                while not restart:
+                    data = await self.reader.read(65536)
+                    if not data: return
+                    parser.feed(data)
+                    for event, elem in parser.read_events():
+                        if event == "start":
+                            depth += 1
+                            if depth == 1: self._open_stream()
+                            continue
+                        depth -= 1
+                        if depth == 0: # Client closed the stream
+                            closed = True
+                            return
+                        if depth == 1: restart = await self._handle(elem)
+                        if restart: break
+        except (ConnectionError, ET.ParseError, ssl.SSLError): pass
+        finally:
+            if self.component: self.server.components.pop(self.jid, None)
+            if self.sm_id and not closed: self.server.detached[self.sm_id] = self # Still routed to, until resumed
+            else: self.server.sessions.discard(self)
+            if not self.writer.is_closing():
+                self.send("</stream:stream>")
+                self.writer.close()
+
+    async def _handle(self, elem): # Returns True when the stream must be restarted (after TLS and SASL)
+        if self.component:
+            for e in elem.iter(): e.tag = e.tag.replace("{" + NS_COMPONENT + "}", "{" + NS_CLIENT + "}") # Handled as client stanzas
+            if elem.tag == tag("handshake"): return self._handshake(elem)
+        if elem.tag == tag("starttls", NS_TLS):
+            self.send(f"<proceed xmlns='{NS_TLS}'/>")
+            await self.writer.drain()
+            await self.writer.start_tls(self.server.ssl_context)
+            self.tls = True
+            return True
+        if elem.tag == tag("auth", NS_SASL):
+            _, user, _ = base64.b64decode(elem.text or "").decode().split("\0")
+            self.user = user if "@" in user else user + "@" + self.server.domain
+            self.send(f"<success xmlns='{NS_SASL}'/>")
+            return True
+        if elem.tag.startswith("{" + NS_SM + "}"):
+            self._stream_management(elem)
+            return False
+        if self.sm_id: self.handled += 1
+        if elem.tag == tag("iq"): self._iq(elem)
+        elif elem.tag == tag("presence"): self._presence(elem)
+        elif elem.tag == tag("message"): self.server.route(self, elem)
+        return False
+
+    def _handshake(self, elem):
+        domain = next((d for d, secret in self.server.secrets.items() if hashlib.sha1((self.sid + secret).encode()).hexdigest() == elem.text), None)
+        if not domain: return self.send("<stream:error><not-authorized xmlns='urn:ietf:params:xml:ns:xmpp-streams'/></stream:error>")
+        self.jid = domain
+        self.server.components[domain] = self
+        self.send("<handshake/>")
+
+    def _stream_management(self, elem):
+        name = elem.tag.split("}")[1]
+        if name == "enable":
+            self.sm_id = f"sm{next(self.server.ids)}"
+            self.send(f"<enabled xmlns='{NS_SM}' id='{self.sm_id}' resume='true'/>")
+        elif name == "r": self.send(f"<a xmlns='{NS_SM}' h='{self.handled}'/>")
+        elif name == "a": self.unacked = [(n, d) for n, d in self.unacked if n > int(elem.get("h"))]
+        elif name == "resume":
+            old = self.server.detached.pop(elem.get("previd"), None)
+            if not old:
+                self.send(f"<failed xmlns='{NS_SM}'/>")
+                return
+            self.jid, self.seq, self.available, self.interested = old.jid, old.seq, old.available, old.interested
+            self.sm_id, self.handled, self.sent = old.sm_id, old.handled, old.sent
+            self.unacked = [(n, d) for n, d in old.unacked if n > int(elem.get("h"))]
+            self.server.sessions.discard(old)
+            self.server.sessions.add(self)
+            self.server.resumed += 1
+            self.send(f"<resumed xmlns='{NS_SM}' previd='{self.sm_id}' h='{self.handled}'/>")
+            for _, data in self.unacked: self.send(data)
+
+    def _reply(self, iq): # Addresses of a reply, a component giving the address it sends from
+        return (f" from={quoteattr(iq.get('to'))}" if iq.get("to") else "") + f" to={quoteattr(iq.get('from') or self.jid or '')}"
+
+    def _result(self, iq, payload=""):
+        self.stanza(f"<iq type='result' id={quoteattr(iq.get('id', ''))}{self._reply(iq)}>{payload}</iq>")
+
+    def _iq(self, iq):
+        child = iq[0] if len(iq) else None
+        if child is not None and child.tag == tag("bind", NS_BIND):
+            resource = child.findtext(tag("resource", NS_BIND)) or f"r{next(self.server.ids)}"
+            self.jid = f"{self.user}/{resource}"
+            self.seq = next(self.server.ids)
+            self.server.sessions.add(self)
+            self._result(iq, f"<bind xmlns='{NS_BIND}'><jid>{escape(self.jid)}</jid></bind>")
+        elif child is not None and child.tag == tag("query", NS_ROSTER):
+            roster = self.server.rosters.setdefault(self.bare, {})
+            if iq.get("type") == "get":
+                self.interested = True
+                ver = str(self.server.roster_versions.get(self.bare, 0))
+                if child.get("ver") == ver: return self._result(iq) # Up to date
+                items = "".join(f"<item jid={quoteattr(j)} subscription={quoteattr(s)}/>" for j, s in roster.items())
+                self.server.roster_items_sent += len(roster)
+                self._result(iq, f"<query xmlns='{NS_ROSTER}' ver='{ver}'>{items}</query>")
+            else:
+                for item in child:
+                    if item.get("subscription") == "remove": roster.pop(item.get("jid"), None)
+                    else: roster.setdefault(item.get("jid"), "none")
+                    self.server.roster_push(self.bare, item.get("jid"), roster.get(item.get("jid"), "remove"))
+                self._result(iq)
+        elif child is not None and child.tag == tag("query", NS_DISCO_INFO):
+            features = "".join(f"<feature var={quoteattr(f)}/>" for f in self.server.features)
+            self._result(iq, f"<query xmlns='{NS_DISCO_INFO}'><identity category='server' type='im'/>{features}</query>")
+        elif iq.get("type") in ("get", "set") and child is not None and child.tag == tag("ping", "urn:xmpp:ping"):
+            self._result(iq)
+        elif iq.get("type") in ("get", "set"):
+            self.stanza(f"<iq type='error' id={quoteattr(iq.get('id', ''))}{self._reply(iq)}><error type='cancel'>"
+                      "<service-unavailable xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error></iq>")
+
+    def _presence(self, presence):
+        ptype = presence.get("type")
+        to = presence.get("to")
+        if self.component: # No roster for a component
+            return self.server.presences.append((presence.get("from"), to, ptype, time.monotonic()))
+        if not to:
+            self.available = ptype != "unavailable"
+            return
+        roster = self.server.rosters.setdefault(self.bare, {})
+        to = to.split("/")[0]
+        if ptype in ("subscribe", "subscribed") and roster.get(to) != "both":
+            roster[to] = "both"
+            self.server.roster_push(self.bare, to, "both")
+        elif ptype in ("unsubscribe", "unsubscribed") and to in roster:
+            roster.pop(to)
+            self.server.roster_push(self.bare, to, "remove")
+        self.server.presences.append((self.bare, to, ptype, time.monotonic()))
+
+
+class FakeXMPP:
+
+    def __init__(self, domain, certfile, keyfile, host="127.0.0.1", port=0, on_message=None, stream_management=True, multicast=False, components=None):
+        self.domain = domain
+        self.host = host
+        self.port = port
+        self.component_port = 0
+        self.secrets = components or {} # Component domain: secret
+        self.components = {} # Component domain: connected session
+        self.on_message = on_message # Callback(from, to, body, id, timestamp) for every message to a user without session
+        self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.features = {NS_DISCO_INFO, "urn:xmpp:ping"} | ({NS_ADDRESS} if multicast else set())
+        self.multicast = 0 # Multicast stanzas received
+        self.stream_management = stream_management
+        self.detached = {} # Sessions lost with stream management enabled, by stream id
+        self.resumed = 0
+        self.roster_versions = {}
+        self.roster_items_sent = 0 # In full roster results
+        self.ids = itertools.count(1)
+        self.sessions = set()
+        self.rosters = {}
+        self.presences = []
+        self.delivered = []
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(lambda r, w: Session(self, r, w).run(), self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        if self.secrets:
+            self._component_server = await asyncio.start_server(lambda r, w: Session(self, r, w, component=True).run(), self.host, 0)
+            self.component_port = self._component_server.sockets[0].getsockname()[1]
+        return self
+
+    def roster_push(self, bare, jid, subscription): # New roster version, change sent to the interested sessions
+        ver = self.roster_versions[bare] = self.roster_versions.get(bare, 0) + 1
+        for s in self.sessions:
+            if s.bare == bare and s.interested:
+                s.stanza(f"<iq type='set' id='push{next(self.ids)}' to={quoteattr(s.jid)}><query xmlns='{NS_ROSTER}' ver='{ver}'>"
+                         f"<item jid={quoteattr(jid)} subscription={quoteattr(subscription)}/></query></iq>")
+
+    def drop(self, bare): # Cut the connection of a user's main session without closing the stream, as on a network failure
+        target = self.session_for(bare)
+        if target and not target.writer.is_closing(): target.writer.transport.abort()
+
+    async def stop(self):
+        for s in list(self.sessions) + list(self.components.values()): s.writer.close()
+        self._server.close()
+        if self.secrets: self._component_server.close()
+
+    def session_for(self, bare): # Oldest available session of a user, as a real server would pick by priority
+        if bare and bare.split("@")[-1] in self.components: return self.components[bare.split("@")[-1]]
+        found = [s for s in self.sessions if s.bare == bare and s.available]
+        return min(found, key=lambda s: s.seq) if found else None
+
+    def route(self, origin, msg):
+        to = (msg.get("to") or "").split("/")[0]
+        addresses = msg.find(tag("addresses", NS_ADDRESS))
+        if to == self.domain and addresses is not None and NS_ADDRESS in self.features: # One copy for each recipient, without addresses
+            self.multicast += 1
+            msg.remove(addresses)
+            for address in addresses:
+                msg.set("to", address.get("jid"))
+                self.route(origin, msg)
+            return
+        body = msg.findtext(tag("body"))
+        sender = msg.get("from") if origin.component else origin.jid # A component sends from any address of its domain
+        target = self.session_for(to)
+        if target:
+            target.stanza(self._message(sender, to, body, msg.get("id", ""), msg.get("type", "chat")))
+        else:
+            self.delivered.append((sender.split("/")[0], to, body, msg.get("id"), time.monotonic()))
+            if self.on_message: self.on_message(sender.split("/")[0], to, body, msg.get("id"), time.monotonic())
+
+    def inject_message(self, jid_from, jid_to, body, msg_id): # Message from a user without session to a connected one
+        target = self.session_for(jid_to)
+        if not target: return False
+        target.stanza(self._message(jid_from + "/bench", jid_to, body, msg_id, "chat"))
+        return True
+
+    def _message(self, jid_from, jid_to, body, msg_id, mtype):
+        return (f"<message from={quoteattr(jid_from)} to={quoteattr(jid_to)} id={quoteattr(msg_id or '')} "
+                f"type={quoteattr(mtype)}><body>{escape(body or '')}</body></message>")
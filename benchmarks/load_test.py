@@ -0,0 +1,348 @@
+#######################################
+# XMPP/AP Bridge - Load test harness  #
+#######################################
+
+# Runs ap-bridge.py and xmpp-bridge.py (or unified-bridge.py) against local fake Mastodon and XMPP servers, replays a configurable mix of
+# mentions, follows, commands and multi-recipient sends, and reports throughput, end-to-end latency and SQLite contention
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import signal
+import sqlite3
+import asyncio
+import tempfile
+import threading
+import subprocess
+from collections import deque
+from argparse import ArgumentParser
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from lib_bridge import ConfigLoader, InitBridge, epoch
+from fake_mastodon import FakeMastodon
+from fake_xmpp import FakeXMPP
+
+AP_DOMAIN = "fedi.test" # Instance hosting the Mastodon bot
+REMOTE_DOMAIN = "remote.test" # Fediverse users of the benchmark
+XMPP_DOMAIN = "xmpp.test"
+BOT_NAME = "xmpp_bridge"
+BOT_JID = "ap_bridge@" + XMPP_DOMAIN
+COMPONENT_DOMAIN = "bridge." + XMPP_DOMAIN # Of the bot in component mode
+COMPONENT_JID = "ap_bridge@" + COMPONENT_DOMAIN
+KINDS = ("mention", "multi", "xmpp", "command", "follow")
+TOKEN = re.compile(r"bench-[0-9a-f]{12}")
+FOLLOWER = re.compile(r"@(new\d+@" + re.escape(REMOTE_DOMAIN) + ")")
+
+
+def percentile(values, p):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# Outstanding operations keyed by correlation token, completed from the fake servers callbacks
+
+class Tracker:
+
+    def __init__(self):
+        self.pending = {}
+        self.latencies = {k: [] for k in KINDS}
+        self.sent = {k: 0 for k in KINDS}
+        self.commands = {} # Replies get a new stanza id, so commands complete in order per user
+        self._lock = threading.Lock()
+
+    def start(self, kind, token, expected=1, user=None):
+        with self._lock:
+            self.pending[token] = [kind, time.monotonic(), expected]
+            self.sent[kind] += 1
+            if user: self.commands.setdefault(user, deque()).append(token)
+
+    def done(self, token, timestamp):
+        with self._lock:
+            op = self.pending.get(token)
+            if not op: return
+            op[2] -= 1
+            if op[2] <= 0:
+                del self.pending[token]
+                self.latencies[op[0]].append(timestamp - op[1])
+
+    def on_status(self, status, timestamp): # Bridged XMPP message or registration reply posted on Mastodon
+        for token in TOKEN.findall(status["content"]) + FOLLOWER.findall(status["content"]): self.done(token, timestamp)
+
+    def on_message(self, jid_from, jid_to, body, msg_id, timestamp): # Bridged mention or command reply received on XMPP
+        tokens = TOKEN.findall(body or "")
+        if not tokens:
+            with self._lock:
+                queued = self.commands.get(jid_to)
+                token = queued.popleft() if queued else None
+            if token: self.done(token, timestamp)
+        for token in tokens: self.done(token, timestamp)
+
+
+# Fake XMPP server running on its own event loop thread
+
+class XMPPThread:
+
+    def __init__(self, certfile, keyfile, tracker, stream_management, multicast, component):
+        self.loop = asyncio.new_event_loop()
+        self.bot_jid = COMPONENT_JID if component else BOT_JID
+        self.server = FakeXMPP(XMPP_DOMAIN, certfile, keyfile, on_message=tracker.on_message, stream_management=stream_management, multicast=multicast,
+                               components={COMPONENT_DOMAIN: "bench"} if component else None)
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result()
+
+    def inject(self, jid_from, body, msg_id):
+        self.loop.call_soon_threadsafe(self.server.inject_message, jid_from, self.bot_jid, body, msg_id)
+
+    def drop(self):
+        self.loop.call_soon_threadsafe(self.server.drop, self.bot_jid)
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+# Measure how long a writer waits for the SQLite write lock while the bots are running
+
+class ContentionProbe(threading.Thread):
+
+    def __init__(self, database_file, interval):
+        super().__init__(daemon=True)
+        self.database_file = database_file
+        self.interval = interval
+        self.waits = []
+        self.running = True
+
+    def run(self):
+        conn = sqlite3.connect(self.database_file, timeout=60, isolation_level=None)
+        while self.running:
+            t = time.monotonic()
+            conn.execute("BEGIN IMMEDIATE")
+            self.waits.append(time.monotonic() - t)
+            conn.execute("COMMIT")
+            time.sleep(self.interval)
+        conn.close()
+
+
+class LoadTest:
+
+    def __init__(self, args):
+        self.args = args
+        self.dir = tempfile.mkdtemp(prefix="bridge-bench-")
+        self.tracker = Tracker()
+        self.mix = self._parse_mix(args.mix)
+        self.procs = []
+        self.scripts = ("unified-bridge.py",) if args.unified or args.component else ("ap-bridge.py", "xmpp-bridge.py")
+        self.follow_seq = 0
+
+    def _parse_mix(self, mix):
+        weights = {}
+        for part in mix.split(","):
+            kind, weight = part.split("=")
+            if kind not in KINDS: sys.exit(f"Unknown operation kind '{kind}', choose among: {', '.join(KINDS)}")
+            weights[kind] = float(weight)
+        return weights
+
+    def _lane_queue(self): # Overrides of bridge-lane-queue, e.g. registration=5,message=50
+        return {lane: int(n) for lane, n in (part.split("=") for part in self.args.lane_queue.split(",") if part)}
+
+    def _certificate(self):
+        cert, key = os.path.join(self.dir, "cert.pem"), os.path.join(self.dir, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+                        "-days", "1", "-subj", "/CN=" + XMPP_DOMAIN, "-addext", "subjectAltName=DNS:" + XMPP_DOMAIN],
+                       check=True, capture_output=True)
+        return cert, key
+
+    def _write_config(self):
+        with open(os.path.join(ROOT, "config", "xmpp-bridge-config.yml.sample")) as f:
+            conf = yaml.safe_load(f)
+        files_dir = os.path.join(self.dir, "files")
+        os.makedirs(files_dir)
+        conf.update({"ap_instance": AP_DOMAIN, "xmpp_instance": XMPP_DOMAIN, "ap_admin": ["admin@" + REMOTE_DOMAIN],
+            "xmpp_admin": ["admin@" + XMPP_DOMAIN], "ap_bridge_jid": self.xmpp.bot_jid, "ap_bridge_pass": "bench",
+            "xmpp_bridge_name": BOT_NAME + "@" + AP_DOMAIN, "xmpp_bridge_token": "bench",
+            "ap-api-base-url": self.mastodon.base_url, "xmpp-mode": ("client", "component")[self.args.component],
+            "xmpp-server": f"127.0.0.1:{(self.xmpp.server.port, self.xmpp.server.component_port)[self.args.component]}",
+            "bridge-log-file": os.path.join(self.dir, "bridge.log"), "bridge-database-file": os.path.join(self.dir, "bridge.db"), "bridge-storage": self.args.storage,
+            "bridge-commit-delay-ms": self.args.commit_delay,
+            "bridge-files-dir": files_dir, "translation-dir": os.path.join(ROOT, "bridge-messages-translations"),
+            "bridge-default-language": "en", "max-reg-users": 0, "max-ap-registrations": 0,
+            "bridge-lane-queue": {**conf.get("bridge-lane-queue", {}), **self._lane_queue()}, "bridge-capture-file": os.path.abspath(self.args.capture) if self.args.capture else "",
+            "max-user-rate": self.args.user_rate, "mastodon-rate-reserve": self.args.rate_reserve, "max-dest-to-send": max(self.args.recipients, 4)})
+        path = os.path.join(self.dir, "config.yml")
+        with open(path, "w") as f:
+            yaml.safe_dump(conf, f)
+        return path
+
+    def _seed(self, config_file): # Create the database with the bridge schema and register all benchmark users
+        config = ConfigLoader(config_file)
+        config.load()
+        InitBridge(None, 1, config).initialize()
+        config.storage_backend().flush() # Schema committed before the users are inserted through another connection
+        now = epoch()
+        rows = []
+        for i in range(self.args.users):
+            acc = self.mastodon.account(f"fuser{i}@{REMOTE_DOMAIN}")
+            rows.append((0, f"fuser{i}@{REMOTE_DOMAIN}", now, 1, "en", None, "Mastodon", acc["id"]))
+            rows.append((1, f"xuser{i}@{XMPP_DOMAIN}", now, 1, "en", None, "XMPP", "0"))
+            self.xmpp.server.rosters.setdefault(BOT_JID, {})[f"xuser{i}@{XMPP_DOMAIN}"] = "both"
+        with sqlite3.connect(config.database_file) as conn:
+            conn.executemany("INSERT INTO users(type, req_user, req_date, nb_reg, lang, revoke_date, app, acc_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return config
+
+    def _start_bots(self, config_file):
+        env = {k: v for k, v in os.environ.items() if k not in ("AP_BRIDGE_JID", "AP_BRIDGE_PASS", "XMPP_BRIDGE_NAME", "XMPP_BRIDGE_TOKEN")}
+        env["SSL_CERT_FILE"] = self.cert
+        for script in self.scripts:
+            out = open(os.path.join(self.dir, script + ".stderr"), "w")
+            self.procs.append(subprocess.Popen([sys.executable, os.path.join(ROOT, script), "-c", config_file],
+                                               env=env, stdout=out, stderr=subprocess.STDOUT))
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.mastodon.stream_count and self.xmpp.server.session_for(self.xmpp.bot_jid): return
+            if any(p.poll() is not None for p in self.procs): break
+            time.sleep(0.1)
+        self.stop()
+        sys.exit(f"Bots did not start, see logs in {self.dir}")
+
+    def _operation(self, kind):
+        token = "bench-" + uuid.uuid4().hex[:12]
+        n = self.args.users
+        fuser = f"fuser{random.randrange(n)}@{REMOTE_DOMAIN}"
+        xuser = f"xuser{random.randrange(n)}@{XMPP_DOMAIN}"
+        match kind:
+            case "mention":
+                self.tracker.start(kind, token)
+                self.mastodon.notify("mention", fuser, f"<p>@{BOT_NAME} xmpp:{xuser} Hello {token}</p>")
+            case "multi":
+                dests = random.sample(range(n), min(self.args.recipients, n))
+                self.tracker.start(kind, token, len(dests))
+                jids = " ".join(f"xmpp:xuser{i}@{XMPP_DOMAIN}" for i in dests)
+                self.mastodon.notify("mention", fuser, f"<p>@{BOT_NAME} {jids} Hello {token}</p>")
+            case "xmpp":
+                self.tracker.start(kind, token)
+                self.xmpp.inject(xuser, f"@{fuser} Hello {token}", uuid.uuid4().hex)
+            case "command":
+                self.tracker.start(kind, token, user=xuser)
+                self.xmpp.inject(xuser, "!help", token)
+            case "follow":
+                self.follow_seq += 1
+                follower = f"new{self.follow_seq}@{REMOTE_DOMAIN}"
+                self.tracker.start(kind, follower)
+                self.mastodon.notify("follow", follower)
+
+    def run(self):
+        self.cert, key = self._certificate()
+        self.mastodon = FakeMastodon(AP_DOMAIN, BOT_NAME, on_status=self.tracker.on_status,
+                                     rate_limit=self.args.api_limit, rate_window=self.args.api_window).start()
+        self.xmpp = XMPPThread(self.cert, key, self.tracker, not self.args.no_stream_management, self.args.multicast, self.args.component)
+        config_file = self._write_config()
+        config = self._seed(config_file)
+        self._start_bots(config_file)
+        probe = ContentionProbe(config.database_file, self.args.probe_interval)
+        probe.start()
+
+        kinds, weights = list(self.mix), list(self.mix.values())
+        start = time.monotonic()
+        next_at = drop_at = xmpp_drop_at = reload_at = start
+        while time.monotonic() - start < self.args.duration:
+            if self.args.drop_stream and time.monotonic() - drop_at >= self.args.drop_stream:
+                drop_at = time.monotonic()
+                self.mastodon.drop_streams()
+            if self.args.drop_xmpp and time.monotonic() - xmpp_drop_at >= self.args.drop_xmpp:
+                xmpp_drop_at = time.monotonic()
+                self.xmpp.drop()
+            if self.args.reload and time.monotonic() - reload_at >= self.args.reload:
+                reload_at = time.monotonic()
+                for p in self.procs: p.send_signal(signal.SIGHUP)
+            self._operation(random.choices(kinds, weights)[0])
+            next_at += random.expovariate(self.args.rate)
+            time.sleep(max(0, next_at - time.monotonic()))
+        sent_end = time.monotonic()
+        while self.tracker.pending and time.monotonic() - sent_end < self.args.drain:
+            time.sleep(0.1)
+        elapsed = time.monotonic() - start
+        probe.running = False
+        probe.join()
+        self.report(elapsed, probe.waits)
+        self.stop()
+
+    def stop(self):
+        for p in self.procs:
+            p.terminate()
+            try: p.wait(10)
+            except subprocess.TimeoutExpired: p.kill()
+        self.mastodon.stop()
+        self.xmpp.stop()
+        if not self.args.keep: shutil.rmtree(self.dir, ignore_errors=True)
+
+    def report(self, elapsed, waits):
+        with sqlite3.connect(os.path.join(self.dir, "bridge.db")) as conn:
+            shed = dict(conn.execute("SELECT dim, SUM(value) FROM counters WHERE metric = 'shed' GROUP BY dim").fetchall())
+        locked = 0
+        for script in self.scripts:
+            with open(os.path.join(self.dir, script + ".stderr")) as f:
+                locked += f.read().count("database is locked")
+        t = self.tracker
+        done = sum(len(v) for v in t.latencies.values())
+        result = {"elapsed_s": round(elapsed, 2), "completed": done, "throughput_per_s": round(done / elapsed, 2),
+                  "timeouts": len(t.pending), "mastodon_requests": self.mastodon.request_count,
+                  "mastodon_rate_limited": self.mastodon.rate_limited, "xmpp_resumed": self.xmpp.server.resumed,
+                  "xmpp_roster_items_sent": self.xmpp.server.roster_items_sent, "xmpp_multicast": self.xmpp.server.multicast, "operations": {},
+                  "sqlite_lock_wait_ms": {p: round(percentile(waits, p) * 1000, 2) for p in (50, 95, 99, 100)},
+                  "sqlite_locked_errors": locked, "shed": shed}
+        print(f"\n{'operation':<10}{'sent':>7}{'done':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for k in KINDS:
+            if not t.sent[k]: continue
+            lat = t.latencies[k]
+            result["operations"][k] = {"sent": t.sent[k], "done": len(lat), **{f"p{p}_ms": round(percentile(lat, p) * 1000, 1) for p in (50, 95, 99)}}
+            r = result["operations"][k]
+            print(f"{k:<10}{r['sent']:>7}{r['done']:>7}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+        print(f"\nCompleted {done} operations in {elapsed:.1f} s: {result['throughput_per_s']} operations/s, {len(t.pending)} timed out")
+        w = result["sqlite_lock_wait_ms"]
+        print(f"SQLite write lock wait (ms): p50 {w[50]}, p95 {w[95]}, p99 {w[99]}, max {w[100]}; 'database is locked' errors: {locked}")
+        print(f"Mastodon API requests served: {self.mastodon.request_count}, rejected by rate limit: {self.mastodon.rate_limited}")
+        print(f"XMPP streams resumed: {self.xmpp.server.resumed}, roster items sent in full rosters: {self.xmpp.server.roster_items_sent}, "
+              f"multicast stanzas: {self.xmpp.server.multicast}")
+        print(f"Events shed while busy: {', '.join(f'{lane} {n}' for lane, n in shed.items()) or 'none'}")
+        if self.args.json:
+            with open(self.args.json, "w") as f:
+                json.dump(result, f, indent=2)
+        if self.args.keep: print(f"Logs, database and configuration kept in {self.dir}")
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = "XMPP/AP Bridge - end-to-end load test against local fake servers")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load generation (default 30)")
+    parser.add_argument("--rate", type=float, default=5, help="mean operations per second, Poisson arrivals (default 5)")
+    parser.add_argument("--mix", default="mention=40,multi=10,xmpp=30,command=15,follow=5", help="weighted mix of operations: " + ", ".join(KINDS))
+    parser.add_argument("--users", type=int, default=50, help="registered users on each side (default 50)")
+    parser.add_argument("--recipients", type=int, default=3, help="recipients of a multi-recipient send (default 3)")
+    parser.add_argument("--user-rate", type=int, default=0, help="max-user-rate of the bridge configuration (default 0, disabled)")
+    parser.add_argument("--api-limit", type=int, default=0, help="Mastodon API calls allowed per window by the fake server (default 0, no limit)")
+    parser.add_argument("--api-window", type=float, default=300, help="seconds of a Mastodon rate limit window (default 300)")
+    parser.add_argument("--rate-reserve", type=int, default=20, help="mastodon-rate-reserve of the bridge configuration (default 20)")
+    parser.add_argument("--drop-stream", type=float, default=0, help="close the Mastodon stream every this number of seconds (default 0, never)")
+    parser.add_argument("--drop-xmpp", type=float, default=0, help="cut the XMPP bot connection every this number of seconds (default 0, never)")
+    parser.add_argument("--reload", type=float, default=0, help="send SIGHUP to the bots every this number of seconds (default 0, never)")
+    parser.add_argument("--no-stream-management", action="store_true", help="do not offer XEP-0198 stream management from the fake XMPP server")
+    parser.add_argument("--multicast", action="store_true", help="offer XEP-0033 multicast from the fake XMPP server")
+    parser.add_argument("--lane-queue", default="", help="queue limits of the bridge lanes, e.g. registration=5,message=50 (default from the sample)")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for outstanding operations (default 30)")
+    parser.add_argument("--probe-interval", type=float, default=0.05, help="seconds between SQLite lock probes (default 0.05)")
+    parser.add_argument("--unified", action="store_true", help="run both bots in a single process with unified-bridge.py")
+    parser.add_argument("--component", action="store_true", help="connect the XMPP bot as an external component (XEP-0114), implies --unified")
+    parser.add_argument("--storage", default="sqlite", choices=("sqlite", "async"), help="bridge-storage of the bots (default sqlite)")
+    parser.add_argument("--commit-delay", type=float, default=10, help="bridge-commit-delay-ms with --storage async (default 10)")
+    parser.add_argument("--capture", help="capture the inbound traffic of the bots to this file, for benchmarks/replay.py")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory with logs and database")
+    LoadTest(parser.parse_args()).run()
@@ -0,0 +1,291 @@
+#######################################
+# XMPP/AP Bridge - Traffic replay     #
+#######################################
+
+# Replays a capture of inbound traffic (bridge-capture-file of the configuration) through the handlers of both bots,
+# in one process against local fake Mastodon and XMPP servers, at a chosen speed, and reports throughput and latency
+# by event and by lane. Senders and addressed users of the capture are registered first, except those whose first event
+# is a follow or subscription. Latency runs from the time an event is due to the end of its handling (replies and bridged
+# messages sent), so that it includes the time spent waiting in its lane
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import importlib
+import threading
+import subprocess
+from types import SimpleNamespace
+from datetime import datetime, timezone
+from collections import defaultdict
+from argparse import ArgumentParser
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from lib_bridge import ConfigLoader, InitBridge, LogManager, ContentParser, UserRow, inbound_lane, epoch
+from fake_mastodon import FakeMastodon
+from fake_xmpp import FakeXMPP
+from load_test import percentile
+
+ap_bridge = importlib.import_module("ap-bridge") # Bot modules are named with a dash, so not importable by statement
+xmpp_bridge = importlib.import_module("xmpp-bridge")
+
+EVENTS = ("mention", "follow", "follow_request", "message", "subscribe", "unsubscribe")
+REGISTRATIONS = ("follow", "follow_request", "subscribe")
+
+
+def load_capture(path): # Header of the first bot found and events of all bots, in time order
+    header, events = None, []
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if "capture" in entry: header = header or entry
+            elif entry.get("event") in EVENTS: events.append(entry)
+    if not header: sys.exit(f"No capture header found in {path}")
+    return header, sorted(events, key=lambda e: e["t"])
+
+
+# Events due, shed and completed, keyed by their sequence in the replay
+
+class Tracker:
+
+    def __init__(self):
+        self.events = {} # Sequence: [event, lane, due (monotonic time), end or None, shed]
+        self._lock = threading.Lock()
+
+    def start(self, seq, event, lane, due):
+        with self._lock: self.events[seq] = [event, lane, due, None, False]
+
+    def done(self, seq):
+        with self._lock: self.events[seq][3] = time.monotonic()
+
+    def shed(self, seq):
+        with self._lock:
+            self.events[seq][3] = time.monotonic()
+            self.events[seq][4] = True
+
+    @property
+    def pending(self):
+        with self._lock: return sum(1 for e in self.events.values() if e[3] is None)
+
+
+# Admission of a bot, completing in the tracker the event being fed when its job ends
+
+class TimedAdmission:
+
+    def __init__(self, admission, tracker, asynchronous):
+        self._admission = admission
+        self._tracker = tracker
+        self._async = asynchronous
+        self.current = None # Event being fed, read when the bot submits its job (before the handler awaits anything)
+
+    def submit(self, lane, job, wait=False):
+        seq, self.current, tracker = self.current, None, self._tracker
+        if self._async:
+            async def timed():
+                try: await job()
+                finally: tracker.done(seq)
+        else:
+            def timed():
+                try: job()
+                finally: tracker.done(seq)
+        if self._admission.submit(lane, timed, wait): return True
+        tracker.shed(seq)
+        return False
+
+    def __getattr__(self, name): # Busy replies and blocking work as the bot's
+        return getattr(self._admission, name)
+
+
+class Replay:
+
+    def __init__(self, args):
+        self.args = args
+        self.dir = tempfile.mkdtemp(prefix="bridge-replay-")
+        self.header, self.events = load_capture(args.capture)
+        if args.limit: self.events = self.events[:args.limit]
+        self.tracker = Tracker()
+        self.delivered = 0 # Messages received by XMPP users
+
+    def _certificate(self, domain):
+        cert, key = os.path.join(self.dir, "cert.pem"), os.path.join(self.dir, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+                        "-days", "1", "-subj", "/CN=" + domain, "-addext", "subjectAltName=DNS:" + domain],
+                       check=True, capture_output=True)
+        return cert, key
+
+    def _write_config(self, component):
+        h = self.header
+        with open(os.path.join(ROOT, "config", "xmpp-bridge-config.yml.sample")) as f:
+            conf = yaml.safe_load(f)
+        files_dir = os.path.join(self.dir, "files")
+        os.makedirs(files_dir)
+        conf.update({"ap_instance": h["ap_instance"], "xmpp_instance": h["xmpp_instance"], "ap_admin": h["ap_admin"], "xmpp_admin": h["xmpp_admin"],
+            "ap_bridge_jid": h["ap_bridge_jid"], "ap_bridge_pass": "replay", "xmpp_bridge_name": h["xmpp_bridge_name"], "xmpp_bridge_token": "replay",
+            "bridge-prefixes": h["pfix"], "ap-api-base-url": self.mastodon.base_url, "xmpp-mode": ("client", "component")[component],
+            "xmpp-server": f"127.0.0.1:{(self.xmpp.port, self.xmpp.component_port)[component]}",
+            "bridge-log-file": os.path.join(self.dir, "bridge.log"), "bridge-database-file": os.path.join(self.dir, "bridge.db"),
+            "bridge-storage": self.args.storage, "bridge-files-dir": files_dir, "bridge-capture-file": "",
+            "translation-dir": os.path.join(ROOT, "bridge-messages-translations"), "bridge-default-language": "en",
+            "max-reg-users": 0, "max-ap-registrations": 0, "max-user-rate": 0})
+        for key, value in (("bridge-lane-workers", self.args.lane_workers), ("bridge-lane-queue", self.args.lane_queue)): # e.g. registration=5,message=50
+            conf[key] = {**conf.get(key, {}), **{lane: int(n) for lane, n in (part.split("=") for part in value.split(",") if part)}}
+        path = os.path.join(self.dir, "config.yml")
+        with open(path, "w") as f:
+            yaml.safe_dump(conf, f)
+        return path
+
+    def _seed(self, config): # Register senders and addressed users, as they were when captured
+        first, users = {}, set()
+        for e in self.events:
+            first.setdefault((e["type"], e["from"]), e["event"])
+            if "content" not in e: continue
+            parser = ContentParser(e["type"], e["content"], config)
+            parser.parse_content()
+            users.update((0, u) for u in parser.ap_addr_list)
+            users.update((1, u) for u in parser.xmpp_jid_list)
+        users.update(k for k, event in first.items() if event not in REGISTRATIONS)
+        storage, now = config.storage_backend(), epoch()
+        roster = self.xmpp.rosters.setdefault(config.ap_bridge_jid, {})
+        for user_type, user in users:
+            if user_type: roster[user] = "both"
+            acc_id = self.mastodon.account(user)["id"] if not user_type else "0"
+            storage.users.save(UserRow(user_type, user, now, 1, "en", None, ("Mastodon", "XMPP")[user_type], acc_id))
+        storage.flush()
+        return len(users)
+
+    def _notification(self, e, seq): # As received from the Mastodon stream
+        local, domain = e["from"].split("@", 1)
+        acct = local if domain == self.header["ap_instance"] else e["from"]
+        n = {"id": str(seq + 1), "type": e["event"], "account": {"acct": acct, "id": self.mastodon.account(e["from"])["id"]}}
+        if e["event"] == "mention":
+            url = f"https://{domain}/statuses/{seq}"
+            n["status"] = {"id": f"9{seq}", "content": e["content"], "in_reply_to_id": f"8{seq}" if e.get("reply") else None,
+                           "sensitive": bool(e.get("sensitive")), "spoiler_text": e.get("spoiler", ""), "poll": {} if e.get("poll") else None,
+                           "media_attachments": [{"url": f"{url}/media/{i}"} for i in range(e.get("media", 0))], "url": url}
+        n = json.loads(json.dumps(n), object_hook=lambda d: SimpleNamespace(**d))
+        if e["event"] == "mention": n.status.created_at = datetime.now(timezone.utc) # Posted when due
+        return n
+
+    async def _feed_xmpp(self, e, seq): # Stanza handled as the bot does on receipt
+        bot, jid = self.bot, e["from"] + "/replay"
+        self.bot_admission.current = seq
+        if e["event"] == "message":
+            msg = bot.make_message(bot.boundjid.bare, e["content"], mtype="chat", mfrom=jid)
+            msg["id"] = f"replay{seq}"
+            await bot.message(msg)
+        else:
+            presence = bot.make_presence(pto=bot.boundjid.bare, pfrom=jid, ptype=e["event"])
+            if e["event"] == "subscribe": await bot.subscribe_request(presence)
+            else:
+                await bot.unsubscribe_request(presence) # Handled at once, not by a lane
+                self.tracker.done(seq)
+
+    def run(self):
+        component = self.header.get("xmpp_mode") == "component"
+        bot_jid, ap_domain = self.header["ap_bridge_jid"], self.header["ap_instance"]
+        cert, key = self._certificate(self.header["xmpp_instance"])
+        os.environ["SSL_CERT_FILE"] = cert
+        for k in ("AP_BRIDGE_JID", "AP_BRIDGE_PASS", "XMPP_BRIDGE_NAME", "XMPP_BRIDGE_TOKEN"): os.environ.pop(k, None)
+        self.mastodon = FakeMastodon(ap_domain, self.header["xmpp_bridge_name"].split("@")[0]).start()
+        server_loop = asyncio.new_event_loop()
+        threading.Thread(target=server_loop.run_forever, daemon=True).start()
+        self.xmpp = FakeXMPP(self.header["xmpp_instance"], cert, key, on_message=self._delivered,
+                             multicast=self.args.multicast, components={bot_jid.split("@")[1]: "replay"} if component else None)
+        asyncio.run_coroutine_threadsafe(self.xmpp.start(), server_loop).result()
+
+        config = ConfigLoader(self._write_config(component))
+        config.load()
+        LogManager(config).start()
+        mastodon = config.mastodon_client()
+        InitBridge(mastodon, 0, config).initialize()
+        InitBridge(None, 1, config).initialize()
+        seeded = self._seed(config)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop) # Of the bot session, run on its own thread
+        self.bot = ap_bridge.bridge_session(config)
+        self.bot._admission = self.bot_admission = TimedAdmission(self.bot._admission, self.tracker, True)
+        listener = xmpp_bridge.Listener(mastodon, config)
+        listener._admission = listener_admission = TimedAdmission(listener._admission, self.tracker, False)
+        threading.Thread(target=loop.run_until_complete, args=(self.bot.run_forever(),), daemon=True).start()
+        deadline = time.monotonic() + 30
+        while not self.xmpp.session_for(bot_jid):
+            if time.monotonic() > deadline: sys.exit(f"XMPP bot did not connect, see logs in {self.dir}")
+            time.sleep(0.1)
+        time.sleep(0.5) # Session start: roster and service discovery
+
+        print(f"Replaying {len(self.events)} events at {self.args.speed:g}x, {seeded} users registered first")
+        t0, start, gap, slip = self.events[0]["t"] if self.events else 0, time.monotonic(), 0.0, []
+        previous = t0
+        for seq, e in enumerate(self.events):
+            if self.args.max_gap: gap += max(e["t"] - previous - self.args.max_gap, 0) # Long idle periods are cut short
+            previous = e["t"]
+            due = start + (e["t"] - t0 - gap) / self.args.speed
+            time.sleep(max(0, due - time.monotonic()))
+            slip.append(time.monotonic() - due)
+            lane = inbound_lane(config, e["type"], e["from"], e.get("content")) if e["event"] != "unsubscribe" else "-"
+            self.tracker.start(seq, e["event"], lane, due)
+            if e["type"]: asyncio.run_coroutine_threadsafe(self._feed_xmpp(e, seq), loop)
+            else:
+                listener_admission.current = seq
+                listener._process(self._notification(e, seq))
+                if listener_admission.current == seq: self.tracker.done(seq) # Not for the bot, e.g. follow of a locked account
+        fed = time.monotonic()
+        while self.tracker.pending and time.monotonic() - fed < self.args.drain:
+            time.sleep(0.05)
+        self.report(time.monotonic() - start, slip)
+        asyncio.run_coroutine_threadsafe(self.xmpp.stop(), server_loop).result()
+        self.mastodon.stop()
+        if not self.args.keep: shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _delivered(self, jid_from, jid_to, body, msg_id, timestamp):
+        self.delivered += 1
+
+    def report(self, elapsed, slip):
+        events = list(self.tracker.events.values())
+        done = [e for e in events if e[3] is not None and not e[4]]
+        result = {"events": len(events), "speed": self.args.speed, "elapsed_s": round(elapsed, 2), "completed": len(done),
+                  "shed": sum(e[4] for e in events), "timeouts": self.tracker.pending, "throughput_per_s": round(len(done) / elapsed, 2) if elapsed else 0,
+                  "feed_slip_ms": {p: round(percentile(slip, p) * 1000, 1) for p in (50, 99)}, "mastodon_requests": self.mastodon.request_count,
+                  "mastodon_statuses": len(self.mastodon.statuses), "xmpp_messages": self.delivered, "by_event": {}, "by_lane": {}}
+        for key, index in (("by_event", 0), ("by_lane", 1)):
+            groups = defaultdict(list)
+            for e in events: groups[e[index]].append(e)
+            print(f"\n{key[3:]:<16}{'sent':>7}{'done':>7}{'shed':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+            for name, group in sorted(groups.items()):
+                lat = [e[3] - e[2] for e in group if e[3] is not None and not e[4]]
+                r = result[key][name] = {"sent": len(group), "done": len(lat), "shed": sum(e[4] for e in group),
+                                         **{f"p{p}_ms": round(percentile(lat, p) * 1000, 1) for p in (50, 95, 99)}}
+                print(f"{name:<16}{r['sent']:>7}{r['done']:>7}{r['shed']:>7}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+        print(f"\nCompleted {len(done)} of {len(events)} events in {elapsed:.1f} s: {result['throughput_per_s']} events/s, "
+              f"{result['shed']} shed, {result['timeouts']} timed out")
+        print(f"Feeding late by (ms): p50 {result['feed_slip_ms'][50]}, p99 {result['feed_slip_ms'][99]}")
+        print(f"Mastodon API requests served: {self.mastodon.request_count}, statuses posted: {result['mastodon_statuses']}, XMPP messages delivered: {self.delivered}")
+        if self.args.json:
+            with open(self.args.json, "w") as f:
+                json.dump(result, f, indent=2)
+        if self.args.keep: print(f"Logs, database and configuration kept in {self.dir}")
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = "XMPP/AP Bridge - replay of captured traffic against local fake servers")
+    parser.add_argument("capture", help="capture file written by the bots (bridge-capture-file)")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed, from 1 (as captured) to 100 times faster (default 1)")
+    parser.add_argument("--max-gap", type=float, default=0, help="cut idle periods of the capture to this number of seconds (default 0, kept)")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first events (default 0, all)")
+    parser.add_argument("--lane-workers", default="", help="workers of the bridge lanes, e.g. message=2 (default from the sample)")
+    parser.add_argument("--lane-queue", default="", help="queue limits of the bridge lanes, e.g. registration=5,message=50 (default from the sample)")
+    parser.add_argument("--multicast", action="store_true", help="offer XEP-0033 multicast from the fake XMPP server")
+    parser.add_argument("--storage", default="memory", choices=("memory", "sqlite", "async"), help="bridge-storage of the bots (default memory)")
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for outstanding events (default 30)")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory with logs and database")
+    args = parser.parse_args()
+    if not 1 <= args.speed <= 100: parser.error("--speed must be from 1 to 100")
+    Replay(args).run()
@@ -0,0 +1,51 @@
+####################################
+#   XMPP/AP Bridge - Admin tasks   #
+####################################
+
+# Administration from the command line, next to the running bots, sharing their configuration and database
+# import-red: add the domains of a Mastodon domain block export (CSV) or of a plain list to the red list, then unregister
+# registered users of these domains in one pass
+
+import os
+import sys
+import csv
+from argparse import ArgumentParser
+from lib_bridge import BlocklistImport, ConfigLoader, LogManager, background_calls
+
+CONFIG_FILE = os.getenv("XMPP_BRIDGE_CONFIG_FILE", "/usr/local/etc/xmpp-bridge-config.yml")
+
+
+def import_red(config, path, purge):
+    imp = BlocklistImport(config)
+    try:
+        domains, skipped = imp.read(path)
+        added, listed = imp.apply(domains, path)
+    except (OSError, UnicodeError, csv.Error) as e:
+        sys.exit(f"Could not import {path}: {e}")
+    print(f"{len(domains)} domains read, {len(added)} added to red list, {listed} already listed, {skipped} entries skipped")
+    if not added or not purge: return
+    user_types = (0,) if config.xmpp_mode == "component" else (0, 1) # Only the running component can unsubscribe its users
+    print(f"Unregistering {imp.affected(added, user_types)} registered users of these domains...")
+    with background_calls():
+        unregistered = sum(imp.purge(set(added), user_types))
+    config.storage_backend().flush()
+    print(f"{unregistered} users unregistered")
+    if user_types == (0,): print("XMPP users of these domains will be unregistered by the next domain check of the XMPP bot")
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = "XMPP/AP Bridge - administration tasks")
+    parser.add_argument("-c", "--config", help="specify configuration file path and name")
+    tasks = parser.add_subparsers(dest="task", required=True)
+    task = tasks.add_parser("import-red", help="import a domain blocklist (Mastodon CSV export or one domain per line) into the red list")
+    task.add_argument("file", help="path of the blocklist file")
+    task.add_argument("--no-purge", action="store_true", help="only update the red list, registered users are left to the bots' domain checks")
+    args = parser.parse_args()
+    config = ConfigLoader(args.config if args.config else CONFIG_FILE)
+    config.load(probe=False)
+    LogManager(config).start()
+    config.storage_backend().create_schema() # Up to date if the bots ran once
+
+    match args.task:
+        case "import-red": import_red(config, args.file, not args.no_purge)
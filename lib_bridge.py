@@ -7,15 +7,35 @@ VERSION = "0.7.4"
 
 import sqlite3
 import os
+import sys
 import re
+import csv
+import json
+import hashlib
+import hmac
 import yaml
-from datetime import datetime, timedelta
+import logging
+import logging.handlers
+import queue
+import atexit
+import threading
+import time
+import random
+import tempfile
+import tracemalloc
+from collections import namedtuple, OrderedDict, Counter
+from functools import partial
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
 from requests import get
 import asyncio
 import slixmpp
 from mastodon import Mastodon, MastodonError
+from slixmpp.plugins.xep_0033 import Addresses
 
 
 ###
@@ -55,11 +75,19 @@ class NestedDictBuilder:
         return self.nested_dict, self.language_list
 
 
+NEW_COMMANDS = {23: "stats", 24: "profile", 25: "importred"} # Index: default name of the commands added since the first versions
+
+
 # Global configuration parameters class (fetched from configuration file, params explained there)
 
 class ConfigLoader:
 
+    RELOADABLE = ("ap_admin", "xmpp_admin", "default_lang", "unknown_lang", "command_list", "pfix", "char_limit", "min_active",
+                  "green_mode", "max_reg", "max_reg_users", "max_dest", "max_reply", "max_rate", "retention", "comm_limit",
+                  "silent_block", "silent_send", "catchup_hours", "max_inbound", "profile_seconds", "profile_interval", "latency_window", "latency_slo", "help_url", "ahelp_url", "messages", "language_list", "domains")
+
     def __init__(self, config_file):
+        self._config_file = config_file
         with open(config_file) as f:
             self._config_list = yaml.safe_load(f)
         self.ap_bridge_jid = os.getenv("AP_BRIDGE_JID", self._config_list["ap_bridge_jid"])
@@ -70,18 +98,50 @@ class ConfigLoader:
         self.xmpp_bridge_token = os.getenv("XMPP_BRIDGE_TOKEN", self._config_list["xmpp_bridge_token"])
         self.xmpp_instance = self._config_list["xmpp_instance"]
         self.xmpp_admin = self._config_list["xmpp_admin"]
+        self.ap_api_url = self._config_list.get("ap-api-base-url") or self.ap_instance
+        self.xmpp_mode = self._config_list.get("xmpp-mode", "client")
+        server = self._config_list.get("xmpp-server") or ("localhost:5347" if self.xmpp_mode == "component" else "")
+        self.xmpp_server = (server.rsplit(":", 1)[0], int(server.rsplit(":", 1)[1])) if server else (None, None)
         self.user_agent = self._config_list["user-agent"]
         self.log_file = self._config_list["bridge-log-file"]
+        self.log_level = self._config_list.get("bridge-log-level", "INFO")
+        self.log_max_bytes = self._config_list.get("bridge-log-max-bytes", 0)
+        self.log_rotate_when = self._config_list.get("bridge-log-rotate-when", "")
+        self.log_backups = self._config_list.get("bridge-log-backups", 5)
+        self.log_dup_window = self._config_list.get("bridge-log-duplicate-seconds", 60)
         self.database_file = self._config_list["bridge-database-file"]
+        self.storage_type = self._config_list.get("bridge-storage", "sqlite")
+        self.commit_delay = self._config_list.get("bridge-commit-delay-ms", 10) / 1000
+        self.commit_batch = self._config_list.get("bridge-commit-max-batch", 100)
+        self.conversation_cache = self._config_list.get("bridge-conversation-cache", 10000)
+        self.ledger_cache = self._config_list.get("bridge-ledger-cache", 10000)
+        self.ledger_hours = self._config_list.get("bridge-ledger-hours", 48)
         self.start_file = os.path.join(self._config_list["bridge-files-dir"], "xmpp-bridge-start.txt")
         self.open_file = os.path.join(self._config_list["bridge-files-dir"], "xmpp-bridge-open.txt")
         self.dred_file = os.path.join(self._config_list["bridge-files-dir"], "xmpp-bridge-red.txt")
         self.dgreen_file = os.path.join(self._config_list["bridge-files-dir"], "xmpp-bridge-green.txt")
+        self.cursor_file = os.path.join(self._config_list["bridge-files-dir"], "xmpp-bridge-notification.txt")
+        self.import_dir = self._config_list.get("bridge-import-dir", "") # Only place admin commands may read blocklists from
+        self.files_dir = self._config_list["bridge-files-dir"]
+        self.profile_seconds = self._config_list.get("bridge-profile-seconds", 30)
+        self.profile_interval = self._config_list.get("bridge-profile-interval-ms", 10) / 1000
+        self.maintenance_minutes = self._config_list.get("bridge-maintenance-minutes", 60)
+        self.maintenance_budget = self._config_list.get("bridge-maintenance-budget-ms", 200) / 1000
+        self.reconnect_max = self._config_list.get("bridge-reconnect-max-delay", 60)
+        self.lane_workers = {**LANE_WORKERS, **(self._config_list.get("bridge-lane-workers") or {})}
+        self.lane_queue = {**LANE_QUEUE, **(self._config_list.get("bridge-lane-queue") or {})}
+        self.capture_file = self._config_list.get("bridge-capture-file", "")
+        self.latency_window = self._config_list.get("bridge-latency-window-minutes", 60)
+        self.latency_slo = self._config_list.get("bridge-latency-slo-ms", 0)
+        self.catchup_hours = self._config_list.get("mastodon-catchup-hours", 24)
         self.default_lang = self._config_list["bridge-default-language"]
         self.unknown_lang = self._config_list["bridge-unknown-language"]
         self.command_list = self._config_list["bridge-command-list"]
+        for index, name in NEW_COMMANDS.items(): # Configuration files of earlier versions do not list them, others may rename them
+            if len(self.command_list) == index and name not in self.command_list: self.command_list.append(name)
         self.pfix = self._config_list["bridge-prefixes"]
         self.char_limit = self._config_list["max-char-per-post"]
+        self.max_inbound = (self._config_list.get("max-inbound-html", 65536), self._config_list.get("max-inbound-text", 16384)) # By user_type
         self.min_active = min(self._config_list["min-ap-activity-posts"], 40) # Mastodon limit is 40
         self.green_mode = self._config_list["greenlist-mode"]
         self.max_reg = self._config_list["max-ap-registrations"]
@@ -89,76 +149,1768 @@ class ConfigLoader:
         self.max_dest = max(self._config_list["max-dest-to-send"], 1) # Do not allow 0 as a value
         self.max_reply = self._config_list["max-minutes-for-reply"]
         self.max_rate = self._config_list["max-user-rate"]
+        self.rate_reserve = self._config_list.get("mastodon-rate-reserve", 20)
         if self.max_rate: self.max_dest = min(self.max_dest, self.max_rate) # Do not allow more dest than rate
         self.retention = self._config_list["max-retention-days-revoked-user"]
         self.comm_limit = self._config_list["comm-max-limit-days"]
         self.silent_block = self._config_list["silent-block"]
         self.silent_send = self._config_list["silent-send"]
+        self.domains = DomainPolicy(self.dred_file, self.dgreen_file)
         self.account_locked = False
+        self.probed = False # Limits fetched from the instance override those of the configuration file
+        self.mastodon = None # Shared Mastodon client, see mastodon_client()
+        self.xmpp_session = None # Running XMPP bot session of this process, see XmppDispatch
+        self.storage = None # Shared storage, see storage_backend()
+        self.ledger = None # Shared ledger of processed messages, see processed_ledger()
+        self.sampler = None # Profiler of the running bot, see profiler()
+        self.scheduler = None # Maintenance jobs of the running bots, see maintenance()
+        self.recorder = None # Capture of inbound traffic, see traffic_capture()
         self.help_url = self._config_list["help-url"]
         self.ahelp_url = self._config_list["ahelp-url"]
         self.version = VERSION
 
+    def mastodon_client(self): # One Mastodon client per process, created on first use
+        if not self.mastodon:
+            self.mastodon = MastodonScheduler(Mastodon(access_token = self.xmpp_bridge_token, api_base_url = self.ap_api_url, user_agent = self.user_agent), self.rate_reserve / 100)
+        return self.mastodon
+
+    def storage_backend(self): # One storage per process, created on first use
+        if not self.storage:
+            match self.storage_type:
+                case "async": self.storage = AsyncSqliteStorage(self.database_file, self.commit_delay, self.commit_batch, self.conversation_cache)
+                case "memory": self.storage = MemoryStorage()
+                case _: self.storage = SqliteStorage(self.database_file, cache_size=self.conversation_cache)
+        return self.storage
+
+    def processed_ledger(self): # One ledger per process, created on first use
+        if not self.ledger:
+            self.ledger = ProcessedLedger(self.storage_backend(), self.ledger_cache, self.ledger_hours)
+        return self.ledger
+
+    def profiler(self): # One profiler per process, created on first use
+        if not self.sampler:
+            self.sampler = Profiler(self.files_dir)
+        return self.sampler
+
+    def maintenance(self): # One maintenance thread per process, created on first use
+        if not self.scheduler:
+            self.scheduler = Maintenance(self.maintenance_minutes * 60, self.maintenance_budget)
+        return self.scheduler
+
+    def traffic_capture(self): # One capture per process if a capture file is set, created on first use, else None
+        if self.capture_file and not self.recorder:
+            self.recorder = TrafficCapture(self.capture_file, self)
+        return self.recorder
+
     def _get_instance_settings(self):
         try:
-            mastodon = Mastodon(access_token = self.xmpp_bridge_token, api_base_url = self.ap_instance, user_agent = self.user_agent)
+            mastodon = self.mastodon_client()
             self.account_locked = mastodon.account_verify_credentials()["locked"]
             self.char_limit = mastodon.instance()["configuration"]["statuses"]["max_characters"]
+            self.probed = True
         except: pass # If we can't fetch data from instance, never mind, fall back to defaults
 
-    def load(self):
+    def load(self, probe=True):
         self.messages, self.language_list = NestedDictBuilder("bridge-messages-keys.txt", self._config_list["translation-dir"]).build()
-        self._get_instance_settings()
+        if probe: self._get_instance_settings()
         for k in (self.help_url, self.ahelp_url):
             for l in self.language_list:
                 if l not in k: k[l] = "https://" + self.ap_instance + "/@" + self.xmpp_bridge_name
 
+    def reload_domains(self): # Read red / green lists again after they were changed
+        self.domains = DomainPolicy(self.dred_file, self.dgreen_file)
+
+    def domain_policy(self): # Current red / green lists, read again only if their files changed
+        if self.domains.stale(): self.reload_domains()
+        return self.domains
+
+    def reload(self): # On SIGHUP: swap in limits, commands, messages and domain lists read again, sessions and storage are kept
+        try:
+            fresh = ConfigLoader(self._config_file)
+            fresh.load(probe=False)
+        except Exception as e: # Keep running with the current configuration
+            LogEvent(">> Error when reloading configuration, keeping the current one", e).log()
+            return
+        snapshot = {k: getattr(fresh, k) for k in self.RELOADABLE}
+        if self.probed: del snapshot["char_limit"] # Instance limit still applies, no need to ask again
+        self.__dict__.update(snapshot) # Single update, handlers created afterwards see either the old or the new values only
+        LogEvent(f">> Configuration reloaded from {self._config_file}: {len(self.language_list)} languages, "
+                 f"{len(self.domains.red)} red listed and {len(self.domains.green)} green listed domains", level=logging.INFO).log()
+
+
+# Red and green lists of domains, read from their files once and again only when the files change
+
+class DomainPolicy:
+
+    def __init__(self, red_file, green_file):
+        self._files = (red_file, green_file)
+        self._mtimes = self._stat()
+        self.red = self._read(red_file)
+        self.green = self._read(green_file)
+
+    def _stat(self):
+        return tuple(os.stat(f).st_mtime_ns if os.path.exists(f) else None for f in self._files)
+
+    def stale(self): # Changed by the other bot process or edited by hand
+        return self._stat() != self._mtimes
+
+    @staticmethod
+    def _read(file_path):
+        if not os.path.exists(file_path): return frozenset()
+        with open(file_path) as f:
+            return frozenset(d for d in (line.split("#", 1)[0].strip() for line in f) if d)
+
+
+###
+# Logging: structured records queued from the handlers and written to file by a background thread
+###
+
+LOGGER = logging.getLogger("xmpp-ap-bridge")
+DIRECTIONS = ("fedi2xmpp", "xmpp2fedi") # Indexed by user_type of the originating user
+DUP_USERS = 100 # Distinct users counted in a report of suppressed records
+
+
+# Suppress identical records (same text, level and error class, whatever the user) repeated within a time window: the
+# count of those suppressed and of the users they were about is reported on the next one, or once the window is over
+# (flush) in a copy of the first record without its user. An outage is then one line per window, not one per recipient
+
+class DuplicateFilter(logging.Filter):
+
+    def __init__(self, window):
+        super().__init__()
+        self._window = window
+        self._seen = {} # Key: [time of the record let through, count suppressed since, that record, users of those suppressed]
+        self._lock = threading.Lock() # Records filtered by the writer thread, flushed by a timer
+        self.handler = None # Where the counts are reported on flush
 
-# Log errors in configured file, except if latter is not defined (no logs)
+    def filter(self, record):
+        if not self._window or getattr(record, "repeated", False): return True
+        key = (record.msg, record.levelno, getattr(record, "error_class", ""))
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen and record.created - seen[0] < self._window:
+                seen[1] += 1
+                user = getattr(record, "user", None)
+                if user and len(seen[3]) < DUP_USERS: seen[3][user] = None
+                return False
+            if seen and seen[1]: record.suppressed, record.users = seen[1], self._users(seen[3])
+            self._seen[key] = [record.created, 0, record, {}]
+            if len(self._seen) > 1000: # Forget keys outside the window so memory stays bounded, once their count is reported
+                self._seen = {k: v for k, v in self._seen.items() if v[1] or record.created - v[0] < self._window}
+        return True
 
-class LogError:
+    @staticmethod
+    def _users(users): # Count of the users (DUP_USERS+ beyond) and the first of them
+        if not users: return None
+        listed = list(users)
+        count = f"{DUP_USERS}+" if len(listed) >= DUP_USERS else str(len(listed))
+        return count + ": " + ", ".join(listed[:5]) + (", ..." if len(listed) > 5 else "")
 
-    def __init__(self, filename, text, error):
-        self.filename = filename
+    def flush(self, now=None): # Report the counts of windows over at now, of all windows without
+        with self._lock:
+            due = [v for v in self._seen.values() if v[1] and (now is None or now - v[0] >= self._window)]
+            reports = [(v[2], v[1], self._users(v[3])) for v in due]
+            for v in due: v[1], v[3] = 0, {}
+        for record, count, users in reports:
+            if self.handler: self.handler.handle(logging.makeLogRecord({**record.__dict__, "created": time.time(), "user": None,
+                                                                        "suppressed": count, "users": users, "repeated": True}))
+
+
+# One line per record: timestamp, level, text, then key="value" structured fields when present
+
+class StructuredFormatter(logging.Formatter):
+
+    FIELDS = ("user", "direction", "error_class", "error", "suppressed", "users")
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(message)s", "%d-%m-%Y %H:%M:%S")
+
+    def format(self, record):
+        fields = []
+        for k in self.FIELDS:
+            v = getattr(record, k, None)
+            if v is not None and v != "": fields.append(k + '="' + str(v).replace('"', "'").replace("\n", " ") + '"')
+        return super().format(record) + (" | " + " ".join(fields) if fields else "")
+
+
+# Configure the process logger once: handlers only enqueue, a listener thread formats, filters and writes with rotation
+
+class LogManager:
+
+    _listener = None
+    _duplicates = None # Filter of the file handler, and event stopping its flush timer
+    _stopped = None
+
+    def __init__(self, config):
+        self._log_file = config.log_file
+        self._log_level = config.log_level
+        self._max_bytes = config.log_max_bytes
+        self._rotate_when = config.log_rotate_when
+        self._backups = config.log_backups
+        self._dup_window = config.log_dup_window
+
+    def _file_handler(self):
+        if self._rotate_when:
+            handler = logging.handlers.TimedRotatingFileHandler(self._log_file, when=self._rotate_when, backupCount=self._backups)
+        else: # maxBytes at 0 never rotates, leaving rotation to an external tool as before
+            handler = logging.handlers.RotatingFileHandler(self._log_file, maxBytes=self._max_bytes, backupCount=self._backups)
+        handler.setFormatter(StructuredFormatter())
+        LogManager._duplicates = DuplicateFilter(self._dup_window)
+        LogManager._duplicates.handler = handler
+        handler.addFilter(LogManager._duplicates)
+        return handler
+
+    @staticmethod
+    def _flush_duplicates(duplicates, window, stopped): # Counts of records suppressed are reported even if none comes again
+        while not stopped.wait(window): duplicates.flush(time.time())
+
+    def start(self):
+        LogManager.stop()
+        LOGGER.handlers.clear()
+        LOGGER.propagate = False
+        if not self._log_file: # No log file configured: no logging at all
+            LOGGER.addHandler(logging.NullHandler())
+            return
+        LOGGER.setLevel(self._log_level.upper())
+        log_queue = queue.SimpleQueue()
+        LOGGER.addHandler(logging.handlers.QueueHandler(log_queue))
+        LogManager._listener = logging.handlers.QueueListener(log_queue, self._file_handler(), respect_handler_level=True)
+        LogManager._listener.start()
+        if self._dup_window:
+            LogManager._stopped = threading.Event()
+            threading.Thread(target=LogManager._flush_duplicates, args=(LogManager._duplicates, self._dup_window, LogManager._stopped),
+                             name="bridge-log-duplicates", daemon=True).start()
+        atexit.register(LogManager.stop)
+
+    @staticmethod
+    def stop(): # Flush pending records and stop the writer thread
+        if LogManager._listener:
+            LogManager._listener.stop()
+            if LogManager._stopped: LogManager._stopped.set()
+            LogManager._duplicates.flush() # Records queued are written, counts pending too
+            for h in LogManager._listener.handlers: h.close()
+            LogManager._listener = None
+
+
+# Log an event with its structured fields, never blocks on file I/O
+
+class LogEvent:
+
+    def __init__(self, text, error=None, user=None, user_type=None, level=logging.ERROR):
         self.text = text
         self.error = error
+        self.user = user
+        self.user_type = user_type
+        self.level = level
 
     def log(self):
-        if self.filename:
-            with open(self.filename, "a") as f:
-                f.write(f"{self.text} on {datetime.now().strftime('%d-%m-%Y %H:%M:%S')} with error content: {self.error}\n")
+        if not LOGGER.isEnabledFor(self.level): return
+        LOGGER.log(self.level, self.text, extra={
+            "user": self.user,
+            "direction": DIRECTIONS[self.user_type] if self.user_type is not None else None,
+            "error_class": type(self.error).__name__ if isinstance(self.error, BaseException) else None,
+            "error": self.error})
+
+
+###
+# Storage: users, blocks, instb, comm, roster and ledger repositories, over SQLite (direct or on a dedicated thread) or in memory
+###
+
+UserRow = namedtuple("UserRow", "type req_user req_date nb_reg lang revoke_date app acc_id")
+BlockRow = namedtuple("BlockRow", "type blocking blocked block_date")
+InstbRow = namedtuple("InstbRow", "type blocked block_date")
+CommRow = namedtuple("CommRow", "type user from_u from_date id_from id_to recv_ms sent_ms seq", defaults=(None, None, None)) # Times in milliseconds, seq: order of insertion (rowid)
+
+REPOSITORIES = ("users", "blocks", "instb", "comm", "roster", "ledger", "counters")
+
+
+def epoch(): # Dates are stored as integer seconds since 1970-01-01 UTC, compared and indexed as such
+    return int(time.time())
+
+
+def day(timestamp): # Local date of a stored date, as shown to users and for daily counters
+    return time.strftime("%F", time.localtime(timestamp))
+
+
+SCHEMA = ("""CREATE TABLE IF NOT EXISTS users(type TINYINT,
+                                         req_user VARCHAR(255),
+                                         req_date INTEGER,
+                                         nb_reg SMALLINT,
+                                         lang CHAR(2),
+                                         revoke_date INTEGER,
+                                         app VARCHAR(63),
+                                         acc_id VARCHAR(63));""",
+          "CREATE INDEX IF NOT EXISTS users_key ON users(type, req_user)", # Lookups by user, see benchmarks/bench_database.py
+          """CREATE TABLE IF NOT EXISTS blocks(type TINYINT,
+                                         blocking VARCHAR(255),
+                                         blocked VARCHAR(255),
+                                         block_date INTEGER);""",
+          "CREATE INDEX IF NOT EXISTS blocks_key ON blocks(type, blocking, blocked)",
+          """CREATE TABLE IF NOT EXISTS instb(type TINYINT,
+                                         blocked VARCHAR(255),
+                                         block_date INTEGER);""",
+          "CREATE INDEX IF NOT EXISTS instb_key ON instb(type, blocked)",
+          """CREATE TABLE IF NOT EXISTS comm(type TINYINT,
+                                         user VARCHAR(255),
+                                         from_u VARCHAR(255),
+                                         from_date INTEGER,
+                                         id_from VARCHAR(127),
+                                         id_to VARCHAR(127));""",
+          "CREATE INDEX IF NOT EXISTS comm_user ON comm(type, user, from_date)", # Conversation lookups, see ConversationIndex
+          "CREATE INDEX IF NOT EXISTS comm_from ON comm(type, from_u, from_date)",
+          "CREATE INDEX IF NOT EXISTS comm_id_to ON comm(type, id_to)",
+          "CREATE INDEX IF NOT EXISTS comm_id_from ON comm(type, id_from)",
+          "CREATE INDEX IF NOT EXISTS comm_date ON comm(type, from_date)", # Retention, see InitBridge
+          """CREATE TABLE IF NOT EXISTS roster(owner VARCHAR(255),
+                                         jid VARCHAR(255),
+                                         state TEXT);""",
+          "CREATE UNIQUE INDEX IF NOT EXISTS roster_jid ON roster(owner, jid)",
+          """CREATE TABLE IF NOT EXISTS roster_version(owner VARCHAR(255),
+                                         ver VARCHAR(255));""",
+          "CREATE UNIQUE INDEX IF NOT EXISTS roster_version_owner ON roster_version(owner)",
+          """CREATE TABLE IF NOT EXISTS ledger(type TINYINT,
+                                         msg_key VARCHAR(255),
+                                         seen_date INTEGER);""",
+          "CREATE UNIQUE INDEX IF NOT EXISTS ledger_key ON ledger(type, msg_key)", # Messages processed, see ProcessedLedger
+          "CREATE INDEX IF NOT EXISTS ledger_date ON ledger(seen_date)",
+          """CREATE TABLE IF NOT EXISTS counters(metric VARCHAR(31),
+                                         type TINYINT,
+                                         dim VARCHAR(255),
+                                         value INTEGER);""",
+          "CREATE UNIQUE INDEX IF NOT EXISTS counters_key ON counters(metric, type, dim)") # Aggregates, see SqliteCounters
+
+# Upgrades of existing databases, statements taking PRAGMA user_version n to n + 1. Version 1: dates written by the
+# sqlite3 datetime adapter (local time text) to epoch integers; columns declared TIMESTAMP keep integers as such.
+# Version 2: receive and delivery times of bridged messages, for delivery latency (empty for messages bridged before)
+
+MIGRATIONS = (tuple(f"UPDATE {table} SET {column} = CAST(strftime('%s', {column}, 'utc') AS INTEGER) WHERE typeof({column}) = 'text'"
+                    for table, column in (("users", "req_date"), ("users", "revoke_date"), ("blocks", "block_date"),
+                                          ("instb", "block_date"), ("comm", "from_date"), ("ledger", "seen_date"))),
+              ("ALTER TABLE comm ADD COLUMN recv_ms INTEGER", "ALTER TABLE comm ADD COLUMN sent_ms INTEGER"))
+
+# Counters kept in the transactions that change the data they aggregate, by metric, user type and dimension:
+# active, registrations and revocations of users (dimension empty), active users by domain, messages bridged by day
+# (type of the sender). A condition on the user row, evaluated in the same write, keeps them exact under concurrency
+
+COUNT = ("INSERT INTO counters(metric, type, dim, value) SELECT ?, ?, ?, ? WHERE {} "
+         "ON CONFLICT(metric, type, dim) DO UPDATE SET value = value + excluded.value")
+ACTIVE_USER = "EXISTS (SELECT 1 FROM users WHERE (type, req_user) = (?, ?) AND revoke_date IS NULL)"
+COUNTERS_BACKFILL = ( # Databases created before counters existed
+    "INSERT OR IGNORE INTO counters SELECT 'active', type, '', COUNT(*) FROM users WHERE revoke_date IS NULL GROUP BY type",
+    "INSERT OR IGNORE INTO counters SELECT 'domain', type, substr(req_user, instr(req_user, '@') + 1), COUNT(*) FROM users WHERE revoke_date IS NULL GROUP BY 2, 3",
+    "INSERT OR IGNORE INTO counters SELECT 'registrations', type, '', SUM(nb_reg) FROM users GROUP BY type",
+    "INSERT OR IGNORE INTO counters SELECT 'revocations', type, '', COUNT(*) FROM users WHERE revoke_date IS NOT NULL GROUP BY type",
+    "INSERT OR IGNORE INTO counters SELECT 'bridged', 1 - type, date(from_date, 'unixepoch', 'localtime'), COUNT(*) FROM comm GROUP BY 2, 3")
+
+
+def counted(metric, user_type, dim="", delta=1, when="1", when_args=()): # Counter update as a (sql, args) pair for SqliteStorage.write
+    return COUNT.format(when), (metric, user_type, dim, delta, *when_args)
+
+
+def user_counts(user_type, user, active): # Counter updates for a user becoming active or not, to run before the change: no-op if already so
+    when, args, delta = ("NOT " if active else "") + ACTIVE_USER, (user_type, user), (-1, 1)[active]
+    return (counted("active", user_type, "", delta, when, args), counted("domain", user_type, user.split("@")[-1], delta, when, args),
+            counted(("revocations", "registrations")[active], user_type, "", 1, when, args))
+
+
+# Expose a storage (or one of its repositories) with every method called through call(method, *args)
+
+class StorageProxy:
+
+    def __init__(self, target, call):
+        self._target = target
+        self._call = call
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        value = StorageProxy(attr, self._call) if name in REPOSITORIES else partial(self._call, attr)
+        setattr(self, name, value) # Resolve each name once
+        return value
+
+
+async def run_inline(method, *args): # Awaitable call for storages which do not block on I/O or run in the caller's thread
+    return method(*args)
+
+
+def mutation(method): # Mark a storage method as a write, so that a group commit storage defers it to the next commit
+    method.mutation = True
+    return method
+
+
+# SQLite repositories, SQL statements only: connection and transactions are handled by SqliteStorage
+
+class SqliteUsers:
+
+    def __init__(self, db):
+        self._db = db
+
+    def get(self, user_type, user):
+        return self._db.fetchone(UserRow, "SELECT * FROM users WHERE (type, req_user) = (?, ?)", (user_type, user))
+
+    def active(self): # Registered users, most recent first
+        return self._db.fetch(UserRow, "SELECT * FROM users WHERE revoke_date IS NULL ORDER BY req_date DESC")
+
+    def revoked(self, user_type, before): # Revoked before a date
+        return self._db.fetch(UserRow, "SELECT * FROM users WHERE type = ? AND revoke_date < ?", (user_type, before))
+
+    def page(self, user_type, after, limit): # Registered users of a type following the address after, in address order
+        return self._db.fetch(UserRow, "SELECT * FROM users WHERE type = ? AND req_user > ? AND revoke_date IS NULL ORDER BY req_user LIMIT ?",
+                              (user_type, after, limit))
+
+    @mutation
+    def save(self, row): # Insert or update the row of (type, req_user)
+        with self._db.transaction() as conn:
+            for sql, args in user_counts(row.type, row.req_user, row.revoke_date is None): conn.execute(sql, args)
+            if not conn.execute("UPDATE users SET req_date = ?, nb_reg = ?, lang = ?, revoke_date = ?, app = ?, acc_id = ? WHERE (type, req_user) = (?, ?)",
+                                (row.req_date, row.nb_reg, row.lang, row.revoke_date, row.app, row.acc_id, row.type, row.req_user)).rowcount:
+                conn.execute("INSERT INTO users(type, req_user, req_date, nb_reg, lang, revoke_date, app, acc_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+
+    @mutation
+    def set_lang(self, user_type, user, lang):
+        self._db.write(("UPDATE users SET lang = ? WHERE (type, req_user) = (?, ?)", (lang, user_type, user)))
+
+
+class SqliteBlocks:
+
+    def __init__(self, db):
+        self._db = db
+
+    def get(self, user_type, blocking, blocked):
+        return self._db.fetchone(BlockRow, "SELECT * FROM blocks WHERE (type, blocking, blocked) = (?, ?, ?)", (user_type, blocking, blocked))
+
+    def of_user(self, user_type, blocking): # Blocklist of a user, most recent first
+        return self._db.fetch(BlockRow, "SELECT * FROM blocks WHERE (type, blocking) = (?, ?) ORDER BY block_date DESC", (user_type, blocking))
+
+    @mutation
+    def add(self, row):
+        self._db.write(("INSERT INTO blocks(type, blocking, blocked, block_date) VALUES (?, ?, ?, ?)", row))
+
+    @mutation
+    def delete(self, user_type, blocking, blocked):
+        self._db.write(("DELETE FROM blocks WHERE (type, blocking, blocked) = (?, ?, ?)", (user_type, blocking, blocked)))
+
+
+class SqliteInstb:
+
+    def __init__(self, db):
+        self._db = db
+
+    def get(self, user_type, blocked):
+        return self._db.fetchone(InstbRow, "SELECT * FROM instb WHERE (type, blocked) = (?, ?)", (user_type, blocked))
+
+    def all(self): # Most recent first
+        return self._db.fetch(InstbRow, "SELECT * FROM instb ORDER BY block_date DESC")
+
+    def of_type(self, user_type):
+        return self._db.fetch(InstbRow, "SELECT * FROM instb WHERE type = ?", (user_type,))
+
+    @mutation
+    def add(self, row):
+        self._db.write(("INSERT INTO instb(type, blocked, block_date) VALUES (?, ?, ?)", row))
+
+    @mutation
+    def delete(self, user_type, blocked):
+        self._db.write(("DELETE FROM instb WHERE (type, blocked) = (?, ?)", (user_type, blocked)))
+
+
+class SqliteComm:
+
+    def __init__(self, db):
+        self._db = db
+
+    @mutation
+    def add(self, row): # Returns its seq
+        with self._db.transaction() as conn:
+            seq = conn.execute("INSERT INTO comm(type, user, from_u, from_date, id_from, id_to, recv_ms, sent_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row[:8]).lastrowid
+            conn.execute(*counted("bridged", 1-row.type, day(row.from_date)))
+        return seq
+
+    def last_to(self, user_type, user, since=0): # Last message received by user, not before since (rowid: latest within a second)
+        return self._db.fetchone(CommRow, "SELECT *, rowid FROM comm WHERE (type, user) = (?, ?) AND from_date >= ? ORDER BY from_date DESC, rowid DESC LIMIT 1",
+                                 (user_type, user, since))
+
+    def recent_from(self, user_type, from_u, limit, since=0): # Last messages sent by from_u, not before since, most recent first
+        return self._db.fetch(CommRow, "SELECT *, rowid FROM comm WHERE (type, from_u) = (?, ?) AND from_date >= ? ORDER BY from_date DESC, rowid DESC LIMIT ?",
+                              (user_type, from_u, since, limit))
+
+    def by_id_to(self, user_type, id_to):
+        return self._db.fetchone(CommRow, "SELECT *, rowid FROM comm WHERE (type, id_to) = (?, ?)", (user_type, id_to))
+
+    def by_id_from(self, user_type, id_from):
+        return self._db.fetch(CommRow, "SELECT *, rowid FROM comm WHERE (type, id_from) = (?, ?)", (user_type, id_from))
+
+    def invalidate(self): pass # Nothing cached
+
+    def latencies(self, user_type, since): # Milliseconds from receipt to delivery of the messages to users of a type bridged since
+        return [r[0] for r in self._db.conn().execute("SELECT sent_ms - recv_ms FROM comm WHERE type = ? AND from_date >= ? AND sent_ms IS NOT NULL",
+                                                      (user_type, since))]
+
+    def oldest_date(self, user_type):
+        row = self._db.conn().execute("SELECT from_date FROM comm WHERE type = ? ORDER BY from_date LIMIT 1", (user_type,)).fetchone()
+        return row[0] if row else None
+
+    @mutation
+    def expire(self, user_type, before):
+        self._db.write(("DELETE FROM comm WHERE type = ? AND from_date < ?", (user_type, before)))
+
+
+class SqliteRoster:
+
+    def __init__(self, db):
+        self._db = db
+
+    def entries(self, owner): # {jid: item state} of the roster of owner
+        return {jid: json.loads(state) for jid, state in self._db.conn().execute("SELECT jid, state FROM roster WHERE owner = ?", (owner,))}
+
+    def version(self, owner):
+        row = self._db.conn().execute("SELECT ver FROM roster_version WHERE owner = ?", (owner,)).fetchone()
+        return row[0] if row else ""
+
+    @mutation
+    def save(self, owner, jid, state):
+        self._db.write(("INSERT OR REPLACE INTO roster(owner, jid, state) VALUES (?, ?, ?)", (owner, jid, json.dumps(state))))
+
+    @mutation
+    def delete(self, owner, jid):
+        self._db.write(("DELETE FROM roster WHERE (owner, jid) = (?, ?)", (owner, jid)))
+
+    @mutation
+    def set_version(self, owner, ver):
+        self._db.write(("INSERT OR REPLACE INTO roster_version(owner, ver) VALUES (?, ?)", (owner, ver)))
+
+
+class SqliteLedger:
+
+    def __init__(self, db):
+        self._db = db
+
+    def seen(self, user_type, msg_key):
+        return self._db.conn().execute("SELECT 1 FROM ledger WHERE (type, msg_key) = (?, ?)", (user_type, msg_key)).fetchone() is not None
+
+    @mutation
+    def add(self, user_type, msg_key, seen_date):
+        self._db.write(("INSERT OR IGNORE INTO ledger(type, msg_key, seen_date) VALUES (?, ?, ?)", (user_type, msg_key, seen_date)))
+
+    @mutation
+    def expire(self, before):
+        self._db.write(("DELETE FROM ledger WHERE seen_date < ?", (before,)))
+
+
+class SqliteCounters:
+
+    def __init__(self, db):
+        self._db = db
+
+    def get(self, metric, user_type, dim=""):
+        row = self._db.conn().execute("SELECT value FROM counters WHERE (metric, type, dim) = (?, ?, ?)", (metric, user_type, dim)).fetchone()
+        return row[0] if row else 0
+
+    def total(self, metric, user_type, since=""): # Sum over dimensions from since, e.g. days of bridged messages
+        return self._db.conn().execute("SELECT COALESCE(SUM(value), 0) FROM counters WHERE (metric, type) = (?, ?) AND dim >= ?",
+                                       (metric, user_type, since)).fetchone()[0]
+
+    def top(self, metric, limit): # Dimensions with the highest values, both user types together
+        return self._db.conn().execute("SELECT dim, SUM(value) FROM counters WHERE metric = ? GROUP BY dim HAVING SUM(value) > 0 "
+                                       "ORDER BY 2 DESC, dim LIMIT ?", (metric, limit)).fetchall()
+
+    @mutation
+    def count(self, metric, user_type, dim="", delta=1): # Counter of its own, not maintained with the data (e.g. events shed)
+        self._db.write(counted(metric, user_type, dim, delta))
+
+    @mutation
+    def backfill(self): # Only once, while there is no counter yet
+        with self._db.transaction() as conn:
+            if not conn.execute("SELECT 1 FROM counters LIMIT 1").fetchone():
+                for sql in COUNTERS_BACKFILL: conn.execute(sql)
+
+
+# Conversation index in front of the comm repository: latest message received and last messages sent by each user,
+# and id_from / id_to mappings, in bounded LRU maps so that reply and resend resolution rarely reaches the table.
+# Entries are updated with each new row when the result stays exact, and all dropped whenever another connection
+# committed (PRAGMA data_version, e.g. the other bot, checked at most once per interval so that hits stay in memory) or
+# rows were deleted. A result read from the table is only cached if the index did not change meanwhile (generation), as
+# it may predate a row added by another thread
+
+CONVERSATION_CHECK = 1.0 # Seconds between checks for commits of other connections
+
+
+class ConversationIndex:
+
+    def __init__(self, comm, db, size):
+        self._comm = comm
+        self._db = db
+        self._size = size
+        self._lock = threading.Lock()
+        self._last_in = OrderedDict() # (type, user): latest row or None
+        self._last_out = OrderedDict() # (type, from_u): (limit fetched, latest rows)
+        self._by_id_to = OrderedDict() # (type, id_to): first row or None
+        self._by_id_from = OrderedDict() # (type, id_from): rows
+        self._generation = 0 # Increased with each change of the index
+        self._check_at = 0 # Next check for commits of other connections
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, lru, key):
+        now = time.monotonic()
+        if now >= self._check_at: # Rows committed elsewhere are seen within the interval
+            self._check_at = now + CONVERSATION_CHECK
+            if self._db.changed_elsewhere(): self.invalidate()
+        with self._lock:
+            if key in lru:
+                lru.move_to_end(key)
+                self.hits += 1
+                return True, lru[key], self._generation
+            self.misses += 1
+            return False, None, self._generation
+
+    def _store(self, lru, key, value): # Caller holds the lock
+        lru[key] = value
+        lru.move_to_end(key)
+        if len(lru) > self._size: lru.popitem(last=False)
+
+    def _put(self, lru, key, value, generation): # Value read from the table when the index was at this generation
+        with self._lock:
+            if generation == self._generation: self._store(lru, key, value)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            for lru in (self._last_in, self._last_out, self._by_id_to, self._by_id_from): lru.clear()
+
+    @mutation
+    def add(self, row):
+        row = row._replace(seq=self._comm.add(row))
+        with self._lock: # The new row is the latest received by its user, and the first one for its id_to (generated on send)
+            self._generation += 1
+            self._store(self._last_in, (row.type, row.user), row)
+            if self._by_id_to.get((row.type, row.id_to)) is None: self._store(self._by_id_to, (row.type, row.id_to), row)
+            if (row.type, row.id_from) in self._by_id_from: # Other lists are only extended if already cached, else unknown
+                rows = self._by_id_from[(row.type, row.id_from)] # Read by another thread after the insert, it may have the row
+                self._store(self._by_id_from, (row.type, row.id_from), rows if row in rows else rows + [row])
+            if (row.type, row.from_u) in self._last_out:
+                limit, rows = self._last_out[(row.type, row.from_u)]
+                self._store(self._last_out, (row.type, row.from_u), (limit, ([row] + [r for r in rows if r != row])[:limit]))
+
+    def last_to(self, user_type, user, since=0): # Latest rows are cached regardless of since, and filtered on the way out
+        hit, row, gen = self._get(self._last_in, (user_type, user))
+        if not hit: row = self._put(self._last_in, (user_type, user), self._comm.last_to(user_type, user), gen)
+        return row if row and row.from_date >= since else None
+
+    def recent_from(self, user_type, from_u, limit, since=0):
+        hit, value, gen = self._get(self._last_out, (user_type, from_u))
+        if hit and (limit <= value[0] or len(value[1]) < value[0]): rows = value[1][:limit] # All rows are cached if fewer than fetched
+        else: rows = self._put(self._last_out, (user_type, from_u), (limit, self._comm.recent_from(user_type, from_u, limit)), gen)[1]
+        return [r for r in rows if r.from_date >= since]
+
+    def by_id_to(self, user_type, id_to):
+        hit, row, gen = self._get(self._by_id_to, (user_type, id_to))
+        return row if hit else self._put(self._by_id_to, (user_type, id_to), self._comm.by_id_to(user_type, id_to), gen)
+
+    def by_id_from(self, user_type, id_from):
+        hit, rows, gen = self._get(self._by_id_from, (user_type, id_from))
+        return list(rows) if hit else list(self._put(self._by_id_from, (user_type, id_from), self._comm.by_id_from(user_type, id_from), gen))
+
+    def latencies(self, user_type, since):
+        return self._comm.latencies(user_type, since)
+
+    def oldest_date(self, user_type):
+        return self._comm.oldest_date(user_type)
+
+    @mutation
+    def expire(self, user_type, before):
+        self._comm.expire(user_type, before)
+        self.invalidate()
+
+
+# Synchronous SQLite storage: one connection per thread, each write committed on its own
+
+class SqliteStorage:
+
+    def __init__(self, database_file, group_commit=False, cache_size=10000):
+        self._database_file = database_file
+        self._group_commit = group_commit # Writes left in an open transaction, committed by the caller with commit()
+        self._local = threading.local()
+        self.users = SqliteUsers(self)
+        self.blocks = SqliteBlocks(self)
+        self.instb = SqliteInstb(self)
+        self.comm = ConversationIndex(SqliteComm(self), self, cache_size) if cache_size else SqliteComm(self)
+        self.roster = SqliteRoster(self)
+        self.ledger = SqliteLedger(self)
+        self.counters = SqliteCounters(self)
+        self.aio = StorageProxy(self, run_inline)
+
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if not conn:
+            conn = self._local.conn = sqlite3.connect(self._database_file) # Dates are integers, no type detection
+        return conn
+
+    def changed_elsewhere(self): # True if another connection committed since the last call from this thread (or first call)
+        version = self.conn().execute("PRAGMA data_version").fetchone()[0]
+        changed = getattr(self._local, "version", None) != version
+        self._local.version = version
+        return changed
+
+    def fetch(self, row, sql, args=()):
+        return [row._make(r) for r in self.conn().execute(sql, args)]
+
+    def fetchone(self, row, sql, args=()):
+        r = self.conn().execute(sql, args).fetchone()
+        return row._make(r) if r else None
+
+    @contextmanager
+    def transaction(self, immediate=False): # All or nothing: a transaction of its own, or a savepoint within the open group commit
+        conn = self.conn()
+        if not self._group_commit:
+            with conn: yield conn
+            return
+        if not conn.in_transaction: conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        conn.execute("SAVEPOINT write")
+        try: yield conn
+        except BaseException:
+            conn.execute("ROLLBACK TO write")
+            raise
+        finally: conn.execute("RELEASE write")
+
+    def write(self, *statements): # (sql, args) pairs, in one transaction
+        with self.transaction() as conn:
+            for sql, args in statements: conn.execute(sql, args)
+
+    def commit(self):
+        self.conn().commit()
+
+    def rollback(self):
+        self.conn().rollback()
+
+    def flush(self): pass # Every write is already committed, or committed by the caller in group commit mode
+
+    @mutation
+    def create_schema(self):
+        with self.transaction(immediate=True) as conn: # Write lock first, waited for while the other bot starts, else both fail to upgrade
+            for sql in SCHEMA: conn.execute(sql)
+            for statements in MIGRATIONS[conn.execute("PRAGMA user_version").fetchone()[0]:]:
+                for sql in statements: conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        self.counters.backfill()
+
+    @mutation
+    def revoke_user(self, user_type, user, revoke_date): # Revoke registration, forget blocklist and communications
+        self.write(*user_counts(user_type, user, False),
+                   ("UPDATE users SET revoke_date = ? WHERE (type, req_user) = (?, ?)", (revoke_date, user_type, user)),
+                   ("DELETE FROM blocks WHERE (type, blocking) = (?, ?)", (user_type, user)),
+                   ("DELETE FROM comm WHERE (type, user) = (?, ?)", (user_type, user)),
+                   ("DELETE FROM comm WHERE (type, from_u) = (?, ?)", (1-user_type, user)))
+        self.comm.invalidate()
+
+    @mutation
+    def purge_user(self, user_type, user): # Delete all data regarding user
+        self.write(*user_counts(user_type, user, False)[:2], # Still active: no longer counted, but not a revocation
+                   ("DELETE FROM users WHERE (type, req_user) = (?, ?)", (user_type, user)),
+                   ("DELETE FROM blocks WHERE (type, blocking) = (?, ?)", (user_type, user)),
+                   ("DELETE FROM comm WHERE (type, user) = (?, ?)", (user_type, user)),
+                   ("DELETE FROM comm WHERE (type, from_u) = (?, ?)", (1-user_type, user)))
+        self.comm.invalidate()
+
+    def close(self): # Close the connection of the calling thread
+        conn = getattr(self._local, "conn", None)
+        if conn: conn.close()
+        self._local.conn = None
+
+
+# SQLite storage running every call in order on a dedicated DB thread, with group commit: writes are applied at once
+# within an open transaction (so later reads see them) and committed in batches, after commit_delay seconds or
+# max_batch writes, sharing one fsync. Plain calls to writes do not wait (write-behind), storage.aio calls to writes
+# and flush() return once committed; reads always return their result
+
+class AsyncSqliteStorage:
+
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, database_file, commit_delay=0.01, max_batch=100, cache_size=10000):
+        self._storage = SqliteStorage(database_file, group_commit=True, cache_size=cache_size)
+        self._commit_delay = commit_delay
+        self._max_batch = max(max_batch, 1)
+        self._queue = queue.SimpleQueue()
+        for name in REPOSITORIES: setattr(self, name, StorageProxy(getattr(self._storage, name), self._call))
+        self.aio = StorageProxy(self._storage, self._call_async)
+        self._thread = threading.Thread(target=self._run, name="bridge-db", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _submit(self, method, *args):
+        future = Future()
+        self._queue.put((method, args, future))
+        return future
+
+    def _call(self, method, *args):
+        future = self._submit(method, *args)
+        if not getattr(method, "mutation", False): return future.result()
+
+    async def _call_async(self, method, *args):
+        return await asyncio.wrap_future(self._submit(method, *args))
+
+    def _commit(self, pending): # Returns the error if the writes were rolled back
+        if not pending: return None
+        error = None
+        try:
+            self._storage.commit()
+            for future, result in pending: future.set_result(result)
+        except Exception as e:
+            self._storage.rollback()
+            LogEvent(">> Error in committing writes to database", e).log()
+            for future, result in pending: future.set_exception(e)
+            error = e
+        pending.clear()
+        return error
+
+    def _run(self):
+        pending = [] # (future, result) of writes applied but not committed yet
+        deadline = None
+        failed = None # Error of a commit since the last flush, reported to it
+        while True:
+            if pending and time.monotonic() >= deadline: # Also under steady load, when the queue is never empty
+                failed = self._commit(pending) or failed
+            try: method, args, future = self._queue.get(timeout=max(deadline - time.monotonic(), 0) if pending else None)
+            except queue.Empty: # Commit delay elapsed
+                failed = self._commit(pending) or failed
+                continue
+            if method is self._FLUSH or method is self._STOP:
+                error = self._commit(pending) or failed
+                failed = None
+                if method is self._STOP: self._storage.close()
+                if error and method is self._FLUSH: future.set_exception(error) # Writes rolled back must not be confirmed
+                else: future.set_result(None)
+                if method is self._STOP: return
+                continue
+            mutating = getattr(method, "mutation", False)
+            try: result = method(*args)
+            except Exception as e:
+                if mutating: # Plain callers do not wait for the result, the next flush reports the error
+                    LogEvent(">> Error in writing to database", e).log()
+                    failed = failed or e
+                future.set_exception(e)
+                continue
+            if not mutating:
+                future.set_result(result)
+                continue
+            if not pending: deadline = time.monotonic() + self._commit_delay
+            pending.append((future, result))
+            if len(pending) >= self._max_batch: failed = self._commit(pending) or failed
+
+    def create_schema(self): return self._submit(self._storage.create_schema).result() # Startup must not go on with a failed migration
+    def revoke_user(self, *args): return self._call(self._storage.revoke_user, *args)
+    def purge_user(self, *args): return self._call(self._storage.purge_user, *args)
+
+    def flush(self): # Wait until all writes submitted so far are committed
+        if self._thread.is_alive(): self._submit(self._FLUSH).result()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._submit(self._STOP).result()
+            self._thread.join()
+
+
+# In-memory repositories for benchmarks: nothing written to disk, nothing shared between processes
+
+class MemoryTable:
+
+    def __init__(self, db, name):
+        self._db = db
+        self._rows = db.tables[name]
+
+    def _select(self, where, order=None, limit=None):
+        with self._db.lock:
+            rows = [r for r in self._rows if where(r)]
+        if order: rows.sort(key=order, reverse=True) # Rows are kept newest first, and the sort keeps that order among equal keys
+        return rows[:limit] if limit is not None else rows
+
+    def _first(self, where, order=None):
+        rows = self._select(where, order, 1)
+        return rows[0] if rows else None
+
+    def _delete(self, where):
+        with self._db.lock:
+            self._rows[:] = [r for r in self._rows if not where(r)]
+
+    def add(self, row):
+        with self._db.lock:
+            self._rows.insert(0, row)
+
+
+class MemoryUsers(MemoryTable):
+
+    def __init__(self, db):
+        super().__init__(db, "users")
+
+    def get(self, user_type, user):
+        return self._first(lambda r: (r.type, r.req_user) == (user_type, user))
+
+    def active(self):
+        return self._select(lambda r: r.revoke_date is None, lambda r: r.req_date or 0)
+
+    def revoked(self, user_type, before):
+        return self._select(lambda r: r.type == user_type and r.revoke_date is not None and r.revoke_date < before)
+
+    def page(self, user_type, after, limit):
+        rows = sorted(self._select(lambda r: r.type == user_type and r.req_user > after and r.revoke_date is None), key=lambda r: r.req_user)
+        return rows[:limit]
+
+    def save(self, row):
+        with self._db.lock:
+            self._db.counters.user(row.type, row.req_user, self.get(row.type, row.req_user), row.revoke_date is None)
+            self._delete(lambda r: (r.type, r.req_user) == (row.type, row.req_user))
+            self.add(row)
+
+    def set_lang(self, user_type, user, lang):
+        with self._db.lock:
+            entry = self.get(user_type, user)
+            if entry: self.save(entry._replace(lang=lang))
+
+
+class MemoryBlocks(MemoryTable):
+
+    def __init__(self, db):
+        super().__init__(db, "blocks")
+
+    def get(self, user_type, blocking, blocked):
+        return self._first(lambda r: (r.type, r.blocking, r.blocked) == (user_type, blocking, blocked))
+
+    def of_user(self, user_type, blocking):
+        return self._select(lambda r: (r.type, r.blocking) == (user_type, blocking), lambda r: r.block_date)
+
+    def delete(self, user_type, blocking, blocked):
+        self._delete(lambda r: (r.type, r.blocking, r.blocked) == (user_type, blocking, blocked))
+
+
+class MemoryInstb(MemoryTable):
+
+    def __init__(self, db):
+        super().__init__(db, "instb")
+
+    def get(self, user_type, blocked):
+        return self._first(lambda r: (r.type, r.blocked) == (user_type, blocked))
+
+    def all(self):
+        return self._select(lambda r: True, lambda r: r.block_date)
+
+    def of_type(self, user_type):
+        return self._select(lambda r: r.type == user_type)
+
+    def delete(self, user_type, blocked):
+        self._delete(lambda r: (r.type, r.blocked) == (user_type, blocked))
+
+
+class MemoryComm(MemoryTable):
+
+    def __init__(self, db):
+        super().__init__(db, "comm")
+        self._seq = 0
+
+    def add(self, row):
+        with self._db.lock:
+            self._seq += 1
+            super().add(row._replace(seq=self._seq))
+            self._db.counters.count("bridged", 1-row.type, day(row.from_date))
+            return self._seq
+
+    def last_to(self, user_type, user, since=0):
+        return self._first(lambda r: (r.type, r.user) == (user_type, user) and r.from_date >= since, lambda r: r.from_date)
+
+    def recent_from(self, user_type, from_u, limit, since=0):
+        return self._select(lambda r: (r.type, r.from_u) == (user_type, from_u) and r.from_date >= since, lambda r: r.from_date, limit)
+
+    def by_id_to(self, user_type, id_to):
+        return self._first(lambda r: (r.type, r.id_to) == (user_type, id_to))
+
+    def by_id_from(self, user_type, id_from):
+        return self._select(lambda r: (r.type, r.id_from) == (user_type, id_from))
+
+    def latencies(self, user_type, since):
+        return [r.sent_ms - r.recv_ms for r in self._select(lambda r: r.type == user_type and r.from_date >= since and r.sent_ms is not None)]
+
+    def oldest_date(self, user_type):
+        dates = [r.from_date for r in self._select(lambda r: r.type == user_type)]
+        return min(dates) if dates else None
+
+    def expire(self, user_type, before):
+        self._delete(lambda r: r.type == user_type and r.from_date < before)
+
+
+class MemoryRoster:
+
+    def __init__(self, db):
+        self._db = db
+        self._items = {} # Owner: {jid: item state}
+        self._versions = {}
+
+    def entries(self, owner):
+        with self._db.lock:
+            return dict(self._items.get(owner, {}))
+
+    def version(self, owner):
+        return self._versions.get(owner, "")
+
+    def save(self, owner, jid, state):
+        with self._db.lock:
+            self._items.setdefault(owner, {})[jid] = dict(state)
+
+    def delete(self, owner, jid):
+        with self._db.lock:
+            self._items.get(owner, {}).pop(jid, None)
+
+    def set_version(self, owner, ver):
+        self._versions[owner] = ver
+
+
+class MemoryLedger:
+
+    def __init__(self, db):
+        self._db = db
+        self._seen = {} # (type, msg_key): seen_date
+
+    def seen(self, user_type, msg_key):
+        return (user_type, msg_key) in self._seen
+
+    def add(self, user_type, msg_key, seen_date):
+        with self._db.lock:
+            self._seen.setdefault((user_type, msg_key), seen_date)
+
+    def expire(self, before):
+        with self._db.lock:
+            self._seen = {k: d for k, d in self._seen.items() if d >= before}
+
+
+class MemoryCounters:
+
+    def __init__(self, db):
+        self._db = db
+        self._values = {} # (metric, type, dim): value
+
+    def count(self, metric, user_type, dim="", delta=1):
+        with self._db.lock:
+            self._values[(metric, user_type, dim)] = self._values.get((metric, user_type, dim), 0) + delta
+
+    def user(self, user_type, user, entry, active, revocation=True): # Same rules as user_counts(), from the row before the change
+        if bool(entry and not entry.revoke_date) == active: return
+        delta = (-1, 1)[active]
+        self.count("active", user_type, "", delta)
+        self.count("domain", user_type, user.split("@")[-1], delta)
+        if revocation or active: self.count(("revocations", "registrations")[active], user_type)
+
+    def get(self, metric, user_type, dim=""):
+        return self._values.get((metric, user_type, dim), 0)
+
+    def total(self, metric, user_type, since=""):
+        with self._db.lock:
+            return sum(v for (m, t, d), v in self._values.items() if (m, t) == (metric, user_type) and d >= since)
+
+    def top(self, metric, limit):
+        sums = {}
+        with self._db.lock:
+            for (m, t, d), v in self._values.items():
+                if m == metric: sums[d] = sums.get(d, 0) + v
+        return sorted(((d, v) for d, v in sums.items() if v > 0), key=lambda x: (-x[1], x[0]))[:limit]
+
+    def backfill(self): pass
+
+
+class MemoryStorage:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tables = {name: [] for name in REPOSITORIES}
+        self.users = MemoryUsers(self)
+        self.blocks = MemoryBlocks(self)
+        self.instb = MemoryInstb(self)
+        self.comm = MemoryComm(self)
+        self.roster = MemoryRoster(self)
+        self.ledger = MemoryLedger(self)
+        self.counters = MemoryCounters(self)
+        self.aio = StorageProxy(self, run_inline)
+
+    def create_schema(self): pass
+
+    def flush(self): pass
+
+    def revoke_user(self, user_type, user, revoke_date):
+        with self.lock:
+            entry = self.users.get(user_type, user)
+            if entry: self.users.save(entry._replace(revoke_date=revoke_date))
+            self._forget(user_type, user)
+
+    def purge_user(self, user_type, user):
+        with self.lock:
+            self.counters.user(user_type, user, self.users.get(user_type, user), False, revocation=False)
+            self.users._delete(lambda r: (r.type, r.req_user) == (user_type, user))
+            self._forget(user_type, user)
+
+    def _forget(self, user_type, user):
+        self.blocks._delete(lambda r: (r.type, r.blocking) == (user_type, user))
+        self.comm._delete(lambda r: (r.type, r.user) == (user_type, user) or (r.type, r.from_u) == (1-user_type, user))
+
+    def close(self): pass
+
+
+###
+# Mastodon API calls: rate limit aware scheduling, replies and bridged messages first
+###
+
+FOREGROUND, BACKGROUND = 0, 1
+MASTODON_PRIORITY = ContextVar("mastodon_priority", default=FOREGROUND)
+
+
+@contextmanager
+def background_calls(): # Mastodon calls made within are background work (vetting, purges), served after the others
+    token = MASTODON_PRIORITY.set(BACKGROUND)
+    try: yield
+    finally: MASTODON_PRIORITY.reset(token)
+
+
+# Proxy to the Mastodon client, pacing calls from the X-RateLimit-* headers tracked by Mastodon.py: while the remaining
+# budget of the window is above the reserve, calls go straight through; below it, background calls wait for the next
+# window and foreground calls are spaced evenly over what remains of the window, instead of exhausting it and failing
+
+class MastodonScheduler:
+
+    def __init__(self, client, reserve):
+        self._client = client
+        self._reserve = reserve # Fraction of the window budget kept for foreground calls
+        self._lock = threading.Lock()
+        self._next_call = 0.0 # Earliest time of the next foreground call when spaced
+        self.waits = [0, 0] # Number of delayed calls per priority
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name.startswith("stream_"): return attr # Streaming is not counted in the budget
+        def call(*args, **kwargs):
+            self._wait(MASTODON_PRIORITY.get())
+            return attr(*args, **kwargs)
+        return call
+
+    def _delay(self, priority):
+        now = time.time()
+        reset = self._client.ratelimit_reset
+        if reset <= now: return 0 # New window, budget not known to be short
+        remaining = self._client.ratelimit_remaining
+        if remaining > self._reserve * self._client.ratelimit_limit: return 0
+        if priority == BACKGROUND or remaining <= 0: return reset - now
+        slot = max(now, self._next_call)
+        self._next_call = slot + (reset - now) / remaining
+        return slot - now
+
+    def _wait(self, priority):
+        with self._lock:
+            delay = self._delay(priority)
+        if delay > 0:
+            try: asyncio.get_running_loop()
+            except RuntimeError: pass
+            else: # Never sleep on an event loop (the XMPP session would stall): handlers make their calls from worker threads
+                LogEvent(">> Mastodon rate limit budget low, API call made from an event loop not delayed", f"{delay:.1f} seconds", level=logging.WARNING).log()
+                return
+            self.waits[priority] += 1
+            LogEvent(">> Mastodon rate limit budget low, delaying API call", f"{delay:.1f} seconds", level=logging.DEBUG).log()
+            time.sleep(delay)
+
+
+###
+# Connection recovery: reconnection delays and position in the Mastodon notifications
+###
+
+# Exponential backoff with full jitter: random delay up to base * 2^attempt seconds, capped, so that bots losing their
+# server together do not reconnect in step
+
+class Backoff:
+
+    def __init__(self, base, cap):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next(self):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** min(self.attempt, 16)))
+        self.attempt += 1
+        return delay
+
+    def reset(self): # Call once a connection has proved stable
+        self.attempt = 0
+
+
+# Id of the last Mastodon notification processed, kept in a file so that notifications received while the stream was
+# down (or the bot stopped) can be fetched on reconnection. Ids are compared by length then text, which orders the
+# numeric ids of Mastodon as well as the fixed length sortable ids of other servers. Notifications are processed out of
+# order by the lanes: the id saved is the newest below all those still in flight, so that the ones queued or running
+# when the bot stops are fetched again (the processed ledger drops those which were already sent)
+
+class NotificationCursor:
+
+    def __init__(self, cursor_file):
+        self._file = cursor_file
+        self.last_id = None # Saved
+        try:
+            with open(cursor_file) as f:
+                self.last_id = f.read().strip() or None
+        except FileNotFoundError: pass
+        self.latest_id = self.last_id # Newest taken in charge
+        self._running = set() # In flight
+        self._finished = [] # Done, not saved until older ones in flight are done
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(notification_id):
+        notification_id = str(notification_id)
+        return (len(notification_id), notification_id)
+
+    def seen(self, notification_id):
+        return self.latest_id is not None and self.key(notification_id) <= self.key(self.latest_id)
+
+    def start(self, notification_id): # Taken in charge, False if it already was
+        with self._lock:
+            if self.seen(notification_id): return False
+            self.latest_id = str(notification_id)
+            self._running.add(self.latest_id)
+            return True
+
+    def done(self, notification_id):
+        with self._lock:
+            self._running.discard(str(notification_id))
+            self._finished.append(str(notification_id))
+            oldest = min(self._running, key=self.key) if self._running else None
+            ready = [i for i in self._finished if oldest is None or self.key(i) < self.key(oldest)]
+            if not ready: return
+            self._finished = [i for i in self._finished if i not in ready]
+            self._write(max(ready, key=self.key))
+
+    def save(self, notification_id): # Nothing in flight before it, as for the starting point
+        if self.start(notification_id): self.done(notification_id)
+
+    def _write(self, notification_id):
+        if self.last_id is not None and self.key(notification_id) <= self.key(self.last_id): return
+        self.last_id = notification_id
+        with open(self._file + ".tmp", "w") as f: # Replace at once, a crash never leaves a truncated id
+            f.write(self.last_id)
+        os.replace(self._file + ".tmp", self._file)
+
+
+###
+# Profiling of the running bot, on demand from an admin command
+###
+
+# Sample the stacks of all threads (the XMPP event loop, the Mastodon stream, the database thread) every interval and
+# trace memory allocations during a time box, on a thread of its own. The full result is written to the files directory
+# as collapsed stacks (one "frame;frame;frame count" line each, for flame graph tools) and allocation growth by line
+
+class Profiler:
+
+    def __init__(self, files_dir, top=5):
+        self._files_dir = files_dir
+        self._top = top
+        self._thread = None
+        self.until = 0
+        self.result = None # (seconds, samples, file, hot functions, memory growth) of the last profile, until reported
+        self._report = None # Called with the result once finished, True if it reached whoever asked for it
+
+    def running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def start(self, seconds, interval, report=None):
+        if self.running(): return False
+        self.result = None
+        self._report = report
+        self.until = time.monotonic() + seconds
+        self._thread = threading.Thread(target=self._run, args=(seconds, interval), name="bridge-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self, seconds, interval):
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        stacks, leaves, samples = Counter(), Counter(), 0
+        traced = not tracemalloc.is_tracing()
+        if traced: tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        while time.monotonic() < self.until:
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                leaves[f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"] += 1
+                stack = []
+                while frame:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                stacks[";".join([names.get(ident, str(ident))] + stack[::-1])] += 1
+            samples += 1
+            time.sleep(interval)
+        growth = [d for d in tracemalloc.take_snapshot().compare_to(before, "lineno") if d.size_diff > 0]
+        if traced: tracemalloc.stop()
+        path = os.path.join(self._files_dir, f"xmpp-bridge-profile-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.txt")
+        try:
+            with open(path, "w") as f:
+                f.write(f"# {seconds} seconds, {samples} samples of all threads every {interval * 1000:g} ms\n# Collapsed stacks\n")
+                f.writelines(f"{k} {v}\n" for k, v in stacks.most_common())
+                f.write("# Memory allocated during the profile, by line\n")
+                f.writelines(f"{d}\n" for d in growth[:100])
+        except OSError as e:
+            LogEvent(">> Error in writing profile", e).log()
+            path = "-"
+        hot = ", ".join(f"{k} ({v * 100 // max(samples, 1)}%)" for k, v in leaves.most_common(self._top))
+        memory = ", ".join(f"{d.traceback[0].filename.rsplit('/', 1)[-1]}:{d.traceback[0].lineno} (+{d.size_diff / 1024:.0f} KiB)" for d in growth[:self._top])
+        result = (seconds, samples, path, hot or "-", memory or "-")
+        LogEvent(f">> Profile of {seconds} seconds written to {path}", level=logging.INFO).log()
+        if not (self._report and self._report(result)): self.result = result # Else kept for the next profile command
+
+
+###
+# Maintenance of the running bots: retention, domain checks and instance settings, on a background thread
+###
+
+# Jobs are generators yielding once per unit of work (a user checked or purged, an hour of messages deleted), with
+# whether it changed anything. A run goes by slices of at most the time budget, resumed where it stopped after a pause,
+# so that maintenance never holds the database or the Mastodon rate limit for long; the job is due again an interval
+# after the run started. Each run is logged with its duration and outcome
+
+class Maintenance:
+
+    START_DELAY = 60 # Seconds before the first runs, once the bots are connected
+    PAUSE = 1 # Seconds between two slices of a run
+
+    def __init__(self, interval, budget):
+        self._interval = interval # Seconds, 0 to run each job only once after start
+        self._budget = budget
+        self._jobs = {} # Name: job function, next run (monotonic time) and state of the current run
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._once = 0
+
+    def add(self, name, job): # Once per name, as jobs of the whole process (e.g. instance settings) are added by each bot
+        with self._lock:
+            self._jobs.setdefault(name, {"job": job, "due": time.monotonic() + self.START_DELAY, "run": None})
+
+    def once(self, name, job): # Run a job now and only once (e.g. the purge after an import), numbered as it may be asked again
+        with self._lock:
+            self._once += 1
+            self._jobs[f"{name} #{self._once}"] = {"job": job, "due": time.monotonic(), "run": None, "once": True}
+        self._wake.set()
+
+    def start(self):
+        if self._thread: return
+        self._thread = threading.Thread(target=self._run, name="bridge-maintenance", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        with background_calls(): # Mastodon calls wait for rate limit budget after replies and bridged messages
+            while True:
+                with self._lock: jobs = list(self._jobs.items())
+                for name, state in jobs:
+                    if state["due"] <= time.monotonic(): self._slice(name, state)
+                with self._lock: due = min((state["due"] for state in self._jobs.values()), default=float("inf"))
+                self._wake.wait(min(max(due - time.monotonic(), 0), self.START_DELAY)) # Wake up now and then for jobs added meanwhile
+                self._wake.clear()
+
+    def _slice(self, name, state):
+        if not state["run"]: state.update(run=state["job"](), started=time.monotonic(), busy=0, units=0, changes=0, slices=0)
+        start = time.monotonic()
+        error = None
+        try:
+            for changed in state["run"]:
+                state["units"] += 1
+                state["changes"] += bool(changed)
+                if time.monotonic() - start >= self._budget: break
+            else: state["run"] = None # Run complete
+        except Exception as e:
+            state["run"], error = None, e
+        state["busy"] += time.monotonic() - start
+        state["slices"] += 1
+        if state["run"]:
+            state["due"] = time.monotonic() + self.PAUSE
+            return
+        state["due"] = state["started"] + self._interval if self._interval and not state.get("once") else float("inf")
+        if state.get("once"):
+            with self._lock: del self._jobs[name]
+        if error: LogEvent(f">> Error in maintenance job {name}", error).log()
+        else: LogEvent(f">> Maintenance job {name}: {state['units']} checked, {state['changes']} changed in {state['busy'] * 1000:.0f} ms, "
+                       f"{state['slices']} slices over {time.monotonic() - state['started']:.0f} seconds", level=logging.INFO).log()
+
+
+###
+# Admission control of inbound events, by priority lane
+###
+
+# Each inbound event is classified into a lane: admin (anything from an admin), command, message (to bridge) and
+# registration. Each lane has its own bounded queue and workers, threads for the Mastodon bot and tasks on the event loop
+# for the XMPP bot, so that a follow storm or a spam wave fills its own lane without delaying admin commands or replies.
+# The tasks of the XMPP bot run their blocking work on threads of their lane, so lanes also run side by side there.
+# An event which finds its lane queue full is shed: the counter of shed events of its lane is increased, and the sender
+# is told the bridge is busy, at most once per interval, by a worker of its own whose queue drops replies beyond its
+# limit. So a flood of shed events costs neither the stream nor the Mastodon budget of replies to the events admitted
+
+LANES = ("admin", "command", "message", "registration") # By priority
+LANE_WORKERS = {"admin": 1, "command": 1, "message": 1, "registration": 1} # One worker keeps the order of each lane
+LANE_QUEUE = {"admin": 0, "command": 100, "message": 500, "registration": 50} # Events waiting, 0 for no limit
+BUSY_INTERVAL = 600 # Seconds during which a sender of events shed is told only once that the bridge is busy
+BUSY_QUEUE = 50 # Busy replies waiting to be sent, further ones dropped
+BUSY_SENDERS = 10000 # Senders remembered as told, expired ones forgotten beyond that
+
+
+def inbound_lane(config, user_type, user_from, content=None): # Lane of an inbound event, registration when without content
+    if content is None: return "registration"
+    if user_from in (config.ap_admin, config.xmpp_admin)[user_type]: return "admin"
+    return "command" if re.search(r'(?:^|[\s>])' + re.escape(config.pfix[2]) + r'[a-zA-Z]', content) else "message" # Also in HTML
+
+
+class Admission:
+
+    def __init__(self, config, user_type, loop=None):
+        self._storage = config.storage_backend()
+        self._user_type = user_type
+        self._loop = loop # Workers are tasks of this event loop, threads without one
+        self._queues = {}
+        self._executors = {} # Threads of each lane for the blocking work of tasks
+        self._told = {} # Sender: time until which it is not told again that the bridge is busy
+        self._shed = {} # Lane: events shed not counted in storage yet, written by the busy worker
+        self._counting = False # Write of those queued
+        self._lock = threading.Lock()
+        for lane, workers, limit in [(lane, config.lane_workers[lane], config.lane_queue[lane]) for lane in LANES] + [("busy", 1, BUSY_QUEUE)]:
+            self._queues[lane] = (asyncio.Queue if loop else queue.Queue)(limit)
+            if loop: self._executors[lane] = ThreadPoolExecutor(workers, thread_name_prefix=f"bridge-{lane}")
+            for n in range(workers):
+                if loop: loop.create_task(self._work_async(lane))
+                else: threading.Thread(target=self._work, args=(lane,), name=f"bridge-{lane}-{n}", daemon=True).start()
+
+    def submit(self, lane, job, wait=False): # Queue a job (a coroutine function with a loop), False if shed. Threads only may wait
+        try:
+            if wait: self._queues[lane].put(job)
+            else: self._queues[lane].put_nowait(job)
+            return True
+        except (queue.Full, asyncio.QueueFull):
+            with self._lock: # No database write here, which may be the XMPP event loop
+                self._shed[lane] = self._shed.get(lane, 0) + 1
+                write, self._counting = not self._counting, True
+            if write: self._queue_count()
+            LogEvent(f">> Busy: {lane} lane full, event shed", user_type=self._user_type, level=logging.WARNING).log()
+            return False
+
+    def _queue_count(self):
+        try: self._queues["busy"].put_nowait(self._count_async if self._loop else self._count)
+        except (queue.Full, asyncio.QueueFull):
+            with self._lock: self._counting = False # Counted with the next event shed
+
+    def _count(self):
+        with self._lock: shed, self._shed, self._counting = self._shed, {}, False
+        for lane, n in shed.items(): self._storage.counters.count("shed", self._user_type, lane, n)
+
+    async def _count_async(self):
+        await self._loop.run_in_executor(self._executors["busy"], self._count)
+
+    def busy(self, user_from, job, always=False): # Queue the reply to a shed event (a job as for submit), once per sender and interval unless always
+        now = time.monotonic()
+        with self._lock:
+            if not always:
+                if self._told.get(user_from, 0) > now: return False
+                if len(self._told) >= BUSY_SENDERS: self._told = {u: t for u, t in self._told.items() if t > now}
+                self._told[user_from] = now + BUSY_INTERVAL
+        try:
+            self._queues["busy"].put_nowait(job)
+            return True
+        except (queue.Full, asyncio.QueueFull): return False
+
+    async def blocking(self, lane, func): # Run the blocking work of a task on a thread of its lane
+        return await self._loop.run_in_executor(self._executors[lane], func)
+
+    def _work(self, lane):
+        while True:
+            job = self._queues[lane].get()
+            try: job()
+            except Exception as e: LogEvent(f">> Error when processing event of {lane} lane", e, user_type=self._user_type).log()
+
+    async def _work_async(self, lane):
+        while True:
+            job = await self._queues[lane].get()
+            try: await job()
+            except Exception as e: LogEvent(f">> Error when processing event of {lane} lane", e, user_type=self._user_type).log()
+
+
+###
+# Capture of inbound traffic, anonymised, for replay offline
+###
+
+# Opt-in: each inbound notification or stanza is appended as a JSON line to the capture file, shared by both bots (one
+# write per line). Handles are replaced by keyed hashes of the same length, stable across bots and runs with the same
+# bot password, so that a sender is the same pseudonym in all its events; the TLD, the domains and handles of the bridge
+# are kept. In bodies, words become x (digits 0) of the same length while markup, punctuation, prefixes, commands and
+# language codes are kept, so that mentions, addresses and their structure parse as they did. See benchmarks/replay.py
+
+CAPTURE_TOKENS = (r'|(?P<tag><[^>]*>)|(?P<url>https?://[^\s<>"\']+)|(?P<handle>[\w%+-]+(?:\.[\w%+-]+)*@[\w-]+(?:\.[\w-]+)+)'
+                  r'|(?P<mention>@(?:<[^>]*>)*[\w%+-]+(?:\.[\w%+-]+)*(?:@[\w-]+(?:\.[\w-]+)+)?)|(?P<domain>[\w-]+(?:\.[\w-]+)*\.[a-zA-Z]{2,}\b)'
+                  r'|(?P<word>\w+)') # After prefixes, commands and language codes, kept as they are
+
+
+class TrafficCapture:
+
+    def __init__(self, path, config):
+        self._key = config.ap_bridge_pass.encode()
+        self._domains = {config.ap_instance.lower(), config.xmpp_instance.lower(), config.ap_bridge_jid.split("@")[-1].lower()}
+        self._handles = {config.ap_bridge_jid.lower(), config.xmpp_bridge_name.lower()}
+        self._locals = {h.split("@")[0] for h in self._handles}
+        self._tokens = re.compile(r'(?P<kept>(?:' + re.escape(config.pfix[3]) + "|" + re.escape(config.pfix[2]) + r')[a-zA-Z]*|' + re.escape(config.pfix[1]) + ")" + CAPTURE_TOKENS)
+        self._lock = threading.Lock()
+        try:
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        except OSError as e:
+            self._fd = None
+            LogEvent(f">> Error in opening capture file {path}, traffic not captured", e).log()
+            return
+        self._write({"capture": VERSION, "t": round(time.time(), 3), "pid": os.getpid(),
+                     "ap_instance": config.ap_instance, "xmpp_instance": config.xmpp_instance, "ap_bridge_jid": config.ap_bridge_jid,
+                     "xmpp_bridge_name": config.xmpp_bridge_name, "pfix": config.pfix, "xmpp_mode": config.xmpp_mode,
+                     "ap_admin": [self.handle(h) for h in config.ap_admin], "xmpp_admin": [self.handle(h) for h in config.xmpp_admin]})
+
+    def record(self, user_type, event, user_from, lane, content=None, **status): # One inbound event, before its admission
+        entry = {"t": round(time.time(), 3), "type": user_type, "event": event, "from": self.handle(user_from), "lane": lane}
+        if content is not None: entry["content"] = self.redact(content)
+        if status.get("spoiler"): status["spoiler"] = self.redact(status["spoiler"])
+        entry.update({k: v for k, v in status.items() if v})
+        self._write(entry)
+
+    def _write(self, entry):
+        if self._fd is None: return
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode()
+        try:
+            with self._lock: os.write(self._fd, line) # Appended at once, lines of both bots do not interleave
+        except OSError as e:
+            LogEvent(">> Error in writing capture file", e, level=logging.WARNING).log()
+
+    def _hash(self, value, length):
+        digest = hmac.new(self._key, value.lower().encode(), hashlib.sha256).hexdigest()
+        return (digest * (length // len(digest) + 1))[:length]
+
+    def domain(self, domain):
+        if domain.lower() in self._domains: return domain
+        labels = domain.split(".")
+        return ".".join([self._hash(l, len(l)) for l in labels[:-1]] + labels[-1:])
+
+    def handle(self, handle): # Address of a user, the bridge bots as they are
+        if handle.lower() in self._handles: return handle
+        local, _, domain = handle.partition("@")
+        if not domain: return local if local.lower() in self._locals else self._hash(local, len(local))
+        return self._hash(local, len(local)) + "@" + self.domain(domain) # Same pseudonym in short and full mentions
+
+    def redact(self, text):
+        return self._tokens.sub(self._token, text)
+
+    def _token(self, match):
+        value = match.group()
+        match match.lastgroup:
+            case "tag": return re.sub(r'(href=")([^"]*)', lambda m: m.group(1) + self.redact(m.group(2)), value)
+            case "url":
+                url = urlparse(value)
+                path = re.sub(r'@([\w.%+-]+)|\w+', lambda m: "@" + self.handle(m.group(1)) if m.group(1) else self._word(m.group()), value[len(url.scheme) + 3 + len(url.netloc):])
+                return url.scheme + "://" + self.domain(url.netloc) + path
+            case "handle": return self.handle(value)
+            case "mention": # Short or full, possibly with the markup of Mastodon mentions between @ and the name
+                tags = re.match(r'@((?:<[^>]*>)*)', value).group(1)
+                return "@" + tags + self.handle(value[1 + len(tags):])
+            case "domain": return self.domain(value)
+            case "word": return self._word(value)
+        return value
+
+    def _word(self, word):
+        return re.sub(r'\d', "0", re.sub(r'[^\W\d]', "x", word))
 
 
 ###
 # Helper classes to send XMPP message and delete contact from a synchronous flow
 ###
 
-# Send a XMPP message
+# Multicast of one message to several recipients (XEP-0033) when the server offers it: a single stanza to the service,
+# with a bcc address per recipient so that none sees the others, instead of one stanza each. The service is found with
+# service discovery (XEP-0030) on the server, then on its items, once per server and process
+
+MULTICAST = {} # Server domain: multicast service JID, or None if not offered
+
+
+def server_domain(xmpp): # A component has its own domain, a client that of its server
+    return xmpp.server_domain if xmpp.is_component else xmpp.boundjid.domain
+
+
+async def discover_multicast(xmpp): # Multicast service of the server of a connected session, or None
+    domain = server_domain(xmpp)
+    if domain in MULTICAST: return MULTICAST[domain]
+    disco = xmpp.plugin["xep_0030"]
+    ifrom = xmpp.boundjid if xmpp.is_component else None # Components address every stanza themselves
+    service = None
+    try:
+        if Addresses.namespace in (await disco.get_info(jid=domain, ifrom=ifrom, timeout=10))["disco_info"]["features"]: service = domain
+        else:
+            for jid, _, _ in (await disco.get_items(jid=domain, ifrom=ifrom, timeout=10))["disco_items"]["items"]:
+                if Addresses.namespace in (await disco.get_info(jid=jid, ifrom=ifrom, timeout=10))["disco_info"]["features"]:
+                    service = jid
+                    break
+    except (slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout): pass # Not offered, or unknown: one stanza per recipient
+    MULTICAST[domain] = service
+    if service: LogEvent(f">> Multicast (XEP-0033) offered by {service}, used for messages to several recipients", level=logging.INFO).log()
+    return service
+
+
+def chat_messages(xmpp, recipients, body, lang): # Stanzas sending a message to all recipients, each with the recipients it reaches
+    service = MULTICAST.get(server_domain(xmpp))
+    messages = []
+    for to, reached in [(service, recipients)] if service and len(recipients) > 1 else [(r, [r]) for r in recipients]:
+        mess = xmpp.Message() # Stanza id is set on creation, so known before the loop sends it
+        mess["to"] = to
+        if xmpp.is_component: mess["from"] = xmpp.boundjid
+        mess["type"] = "chat"
+        mess["body"] = body
+        mess["lang"] = lang
+        if reached != [to]:
+            for r in reached: mess["addresses"].add_address(atype="bcc", jid=r)
+        messages.append((mess, reached))
+    return messages
+
+
+def remove_contact(xmpp, contact): # Unsubscribe both ways, and remove from the roster of a client session
+    xmpp.send_presence_subscription(pto=contact, ptype="unsubscribe")
+    xmpp.send_presence_subscription(pto=contact, ptype="unsubscribed")
+    if not xmpp.is_component: xmpp.del_roster_item(contact) # A component has no roster, its users are the registered ones
+
+
+def on_loop(xmpp, func, wait=False): # Run on the event loop of a session, from its handlers or from another thread
+    try: running = asyncio.get_running_loop()
+    except RuntimeError: running = None
+    if running is xmpp.loop: return func()
+    if not wait:
+        xmpp.loop.call_soon_threadsafe(func)
+        return None
+    future = Future()
+    def run():
+        try: future.set_result(func())
+        except Exception as e: future.set_exception(e)
+    xmpp.loop.call_soon_threadsafe(run)
+    return future.result()
+
+
+# Route XMPP actions through the shared bot session if one runs in this process, else through a temporary connection
+
+class XmppDispatch:
+
+    def __init__(self, config, user_type=None): # Type of the user on whose behalf it acts, for the logs
+        self._session = config.xmpp_session
+        self._user_type = user_type
+        self._ap_bridge_jid = config.ap_bridge_jid
+        self._ap_bridge_pass = config.ap_bridge_pass
+        self._xmpp_server = config.xmpp_server
+        self.sent_ms = None # Time the last messages were actually sent, in milliseconds
+
+    def send_message(self, recipient, body, lang): # Returns the stanza id, "0" if not sent
+        return self.send_messages([recipient], body, lang)[recipient]
+
+    def send_messages(self, recipients, body, lang): # Same message to all, returns the stanza id by recipient, "0" if not sent
+        if self._session:
+            messages = chat_messages(self._session, recipients, body, lang)
+            def send(): # When the session loop gets to it, which may be late if it is busy
+                for mess, _ in messages: mess.send()
+                return int(time.time() * 1000)
+            self.sent_ms = on_loop(self._session, send, wait=True)
+            return {r: mess["id"] for mess, reached in messages for r in reached}
+        xmpp = SendMsgBot(self._ap_bridge_jid, self._ap_bridge_pass, recipients, body, lang, self._user_type)
+        xmpp.connect(*self._xmpp_server)
+        asyncio.get_event_loop().run_until_complete(xmpp.disconnected)
+        self.sent_ms = int(time.time() * 1000)
+        return xmpp.return_ids
+
+    def delete_contact(self, contact): # Unsubscribe both ways and remove from roster, returns True on success
+        if self._session:
+            on_loop(self._session, partial(remove_contact, self._session, contact))
+            return True
+        xmpp = DelContactBot(self._ap_bridge_jid, self._ap_bridge_pass, contact, self._user_type)
+        xmpp.connect(*self._xmpp_server)
+        asyncio.get_event_loop().run_until_complete(xmpp.disconnected)
+        return xmpp.return_code
+
+
+# Roster of the bridge account kept in storage with its version (XEP-0237), as the slixmpp roster datastore: on
+# connection, only the changes since that version are requested instead of the full roster. A full roster received
+# (server without versioning, or version unknown to it) replaces the stored one
+
+ROSTER_FIELDS = ("name", "groups", "from", "to", "pending_in", "pending_out", "whitelisted")
+
+
+class RosterStore:
+
+    def __init__(self, storage):
+        self._roster = storage.roster
+        self._items = {} # Owner: {jid: state} as stored, to load items and skip saves which change nothing
+        self._versions = {}
+
+    def attach(self, xmpp): # Before connecting
+        xmpp.roster.set_backend(self, save=False)
+        xmpp.del_event_handler("roster_update", xmpp._handle_roster) # Wrapped, it adds a query element to empty results
+        xmpp.add_event_handler("roster_update", partial(self._roster_update, xmpp))
+
+    def _roster_update(self, xmpp, iq): # Result with a query is a full roster (empty when up to date), set is a push
+        full = iq["type"] == "result" and iq.xml.find("{jabber:iq:roster}query") is not None
+        xmpp._handle_roster(iq)
+        if not full: return
+        listed = {str(jid) for jid in iq["roster"]["items"]}
+        for jid in [j for j in xmpp.client_roster.keys() if j not in listed]: # Saved by slixmpp, drop the others
+            xmpp.client_roster[jid].save(remove=True)
+
+    def entries(self, owner, db_state=None):
+        if owner is None: return [] # Roster owners, created when used
+        owner = str(owner)
+        self._items[owner] = self._roster.entries(owner)
+        return list(self._items[owner])
+
+    def load(self, owner, jid, db_state):
+        return self._items.get(str(owner), {}).get(str(jid))
+
+    def save(self, owner, jid, item_state, db_state):
+        owner, jid = str(owner), str(jid)
+        items = self._items.setdefault(owner, {})
+        state = {k: item_state[k] for k in ROSTER_FIELDS}
+        if item_state.get("removed") or not any(state.values()): # Nothing worth keeping, slixmpp creates items on lookup
+            if items.pop(jid, None) is not None: self._roster.delete(owner, jid)
+        elif items.get(jid) != state:
+            items[jid] = state
+            self._roster.save(owner, jid, state)
+
+    def version(self, owner):
+        owner = str(owner)
+        if owner not in self._versions: self._versions[owner] = self._roster.version(owner)
+        return self._versions[owner]
+
+    def set_version(self, owner, version):
+        owner = str(owner)
+        if self._versions.get(owner) == version: return
+        self._versions[owner] = version
+        self._roster.set_version(owner, version)
+
+
+# Send a XMPP message to one or several recipients, over one connection
 
 class SendMsgBot(slixmpp.ClientXMPP):
 
-    def __init__(self, jid, password, recipient, message, lang, log_file):
+    def __init__(self, jid, password, recipients, message, lang, user_type=None):
         slixmpp.ClientXMPP.__init__(self, jid, password)
-        self.recipient = recipient
+        self.user_type = user_type
+        self.register_plugin('xep_0030') # Service Discovery
+        self.register_plugin('xep_0033') # Extended Stanza Addressing
+        self.recipients = recipients
         self.msg = message
         self.lang = lang
-        self.log_file = log_file
-        self.return_id = "0"
+        self.return_ids = {r: "0" for r in recipients}
         self.add_event_handler("session_start", self.start)
 
     async def start(self, event):
         try:
-            self.send_presence()
-            await self.get_roster()
-            mess = self.Message()
-            mess["to"] = self.recipient
-            mess["type"] = "chat"
-            mess["body"] = self.msg
-            mess["lang"] = self.lang
-            mess.send()
-            self.return_id = mess["id"]
+            self.send_presence() # No roster needed to send
+            if len(self.recipients) > 1: await discover_multicast(self)
+            messages = chat_messages(self, self.recipients, self.msg, self.lang)
+            for mess, _ in messages: mess.send()
+            self.return_ids = {r: mess["id"] for mess, reached in messages for r in reached}
         except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
-            LogError(self.log_file, f">> Error in sending XMPP stanza to {self.recipient}", e).log()
+            LogEvent(">> Error in sending XMPP stanza", e, ", ".join(self.recipients), self.user_type).log()
         finally:
             self.disconnect()
 
@@ -167,23 +1919,20 @@ class SendMsgBot(slixmpp.ClientXMPP):
 
 class DelContactBot(slixmpp.ClientXMPP):
 
-    def __init__(self, jid, password, contact_jid, log_file):
+    def __init__(self, jid, password, contact_jid, user_type=None):
         slixmpp.ClientXMPP.__init__(self, jid, password)
+        self.user_type = user_type
         self.contact_jid = contact_jid
-        self.log_file = log_file
         self.return_code = False
         self.add_event_handler("session_start", self.start)
 
     async def start(self, event):
         try:
-            self.send_presence()
-            await self.get_roster()
-            self.send_presence_subscription(pto=self.contact_jid, ptype="unsubscribe")
-            self.send_presence_subscription(pto=self.contact_jid, ptype="unsubscribed")
-            self.del_roster_item(self.contact_jid)
+            self.send_presence() # No roster needed, the bot session receives the roster push and stores it
+            remove_contact(self, self.contact_jid)
             self.return_code = True
         except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
-            LogError(self.log_file, f">> Error in removing XMPP contact {self.contact_jid}", e).log()
+            LogEvent(">> Error in removing XMPP contact", e, self.contact_jid, self.user_type).log()
         finally:
             self.disconnect()
 
@@ -202,17 +1951,18 @@ class LanguageManager:
         self.lang = config.default_lang
         self._unknown_lang = config.unknown_lang
         self._language_list = config.language_list
-        self._database_file = config.database_file
+        self._storage = config.storage_backend()
+
+    def _set_lang(self, entry):
+        if entry:
+            self.lang = entry.lang
+            if self.lang not in self._language_list: self.lang = self._unknown_lang
 
     def get_language(self):
-        with sqlite3.connect(self._database_file) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE (type, req_user) = (?, ?)", (self.user_type, self.user))
-            entry = cursor.fetchone()
-            if entry:
-                self.lang = entry[4]
-                if self.lang not in self._language_list: self.lang = self._unknown_lang
-            cursor.close()
+        self._set_lang(self._storage.users.get(self.user_type, self.user))
+
+    async def get_language_async(self): # Same, without blocking the event loop on the database
+        self._set_lang(await self._storage.aio.users.get(self.user_type, self.user))
 
 
 # Process setting language from user input message (if any, and setting only one language is allowed)
@@ -226,21 +1976,15 @@ class LanguageProcessor:
         self.current_lang = current_lang
         self.reply_text = ""
         self.reply_lang = current_lang
-        self._database_file = config.database_file
+        self._storage = config.storage_backend()
         self._messages = config.messages
         self._pfix = config.pfix
         self._language_list = config.language_list
         self._unknown_lang = config.unknown_lang
 
     def _set_language(self):
-        with sqlite3.connect(self._database_file) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE (type, req_user) = (?, ?)", (self.user_type, self.user_from))
-            entry = cursor.fetchone()
-            if entry:
-                cursor.execute("UPDATE users SET lang = ? WHERE (type, req_user) = (?, ?)", (self.reply_lang, self.user_type, self.user_from))
-                conn.commit()
-            cursor.close()
+        entry = self._storage.users.get(self.user_type, self.user_from)
+        if entry: self._storage.users.set_lang(self.user_type, self.user_from, self.reply_lang)
         return self._messages["langset"][self.reply_lang] if entry else self._messages["langneedsreg"][self.reply_lang]
 
     def process_language(self):
@@ -257,6 +2001,44 @@ class LanguageProcessor:
 # Parse the content of message and identify the relevant entries: command, language, xmpp and Fediverse addresses, domains
 ###
 
+# Pattern starting with a run of run_class characters, searched in linear time. An unanchored search tries every
+# position of a long run and backtracks over the rest of it each time (quadratic on e.g. "a.a.a.a..."), but when an
+# attempt fails within a run, later starts in the same run fail too: only run starts and match ends are tried.
+# Same results as findall() / sub() of the plain pattern
+
+class RunPattern:
+
+    def __init__(self, pattern, run_class):
+        self._pattern = re.compile(pattern)
+        self._run_start = re.compile(r'(?<!' + run_class + r')' + run_class)
+
+    def finditer(self, text):
+        pos = 0
+        while pos < len(text):
+            m = self._pattern.match(text, pos)
+            if m:
+                yield m
+                pos = m.end()
+                continue
+            start = self._run_start.search(text, pos + 1)
+            if not start: return
+            pos = start.start()
+
+    def findall(self, text):
+        return [m.group() for m in self.finditer(text)]
+
+    def sub(self, repl, text):
+        parts, pos = [], 0
+        for m in self.finditer(text):
+            parts += (text[pos:m.start()], repl)
+            pos = m.end()
+        return "".join(parts) + text[pos:]
+
+
+EMAIL_PATTERN = RunPattern(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b', r'[a-zA-Z0-9._%+-]')
+DOMAIN_PATTERN = RunPattern(r'[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b', r'[a-zA-Z0-9.-]')
+
+
 class ContentParser:
 
     def __init__(self, user_type, input_text, config):
@@ -271,9 +2053,9 @@ class ContentParser:
         # Precompile regex patterns for efficiency
         self._command_pattern = re.compile(r'(?:^|\s)' + self._pfix[2] + r'[a-zA-Z]+\b', re.MULTILINE)
         self._ap_pattern = re.compile(self._pfix[0] + r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b', re.MULTILINE)
-        self._email_pattern = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b', re.MULTILINE)
+        self._email_pattern = EMAIL_PATTERN # Unanchored, see RunPattern
         self._apshort_pattern = re.compile(r'@[a-zA-Z0-9._%+-]+', re.MULTILINE)
-        self._dom_pattern = re.compile(r'[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b', re.MULTILINE)
+        self._dom_pattern = DOMAIN_PATTERN
         self._xmpp_pattern = re.compile(r'\b' + self._pfix[1] + r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}(?:\/[\w-]+)?\b', re.MULTILINE)
         self._lang_pattern = re.compile(r'(?:^|\s)' + self._pfix[3] + r'[a-zA-Z]{2}\b', re.MULTILINE)
 
@@ -347,12 +2129,9 @@ class UserRegistrar:
         self._ap_instance = config.ap_instance
         self._xmpp_instance = config.xmpp_instance
         self._messages = config.messages
-        self._database_file = config.database_file
+        self._storage = config.storage_backend()
         self._command_list = config.command_list
-        self._log_file = config.log_file
         self._open_file = config.open_file
-        self._dred_file = config.dred_file
-        self._dgreen_file = config.dgreen_file
         self._green_mode = config.green_mode
         self._language_list = config.language_list
         self._min_active = config.min_active
@@ -362,12 +2141,7 @@ class UserRegistrar:
         self.success = False
 
     def _is_blisted(self): # Check if user is blocked at instance level
-        with sqlite3.connect(self._database_file) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM instb WHERE (type, blocked) = (?, ?)", (self.user_type, self.user_from))
-            entry = c.fetchone()
-            c.close()
-        return bool(entry)
+        return bool(self._storage.instb.get(self.user_type, self.user_from))
 
     def _is_closed(self): # Check if bridge is in "close" mode for registration
         with open(self._open_file) as f:
@@ -376,12 +2150,7 @@ class UserRegistrar:
 
     def _max_reguser(self): # Check if user max registrations is reached
         m = False
-        with sqlite3.connect(self._database_file) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE revoke_date IS NULL")
-            entry = c.fetchall()
-            c.close()
-            if entry and self._max_reg_users: m = bool(len(entry) >= self._max_reg_users)
+        if self._max_reg_users: m = self._storage.counters.get("active", 0) + self._storage.counters.get("active", 1) >= self._max_reg_users
         return self._messages["maxusers"][self.lang] if m else ""
 
     def _add_to_contact(self): # Add user_from as a contact / follow of bot and check mutual status
@@ -394,27 +2163,21 @@ class UserRegistrar:
                 elif r["following"]: response = self._messages["addcontact"][self.lang]
                 if not (r["followed_by"] or r["requested_by"]): response += self._messages["followme"][self.lang]
             except MastodonError as e:
-                LogError(self._log_file, f">> Error fetching relationship with, or in following, user {self.user_from}", e).log()
+                LogEvent(">> Error fetching relationship with, or in following, user", e, self.user_from, 0).log()
         else:
             try:
-                r = self.instance.client_roster[self.user_from]["subscription"]
-                if r in ("none", "to"): self.instance.send_presence_subscription(pto=self.user_from)
+                r = "none" if self.instance.is_component else on_loop(self.instance, lambda: self.instance.client_roster[self.user_from]["subscription"], wait=True) # No roster kept by a component
+                if r in ("none", "to"): on_loop(self.instance, partial(self.instance.send_presence_subscription, pto=self.user_from))
                 if r == "both" or r == "from" and self.from_follow: response = self._messages["addcontact"][self.lang]
                 if r in ("none", "from") and not self.from_follow: response += self._messages["followme"][self.lang]
                 if r != "both": response += self._messages["requested"][self.lang]
             except (slixmpp.exceptions.XMPPError, slixmpp.exceptions.IqError, slixmpp.exceptions.IqTimeout) as e:
-                LogError(self._log_file, f">> Error in fetching subscription status with, or in adding contact, {self.user_from} to XMPP Bridge roster", e).log()
+                LogEvent(">> Error in fetching subscription status with, or in adding contact to XMPP Bridge roster", e, self.user_from, 1).log()
         return response
 
     def _redlist_check(self): # Check if user is in redlist and can be registered
-        if os.path.exists(self._dred_file):
-            with open(self._dred_file) as f:
-                domain_redlist = [line.split("#", 1)[0].strip() for line in f]
-        else: domain_redlist = []
-        if os.path.exists(self._dgreen_file):
-            with open(self._dgreen_file) as f:
-                domain_greenlist = [line.split("#", 1)[0].strip() for line in f]
-        else: domain_greenlist = []
+        domains = self.config.domain_policy()
+        domain_redlist, domain_greenlist = domains.red, domains.green
 
         if self._is_blisted(): return self._messages["ublock"][self.lang], self.lang, "0"
 
@@ -440,7 +2203,7 @@ class UserRegistrar:
                 active_post = 0
                 st_lang = "xx"
                 for status in statuses:
-                    if datetime.now() - status.created_at.replace(tzinfo=None) < timedelta(days=30):
+                    if epoch() - status.created_at.timestamp() < 30*86400: # Aware datetime, any time zone
                         active_post += 1
                         if st_lang == "xx": st_lang = status.language
                 if active_post >= self._min_active or domain == self._ap_instance or domain in domain_greenlist:
@@ -449,12 +2212,12 @@ class UserRegistrar:
                 else:
                     return self._messages["inactive"][self.lang], self.lang, acc_id
             except MastodonError as e:
-                LogError(self._log_file, f">> Error in fetching statuses for user {self.user_from}", e).log()
+                LogEvent(">> Error in fetching statuses for user", e, self.user_from, 0).log()
                 if domain != self._ap_instance and domain not in domain_greenlist:
                     return self._messages["lustaterr"][self.lang], self.lang, acc_id
                 else: return "", self.lang, acc_id
         except MastodonError as e:
-            LogError(self._log_file, f">> Error in looking up user {self.user_from}", e).log()
+            LogEvent(">> Error in looking up user", e, self.user_from, 0).log()
             return self._messages["lookuperror"][self.lang].format(self._ap_instance), self.lang, "0"
 
     def _get_app(self): # Identify application of user (Fediverse app using nodeinfo, or XMPP)
@@ -467,36 +2230,31 @@ class UserRegistrar:
                 req = get(link, headers={"User-Agent": self._user_agent})
                 if req.status_code == 200: return req.json()["software"]["name"].capitalize()
         except Exception as e:
-            LogError(self._log_file, f">> Error in contacting instance {domain}", e).log()
+            LogEvent(">> Error in contacting instance for nodeinfo", e, self.user_from, 0).log()
         return "Fediverse"
 
     def register_user(self): # Register a user in database and follow/contact
         self.reply_text = self._is_closed() or self._max_reguser()
         if self.reply_text: return
 
-        self.reply_text, self.lang, self.id = self._redlist_check()
+        with background_calls(): # Vetting lookups wait for rate limit budget after replies and bridged messages
+            self.reply_text, self.lang, self.id = self._redlist_check()
 
         if not self.reply_text:
-            conn = sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE (type, req_user) = (?, ?)", (self.user_type, self.user_from))
-            entry = c.fetchone()
-            if not entry:
-                app = self._get_app()
-                entry = (self.user_type, self.user_from, None, 0, self.lang, None, app, self.id)
-                c.execute("INSERT INTO users(type, req_user, req_date, nb_reg, lang, revoke_date, app, acc_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entry)
-            if entry[5] == None and entry[3]:
-                if not self.from_follow: self.reply_text = self._messages["dbexists"][self.lang].format(entry[2].strftime("%F"))
+            entry = self._storage.users.get(self.user_type, self.user_from)
+            if not entry: entry = UserRow(self.user_type, self.user_from, None, 0, self.lang, None, self._get_app(), self.id)
+            if entry.revoke_date == None and entry.nb_reg:
+                if not self.from_follow: self.reply_text = self._messages["dbexists"][self.lang].format(day(entry.req_date))
                 self.success = True
-            elif self._max_reg and entry[3] >= self._max_reg: self.reply_text = self._messages["regmax"][self.lang].format(self._max_reg)
+            elif self._max_reg and entry.nb_reg >= self._max_reg: self.reply_text = self._messages["regmax"][self.lang].format(self._max_reg)
             else:
-                c.execute("UPDATE users SET req_date = ?, nb_reg = ?, lang = ?, revoke_date = ? WHERE (type, req_user) = (?, ?)",
-                          (datetime.now(), entry[3] + 1, self.lang, None, self.user_type, self.user_from))
-                conn.commit()
+                self._storage.users.save(entry._replace(req_date=epoch(), nb_reg=entry.nb_reg + 1, lang=self.lang, revoke_date=None))
+                try: self._storage.flush() # Confirm registration only once durable, and visible to the other bot
+                except sqlite3.Error: # Rolled back, the user can try again
+                    self.reply_text = self._messages["busy"][self.lang]
+                    return
                 self.reply_text = self._messages["regok"][self.lang]
                 self.success = True
-            c.close()
-            conn.close()
             if self.success: self.reply_text += self._add_to_contact() or self._messages["errcontact"][self.lang]
 
 
@@ -510,69 +2268,50 @@ class UserManager:
         self.user = user
         self.from_unfollow = from_unfollow
         self.lang = lang
-        self._xmpp_bridge_token = config.xmpp_bridge_token
+        self.config = config
         self._ap_instance = config.ap_instance
-        self._ap_bridge_jid = config.ap_bridge_jid
-        self._ap_bridge_pass = config.ap_bridge_pass
         self._messages = config.messages
-        self._database_file = config.database_file
-        self._log_file = config.log_file
-        self._user_agent = config.user_agent
+        self._storage = config.storage_backend()
         self.reply_text = ""
 
     def _del_from_contact(self):
         success = False
         if self.user_type == 0:
-            with sqlite3.connect(self._database_file) as conn:
-                c = conn.cursor()
-                c.execute("SELECT * FROM users WHERE (type, req_user) = (?, ?)", (self.user_type, self.user))
-                entry = c.fetchone()
-                c.close()
+            entry = self._storage.users.get(self.user_type, self.user)
             if entry:
                 try:
-                    if not self.instance:
-                        Mastodon(access_token=self._xmpp_bridge_token, api_base_url=self._ap_instance, user_agent=self._user_agent).account_unfollow(entry[7])
-                    else: self.instance.account_unfollow(entry[7])
+                    (self.instance or self.config.mastodon_client()).account_unfollow(entry.acc_id)
                     success = True
                 except MastodonError as e:
-                    LogError(self._log_file, f">> Error in unfollowing user {self.user} from XMPP Bridge", e).log()
+                    LogEvent(">> Error in unfollowing user from XMPP Bridge", e, self.user, 0).log()
         else:
             try:
-                if self.instance: # We are already connected to XMPP, we come from an async loop
-                    self.instance.send_presence_subscription(pto=self.user, ptype="unsubscribe")
-                    self.instance.send_presence_subscription(pto=self.user, ptype="unsubscribed")
-                    self.instance.del_roster_item(self.user)
-                    success = True
-                else: # Not connected to XMPP, coming from a synchronous flow
-                    xmpp = DelContactBot(self._ap_bridge_jid, self._ap_bridge_pass, self.user, self._log_file)
-                    xmpp.connect()
-                    asyncio.get_event_loop().run_until_complete(xmpp.disconnected)
+                if self.instance: # We are already connected to XMPP, from the bot handlers or their worker threads
+                    on_loop(self.instance, partial(remove_contact, self.instance, self.user))
                     success = True
+                else: # Not called from the XMPP bot handlers: shared session if any, else a synchronous flow
+                    success = XmppDispatch(self.config, self.user_type).delete_contact(self.user)
             except Exception as e:
-                LogError(self._log_file, f">> Error in deleting user {self.user} from XMPP Bridge roster", e).log()
+                LogEvent(">> Error in deleting user from XMPP Bridge roster", e, self.user, 1).log()
         return success
 
     def unregister_user(self):
-        with sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE (type, req_user) = (?, ?)", (self.user_type, self.user))
-            entry = c.fetchone()
+        entry = self._storage.users.get(self.user_type, self.user)
 
-            if not entry:
-                if not self.from_unfollow: self.reply_text = self._messages["dbnotexists"][self.lang]
+        if not entry:
+            if not self.from_unfollow: self.reply_text = self._messages["dbnotexists"][self.lang]
+        else:
+            if entry.revoke_date:
+                if not self.from_unfollow: self.reply_text = self._messages["revoked"][self.lang].format(day(entry.revoke_date))
             else:
-                if entry[5]:
-                    if not self.from_unfollow: self.reply_text = self._messages["revoked"][self.lang].format(entry[5].strftime("%F"))
-                else:
-                    c.execute("UPDATE users SET revoke_date = ? WHERE (type, req_user) = (?, ?)", (datetime.now(), self.user_type, self.user))
-                    c.execute("DELETE FROM blocks WHERE (type, blocking) = (?, ?)", (self.user_type, self.user))
-                    c.execute("DELETE FROM comm WHERE (type, user) = (?, ?)", (self.user_type, self.user))
-                    c.execute("DELETE FROM comm WHERE (type, from_u) = (?, ?)", (1-self.user_type, self.user))
-                    conn.commit()
-                    self.reply_text = self._messages["unregok"][self.lang]
+                self._storage.revoke_user(self.user_type, self.user, epoch())
+                try: self._storage.flush()
+                except sqlite3.Error: # Rolled back, still registered
+                    self.reply_text = self._messages["busy"][self.lang]
+                    return
+                self.reply_text = self._messages["unregok"][self.lang]
 
-                if self._del_from_contact(): self.reply_text += self._messages["delcontact"][self.lang]
-            c.close()
+            if self._del_from_contact(): self.reply_text += self._messages["delcontact"][self.lang]
 
 
 ###
@@ -590,7 +2329,7 @@ class InstructionProcessor:
         self._dom = content_parsed.dom_list
         self._msg = content_parsed.parsed
         self.config = config
-        self._database_file = config.database_file
+        self._storage = config.storage_backend()
         self._pfix = config.pfix
         self._messages = config.messages
         self._start_file = config.start_file
@@ -602,13 +2341,11 @@ class InstructionProcessor:
         self._xmpp_bridge_name = config.xmpp_bridge_name
         self._ap_admin = config.ap_admin
         self._ap_bridge_jid = config.ap_bridge_jid
-        self._ap_bridge_pass = config.ap_bridge_pass
         self._ap_instance = config.ap_instance
         self._command_list = config.command_list
         self._green_mode = config.green_mode
         self._max_reg_users = config.max_reg_users
         self._char_limit = config.char_limit
-        self._log_file = config.log_file
         self._help_url = config.help_url
         self._ahelp_url = config.ahelp_url
         self._version = config.version
@@ -634,59 +2371,101 @@ class InstructionProcessor:
             opened = f.read().strip()
         response += "- " + self._messages[opened][self.lang]
         if opened == self._command_list[20] and self._max_reg_users: response += "- " + self._messages["nbregusers"][self.lang].format(self._max_reg_users)
+        response += "- " + self._messages["nbactive"][self.lang].format(self._storage.counters.get("active", 0), self._storage.counters.get("active", 1))
         response += "- " + (self._messages["notgreenlist"][self.lang], self._messages["greenlist"][self.lang])[self._green_mode]
+        response += "- " + self._messages["latency"][self.lang].format(self.config.latency_window, self._latency(1), self._latency(0))
         return response
 
+    def _latency(self, user_type): # Delivery latency of messages to users of a type, flagged beyond the SLO
+        p = latency_percentiles(self._storage, user_type, self.config.latency_window)
+        if not p: return "-"
+        slo = self.config.latency_slo
+        return f"{p[1]} / {p[2]} / {p[3]} ms (n={p[0]})" + (f" > SLO {slo} ms" if slo and p[2] > slo else "")
+
+    def _stats(self): # Usage statistics, from counters maintained with the data
+        c = self._storage.counters
+        today = day(epoch())
+        month = day(epoch() - 29*86400)
+        domains = ", ".join(f"{d} ({n})" for d, n in c.top("domain", 5)) or "-"
+        shed = ", ".join(f"{lane} ({n})" for lane in LANES if (n := c.get("shed", 0, lane) + c.get("shed", 1, lane))) or "-"
+        return self._messages["stats"][self.lang].format(c.get("active", 0), c.get("active", 1),
+            c.get("registrations", 0), c.get("registrations", 1), c.get("revocations", 0), c.get("revocations", 1),
+            c.get("bridged", 0, today), c.get("bridged", 1, today), c.total("bridged", 0, month), c.total("bridged", 1, month), domains, shed)
+
+    def _profile(self): # Start profiling this bot process, or report the profile once finished
+        profiler = self.config.profiler()
+        if profiler.running(): return self._messages["profilerunning"][self.lang].format(int(profiler.until - time.monotonic()) + 1)
+        if profiler.result:
+            response = self._messages["profile"][self.lang].format(*profiler.result)
+            profiler.result = None
+            return response
+        profiler.start(self.config.profile_seconds, self.config.profile_interval, partial(self._report_profile, self.user_type, self.user_from, self.lang))
+        return self._messages["profilestart"][self.lang].format(self.config.profile_seconds, self._pfix[2], self._command_list[24])
+
+    def _report_profile(self, user_type, user, lang, result): # Send the profile summary to the admin who asked for it, True if sent
+        text = self._messages["profile"][lang].format(*result)
+        if not user_type and len(text) + len(user) + 3 >= self._char_limit: # Within the post limit, as replies
+            truncated = self._messages["truncated"][lang]
+            text = text[:self._char_limit - len(user) - len(truncated) - 4] + "\n" + truncated
+        try:
+            if user_type: return XmppDispatch(self.config, user_type).send_message(user, text, lang) != "0"
+            self.config.mastodon_client().status_post(f"@{user} \n{text}", visibility="direct", language=lang)
+            return True
+        except Exception as e:
+            LogEvent(">> Error in sending profile to admin from XMPP Bridge", e, user, user_type).log()
+            return False
+
+    def _import_red(self): # Import a domain blocklist file into the red list, affected users unregistered by the maintenance thread
+        if not self.config.import_dir: return self._messages["noimportdir"][self.lang]
+        name = re.search(re.escape(self._pfix[2] + self._command_list[25]) + r'\s+(\S+)', self._msg, re.IGNORECASE)
+        name = name.group(1) if name else ""
+        import_dir = os.path.realpath(self.config.import_dir)
+        path = os.path.realpath(os.path.join(import_dir, name))
+        if name in ("", ".", "..") or os.path.basename(name) != name or os.path.dirname(path) != import_dir: # A file of that directory only
+            return self._messages["noimport"][self.lang].format(self._pfix[2], self._command_list[25])
+        imp = BlocklistImport(self.config)
+        try:
+            domains, skipped = imp.read(path)
+            added, listed = imp.apply(domains, path)
+        except (OSError, UnicodeError, csv.Error) as e: # Details in the log only, not to whoever is on the admin chat
+            LogEvent(f">> Error in importing blocklist {name} into XMPP Bridge red list", e, self.user_from, self.user_type).log()
+            return self._messages["importerr"][self.lang].format(name)
+        affected = imp.affected(added) # Before the purge starts
+        if added: self.config.maintenance().once("purge of imported red domains", partial(imp.purge, set(added)))
+        return self._messages["importred"][self.lang].format(name, len(domains), len(added), listed, skipped, affected)
+
     def _is_reg(self): # Return True if user_from is registered, False otherwise
-        with sqlite3.connect(self._database_file) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE (type, req_user) = (?, ?)", (self.user_type, self.user_from))
-            entry = c.fetchone()
-            c.close()
-        return bool(entry and not entry[5])
+        entry = self._storage.users.get(self.user_type, self.user_from)
+        return bool(entry and not entry.revoke_date)
 
     def _add_blklist(self): # Add user_to list to user_from blocklist
         if not self._user_to: return self._messages["noblocks"][self.lang].format(self._pfix[1-self.user_type])
         response = ""
-        with sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES) as conn:
-            c = conn.cursor()
-            for b in self._user_to:
-                c.execute("SELECT * FROM blocks WHERE (type, blocking, blocked) = (?, ?, ?)", (self.user_type, self.user_from, b))
-                if not c.fetchone():
-                    c.execute("INSERT INTO blocks(type, blocking, blocked, block_date) VALUES (?, ?, ?, ?)", (self.user_type, self.user_from, b, datetime.now()))
-                    response += self._messages["addblocks"][self.lang].format(self._pfix[1-self.user_type], b)
-                else:
-                    response += self._messages["blockexists"][self.lang].format(self._pfix[1-self.user_type], b)
-            conn.commit()
-            c.close()
+        for b in self._user_to:
+            if not self._storage.blocks.get(self.user_type, self.user_from, b):
+                self._storage.blocks.add(BlockRow(self.user_type, self.user_from, b, epoch()))
+                response += self._messages["addblocks"][self.lang].format(self._pfix[1-self.user_type], b)
+            else:
+                response += self._messages["blockexists"][self.lang].format(self._pfix[1-self.user_type], b)
         return response
 
     def _del_blklist(self): # Remove user_to list from user_from blocklist
         if not self._user_to: return self._messages["nounblocks"][self.lang].format(self._pfix[1-self.user_type])
         response = ""
-        with sqlite3.connect(self._database_file) as conn:
-            c = conn.cursor()
-            for b in self._user_to:
-                c.execute("SELECT * FROM blocks WHERE (type, blocking, blocked) = (?, ?, ?)", (self.user_type, self.user_from, b))
-                if c.fetchone():
-                    c.execute("DELETE FROM blocks WHERE (type, blocking, blocked) = (?, ?, ?)", (self.user_type, self.user_from, b))
-                    response += self._messages["delblocks"][self.lang].format(self._pfix[1-self.user_type], b)
-                else:
-                    response += self._messages["blocknotexists"][self.lang].format(self._pfix[1-self.user_type], b)
-            conn.commit()
-            c.close()
+        for b in self._user_to:
+            if self._storage.blocks.get(self.user_type, self.user_from, b):
+                self._storage.blocks.delete(self.user_type, self.user_from, b)
+                response += self._messages["delblocks"][self.lang].format(self._pfix[1-self.user_type], b)
+            else:
+                response += self._messages["blocknotexists"][self.lang].format(self._pfix[1-self.user_type], b)
         return response
 
     def _list_blklist(self): # List user_from blocklist
-        with sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM blocks WHERE (type, blocking) = (?, ?) ORDER BY block_date DESC", (self.user_type, self.user_from))
-            blist = c.fetchall()
-            c.close()
+        blist = self._storage.blocks.of_user(self.user_type, self.user_from)
         if not blist: return self._messages["emptyblocks"][self.lang]
         response = self._messages["listblocks"][self.lang].format(len(blist))
         for b in blist:
-            response += "- " + self._pfix[1-self.user_type] + b[2] + "\n"
+            response += "- " + self._pfix[1-self.user_type] + b.blocked + "\n"
         return response + "\n"
 
     def _report(self): # Report: send a message to XMPP admin
@@ -694,40 +2473,25 @@ class InstructionProcessor:
         send_msg = "> " + self._messages["report"][self.lang].format(self._pfix[self.user_type], self.user_from) + self._msg
         return_id = "0"
         try:
-            if self.user_type == 0: # We come from Mastodon so we are in a synchronous flow
-                xmpp = SendMsgBot(self._ap_bridge_jid, self._ap_bridge_pass, self._xmpp_admin[0], send_msg, self.lang, self._log_file)
-                xmpp.connect()
-                asyncio.get_event_loop().run_until_complete(xmpp.disconnected)
-                return_id = xmpp.return_id
-            else: # Coming from XMPP, we are already connected and in an async loop
-                self.instance.send_message(mto=self._xmpp_admin[0], mbody=send_msg)
-                return_id = "1"
+            return_id = XmppDispatch(self.config, self.user_type).send_message(self._xmpp_admin[0], send_msg, self.lang) # Shared XMPP session if any, else a synchronous flow
         except Exception as e:
-            LogError(self._log_file, f">> Error in posting to XMPP user {self._xmpp_admin[0]} from Bridge", e).log()
+            LogEvent(">> Error in posting report to XMPP admin from Bridge", e, self._xmpp_admin[0], self.user_type).log()
         return self._messages["reportok"][self.lang] if return_id != "0" else self._messages["errsend"][self.lang].format(self._pfix[1], self._xmpp_admin[0])
 
     def _list_allusers(self): # List all active users
-        with sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE revoke_date IS NULL ORDER BY req_date DESC")
-            ulist = c.fetchall()
-            c.close()
+        ulist = self._storage.users.active()
         if not ulist: return self._messages["emptyusers"][self.lang]
         response = self._messages["listusers"][self.lang].format(len(ulist))
         for u in ulist:
-            response += "- " + u[1] + " (" + u[6] + ")\n"
+            response += "- " + u.req_user + " (" + u.app + ")\n"
         return response + "\n"
 
     def _list_instanceblocks(self): # List all users blocked at instance (Bridge) level
-        with sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM instb ORDER BY block_date DESC")
-            lst_blk = c.fetchall()
-            c.close()
+        lst_blk = self._storage.instb.all()
         if not lst_blk: return self._messages["emptyinstblocks"][self.lang]
         response = self._messages["listinstblocks"][self.lang].format(len(lst_blk))
         for b in lst_blk:
-            response += "- " + self._pfix[b[0]] + b[1] + "\n"
+            response += "- " + self._pfix[b.type] + b.blocked + "\n"
         return response + "\n"
 
     def _add_dom(self, rg): # Add a domain to redlist/greenlist and unsubscribe related users if relevant
@@ -744,18 +2508,13 @@ class InstructionProcessor:
             else:
                 with open(rg_file, "a") as f:
                     f.write(d + "\n")
+                self.config.reload_domains()
                 response += self._messages["adddom" + str(rg)][self.lang].format(d)
                 if not rg:
-                    conn = sqlite3.connect(self._database_file)
-                    c = conn.cursor()
-                    c.execute("SELECT * FROM users WHERE revoke_date IS NULL")
-                    entry = c.fetchall()
-                    c.close()
-                    conn.close()
-                    for e in entry:
-                        domain = e[1].split("@")[1]
+                    for e in self._storage.users.active():
+                        domain = e.req_user.split("@")[1]
                         if domain == d:
-                            UserManager((None, self.instance)[e[0]==self.user_type], e[0], e[1], False, self.lang, self.config).unregister_user()
+                            with background_calls(): UserManager((None, self.instance)[e.type==self.user_type], e.type, e.req_user, False, self.lang, self.config).unregister_user()
         return response
 
     def _del_dom(self, rg): # Remove a domain from redlist/greenlist and unsubscribe related users if in greenlist mode
@@ -769,32 +2528,23 @@ class InstructionProcessor:
         newlist = [x for x in doms if x.split("#", 1)[0].strip() not in self._dom]
         with open(rg_file, "w") as f:
             f.writelines(newlist)
+        self.config.reload_domains()
         dellist = list(set(x.split("#", 1)[0].strip() for x in doms if x.split("#", 1)[0].strip() in self._dom))
         for x in self._dom:
             if x in dellist:
                 if rg and self._green_mode and x not in (self._ap_instance, self._xmpp_instance):
                     response += self._messages["del2domblocks"][self.lang].format(x)
-                    conn = sqlite3.connect(self._database_file)
-                    c = conn.cursor()
-                    c.execute("SELECT * FROM users WHERE revoke_date IS NULL")
-                    entry = c.fetchall()
-                    c.close()
-                    conn.close()
-                    for e in entry:
-                        domain = e[1].split("@")[1]
+                    for e in self._storage.users.active():
+                        domain = e.req_user.split("@")[1]
                         if domain == x:
-                            UserManager((None, self.instance)[e[0]==self.user_type], e[0], e[1], False, self.lang, self.config).unregister_user()
+                            with background_calls(): UserManager((None, self.instance)[e.type==self.user_type], e.type, e.req_user, False, self.lang, self.config).unregister_user()
                 else: response += self._messages["deldomblocks" + str(rg)][self.lang].format(x)
             else: response += self._messages["domblocknotexists" + str(rg)][self.lang].format(x)
         return response
 
     def _list_dom(self, rg): # List all domains in redlist/greenlist
-        rg_file = (self._dred_file, self._dgreen_file)[rg]
-        if os.path.exists(rg_file):
-            with open(rg_file) as f:
-                doms = [line.split("#", 1)[0].strip() for line in f]
-        else: doms = []
-        doms = list(set(x for x in doms if x))
+        domains = self.config.domain_policy()
+        doms = sorted((domains.red, domains.green)[rg])
         if not doms: return self._messages["emptydomblocks" + str(rg)][self.lang]
         response = self._messages["listdomblocks" + str(rg)][self.lang].format(len(doms))
         for d in doms:
@@ -806,34 +2556,24 @@ class InstructionProcessor:
         if set(self._ap_admin) & set(self._user_to) or set(self._xmpp_admin) & set(self._user_to) or self._ap_bridge_jid in self._user_to or self._xmpp_bridge_name in self._user_to:
             return self._messages["adminnoblk"][self.lang]
         response = ""
-        with sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES) as conn:
-            c = conn.cursor()
-            for b in self._user_to:
-                c.execute("SELECT * FROM instb WHERE (type, blocked) = (?, ?)", (1-self.user_type, b))
-                if not c.fetchone():
-                    c.execute("INSERT INTO instb(type, blocked, block_date) VALUES (?, ?, ?)", (1-self.user_type, b, datetime.now()))
-                    conn.commit()
-                    response += self._messages["addablocks"][self.lang].format(self._pfix[1-self.user_type], b)
-                    UserManager(None, 1-self.user_type, b, False, self.lang, self.config).unregister_user()
-                else:
-                    response += self._messages["ablockexists"][self.lang].format(self._pfix[1-self.user_type], b)
-            c.close()
+        for b in self._user_to:
+            if not self._storage.instb.get(1-self.user_type, b):
+                self._storage.instb.add(InstbRow(1-self.user_type, b, epoch()))
+                response += self._messages["addablocks"][self.lang].format(self._pfix[1-self.user_type], b)
+                with background_calls(): UserManager(None, 1-self.user_type, b, False, self.lang, self.config).unregister_user()
+            else:
+                response += self._messages["ablockexists"][self.lang].format(self._pfix[1-self.user_type], b)
         return response
 
     def _admin_unblock(self): # Remove users from instance blocklist
         if not self._user_to: return self._messages["noaunblocks"][self.lang].format(self._pfix[1-self.user_type])
         response = ""
-        with sqlite3.connect(self._database_file) as conn:
-            c = conn.cursor()
-            for b in self._user_to:
-                c.execute("SELECT * FROM instb WHERE (type, blocked) = (?, ?)", (1-self.user_type, b))
-                if c.fetchone():
-                    c.execute("DELETE FROM instb WHERE (type, blocked) = (?, ?)", (1-self.user_type, b))
-                    response += self._messages["delablocks"][self.lang].format(self._pfix[1-self.user_type], b)
-                else:
-                    response += self._messages["ablocknotexists"][self.lang].format(self._pfix[1-self.user_type], b)
-            conn.commit()
-            c.close()
+        for b in self._user_to:
+            if self._storage.instb.get(1-self.user_type, b):
+                self._storage.instb.delete(1-self.user_type, b)
+                response += self._messages["delablocks"][self.lang].format(self._pfix[1-self.user_type], b)
+            else:
+                response += self._messages["ablocknotexists"][self.lang].format(self._pfix[1-self.user_type], b)
         return response
 
     def process_instruction(self): # Main entry point to call command function
@@ -881,12 +2621,15 @@ class InstructionProcessor:
                                     self._command_list[12], self._command_list[10], self._command_list[15], self._command_list[17],
                                     self._command_list[19], self._command_list[14], self._command_list[16], self._command_list[18],
                                     self._command_list[13], self._ahelp_url[self.lang], self._command_list[20],
-                                    self._command_list[21], self._command_list[22])
+                                    self._command_list[21], self._command_list[22], self._command_list[23], self._command_list[24], self._command_list[25])
                                 case 14 | 15: self.reply_text = self._add_dom(cmd_idx % 2)
                                 case 16 | 17: self.reply_text = self._del_dom(cmd_idx % 2)
                                 case 18 | 19: self.reply_text = self._list_dom(cmd_idx % 2)
                                 case 20 | 21: self.reply_text = self._open_close()
                                 case 22: self.reply_text = self._status()
+                                case 23: self.reply_text = self._stats()
+                                case 24: self.reply_text = self._profile()
+                                case 25: self.reply_text = self._import_red()
                                 case _: self.reply_text = self._messages["notacom"][self.lang].format(self._pfix[2])
             except ValueError:
                 cmd_idx = -1
@@ -903,9 +2646,18 @@ class InstructionProcessor:
 # Sends a message from one universe to the other : AP <=> XMPP
 ###
 
+# Delivery latency of bridged messages, from the original post (Fediverse) or the receipt of the stanza (XMPP) to the
+# successful send on the other side, as kept in their comm rows: percentiles over the rolling window of the last minutes
+
+def latency_percentiles(storage, user_type, minutes): # (messages, p50, p95, p99) in ms for messages to users of a type, None if none
+    values = sorted(storage.comm.latencies(user_type, epoch() - minutes*60))
+    if not values: return None
+    return (len(values), *(values[max(-(-len(values) * q // 100) - 1, 0)] for q in (50, 95, 99))) # Nearest rank
+
+
 class MessageSender:
 
-    def __init__(self, instance, user_type, user_from, content, from_id, reply_id, lang, config):
+    def __init__(self, instance, user_type, user_from, content, from_id, reply_id, lang, config, received=None):
         self.instance = instance
         self.user_type = user_type
         self.user_from = user_from
@@ -916,11 +2668,9 @@ class MessageSender:
         self.reply_id = reply_id
         self.lang = lang
         self.config = config
-        self._xmpp_bridge_token = config.xmpp_bridge_token
-        self._ap_bridge_jid = config.ap_bridge_jid
-        self._ap_bridge_pass = config.ap_bridge_pass
+        self._received = int((received or time.time()) * 1000) # Original post or stanza receipt, for delivery latency
         self._ap_instance = config.ap_instance
-        self._database_file = config.database_file
+        self._storage = config.storage_backend()
         self._messages = config.messages
         self._command_list = config.command_list
         self._pfix = config.pfix
@@ -931,24 +2681,15 @@ class MessageSender:
         self._silent_block = config.silent_block
         self._silent_send = config.silent_send
         self._start_file = config.start_file
-        self._user_agent = config.user_agent
-        self._log_file = config.log_file
+        self.failed = False # Sent to none of the recipients because of an error of the other side
 
     def _get_app(self): # Get user application type from database, so recipient knows sender origin
-        with sqlite3.connect(self._database_file) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE (type, req_user) = (?, ?)", (self.user_type, self.user_from))
-            entry = c.fetchone()
-            c.close()
-        return entry[6] if entry else "Unknown"
+        entry = self._storage.users.get(self.user_type, self.user_from)
+        return entry.app if entry else "Unknown"
 
     def _is_reg(self, user_type, user): # Check whether this user is registered
-        with sqlite3.connect(self._database_file) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM users WHERE (type, req_user) = (?, ?)", (user_type, user))
-            entry = c.fetchone()
-            c.close()
-        return bool(entry and not entry[5])
+        entry = self._storage.users.get(user_type, user)
+        return bool(entry and not entry.revoke_date)
 
     def _is_started(self): # Check if bridge is in "stop" mode
         with open(self._start_file) as f:
@@ -958,39 +2699,19 @@ class MessageSender:
     def _is_blocked(self, user_to): # Check status of block between self.user_from and user_to
         response = ""
         block = False
-        with sqlite3.connect(self._database_file) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM blocks WHERE (type, blocking, blocked) = (?, ?, ?)", (self.user_type, self.user_from, user_to))
-            entry = c.fetchone()
-            if entry:
-                response = self._messages["blocking"][self.lang].format(self._pfix[1-self.user_type], user_to)
-                block = True
-            c.execute("SELECT * FROM blocks WHERE (type, blocking, blocked) = (?, ?, ?)", (1-self.user_type, user_to, self.user_from))
-            entry = c.fetchone()
-            if entry:
-                if not self._silent_block: response += self._messages["blocked"][self.lang].format(self._pfix[1-self.user_type], user_to)
-                block = True
-            c.close()
+        if self._storage.blocks.get(self.user_type, self.user_from, user_to):
+            response = self._messages["blocking"][self.lang].format(self._pfix[1-self.user_type], user_to)
+            block = True
+        if self._storage.blocks.get(1-self.user_type, user_to, self.user_from):
+            if not self._silent_block: response += self._messages["blocked"][self.lang].format(self._pfix[1-self.user_type], user_to)
+            block = True
         return response, block
 
-    def _update_comm(self, user_to, id_to): # Update tables of communication ID's after a successful send
-        with sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES) as conn:
-            c = conn.cursor()
-            c.execute("INSERT INTO comm(type, user, from_u, from_date, id_from, id_to) VALUES (?, ?, ?, ?, ?, ?)", (1-self.user_type, user_to, self.user_from, datetime.now(), self.from_id, id_to))
-            conn.commit()
-            c.close()
+    def _update_comm(self, user_to, id_to, sent): # Update tables of communication ID's after a successful send, with receive and delivery times
+        self._storage.comm.add(CommRow(1-self.user_type, user_to, self.user_from, epoch(), self.from_id, id_to, self._received, sent))
 
     def _user_rate(self): # Check if user rate of sender is exceeded (window of 5 minutes)
-        m = False
-        with sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES) as conn:
-            c = conn.cursor()
-            c.execute("SELECT * FROM comm WHERE (type, from_u) = (?, ?) ORDER BY from_date DESC LIMIT ?", (1-self.user_type, self.user_from, self._max_rate))
-            entry = c.fetchall()
-            c.close()
-        if entry and self._max_rate:
-            now = datetime.now()
-            c = sum(1 for e in entry if now - e[3] < timedelta(minutes=5))
-            m = bool(c >= self._max_rate)
+        m = bool(self._max_rate and len(self._storage.comm.recent_from(1-self.user_type, self.user_from, self._max_rate, epoch() - 300)) >= self._max_rate)
         return self._messages["maxrate"][self.lang] if m else ""
 
     def send(self): # Let's try and send this message
@@ -1003,40 +2724,30 @@ class MessageSender:
         is_reply = bool(self.reply_id)
 
         if not self._user_to_list: # No recipients were provided, let's see if this is an answer to a previous message
-            conn = sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-            c = conn.cursor()
             if self.user_type == 0: # Case of Fediverse: check if a previous communication was made using ID's to retrieve sender
                 if is_reply:
-                    c.execute("SELECT * FROM comm WHERE (type, id_to) = (?, ?)", (self.user_type, self.reply_id))
-                    entry = c.fetchone()
-                    if entry: self._user_to_list = [entry[2]] # If matched, the recipient is that previous sender
+                    entry = self._storage.comm.by_id_to(self.user_type, self.reply_id)
+                    if entry: self._user_to_list = [entry.from_u] # If matched, the recipient is that previous sender
                     else:
-                        c.execute("SELECT * FROM comm WHERE (type, id_from) = (?, ?)", (1-self.user_type, self.reply_id))
-                        entry = c.fetchall()
+                        entry = self._storage.comm.by_id_from(1-self.user_type, self.reply_id)
                         if entry:
-                            self._user_to_list = [x[1] for x in entry] # If matched, this is a resend, build list of same recipients
+                            self._user_to_list = [x.user for x in entry] # If matched, this is a resend, build list of same recipients
                 else: self.reply_text = self._messages["noaddr0"][self.lang].format(self._pfix[1-self.user_type], self._pfix[2], self._command_list[3])
                 if not (self._user_to_list or self.reply_text):
                     self.reply_text = (self._messages["noresend"], self._messages["noreply"])[is_reply][self.lang].format(self._pfix[1-self.user_type])
-                c.close()
-                conn.close()
 
             else: # Case of XMPP: check what and when was the last communication with that user, identifying if it's a reply or a second send
-                c.execute("SELECT * FROM comm WHERE (type, user) = (?, ?) ORDER BY from_date DESC LIMIT 1", (self.user_type, self.user_from))
-                entry1 = c.fetchone()
-                c.execute("SELECT * FROM comm WHERE (type, from_u) = (?, ?) ORDER BY from_date DESC LIMIT ?", (1-self.user_type, self.user_from, self._max_dest))
-                entry2 = c.fetchall()
-                c.close()
-                conn.close()
-
-                now = datetime.now() # Now check which is the most recent (reply or second send) and whether we are below the maximum time threshold
-                if entry1 and (not entry2 or entry1[3] > entry2[0][3]) and (not self._max_reply or now - entry1[3] < timedelta(minutes=self._max_reply)):
-                    self._user_to_list = [entry1[2]] # Case of a reply: one recipient
-                    self.reply_id = entry1[4]
+                since = epoch() - self._max_reply*60 if self._max_reply else 0 # Only below the maximum time threshold
+                entry1 = self._storage.comm.last_to(self.user_type, self.user_from, since)
+                entry2 = self._storage.comm.recent_from(1-self.user_type, self.user_from, self._max_dest, since)
+
+                if entry1 and (not entry2 or (entry1.from_date, entry1.seq) > (entry2[0].from_date, entry2[0].seq)): # Now check which is the most recent (reply or second send), in order of insertion within a second
+                    self._user_to_list = [entry1.from_u] # Case of a reply: one recipient
+                    self.reply_id = entry1.id_from
                     is_reply = True
-                elif entry2 and (not self._max_reply or now - entry2[0][3] < timedelta(minutes=self._max_reply)): # Found recent enough previous communication, now build list of recipients
-                    ident = entry2[0][4] # Case of a resend: build the list of same recipients (same ident as it is a single message when from XMPP)
-                    self._user_to_list = [x[1] for x in entry2 if x[4] == ident]
+                elif entry2: # Found recent enough previous communication, now build list of recipients
+                    ident = entry2[0].id_from # Case of a resend: build the list of same recipients (same ident as it is a single message when from XMPP)
+                    self._user_to_list = [x.user for x in entry2 if x.id_from == ident]
                 else: self.reply_text = self._messages["noaddr1"][self.lang].format(self._pfix[1-self.user_type], self._max_reply, self._pfix[2], self._command_list[3])
                 for x in self._user_to_list:
                     self._send_msg += "\n" + self._pfix[0] + x # Finally, add to Fediverse mentions at end of message
@@ -1055,7 +2766,7 @@ class MessageSender:
 
             if s: # Sending user is (now) registered
                 app = self._get_app()
-                first_iter = True
+                recipients = [] # From Fediverse, recipients not blocked
                 for user_to in self._user_to_list:
                     if self.user_type == 1 and not self._is_reg(1-self.user_type, user_to): # If sending from XMPP and recipient not registered, remove from mention
                         self.reply_text += self._messages["isnotreg"][self.lang].format(self._pfix[1-self.user_type], user_to)
@@ -1065,25 +2776,27 @@ class MessageSender:
                         if b:
                             self.reply_text += m # We are blocking or blocked: message to warn sender
                             self._send_msg = re.sub(self._pfix[1-self.user_type] + user_to, user_to, self._send_msg, flags=re.IGNORECASE)
-                    else: # If sending from Fediverse, will send to XMPP one by one
+                    else: # If sending from Fediverse, check block status and send to XMPP once all recipients are known
                         m, b = self._is_blocked(user_to)
                         if b: self.reply_text += m # We are blocking or blocked, message to warn sender
-                        else: # We are not blocked so go ahead and send message to XMPP from Fediverse, one user at a time (in this loop)
-                            return_id = "0"
-                            if first_iter: self._send_msg = "> " + (self._messages["newmsg"], self._messages["answer"])[is_reply][self.lang].format(app, self.user_from) + self._send_msg
-                            first_iter = False
-                            try:
-                                xmpp = SendMsgBot(self._ap_bridge_jid, self._ap_bridge_pass, user_to, self._send_msg, self.lang, self._log_file)
-                                xmpp.connect()
-                                asyncio.get_event_loop().run_until_complete(xmpp.disconnected)
-                                return_id = xmpp.return_id
-                            except Exception as e:
-                                LogError(self._log_file, f">> Error in posting to XMPP user {user_to} from Bridge", e).log()
-                            finally:
-                                if return_id == "0": self.reply_text += self._messages["errsend"][self.lang].format(self._pfix[1-self.user_type], user_to)
-                                else:
-                                    if not self._silent_send: self.reply_text += self._messages["oksend"][self.lang].format(self._pfix[1-self.user_type], user_to)
-                                    self._update_comm(user_to, return_id)
+                        else: recipients.append(user_to)
+
+                if recipients: # Now we are coming from Fediverse: one multicast stanza for all if the server offers it, else one each
+                    return_ids = {}
+                    self._send_msg = "> " + (self._messages["newmsg"], self._messages["answer"])[is_reply][self.lang].format(app, self.user_from) + self._send_msg
+                    dispatch = XmppDispatch(self.config, self.user_type)
+                    try:
+                        return_ids = dispatch.send_messages(recipients, self._send_msg, self.lang)
+                    except Exception as e:
+                        LogEvent(">> Error in posting to XMPP user from Bridge", e, ", ".join(recipients), self.user_type).log()
+                    sent = dispatch.sent_ms or int(time.time() * 1000) # When sent by the session loop, not when handed to it
+                    self.failed = all(return_ids.get(user_to, "0") == "0" for user_to in recipients)
+                    for user_to in recipients:
+                        return_id = return_ids.get(user_to, "0")
+                        if return_id == "0": self.reply_text += self._messages["errsend"][self.lang].format(self._pfix[1-self.user_type], user_to)
+                        else:
+                            if not self._silent_send: self.reply_text += self._messages["oksend"][self.lang].format(self._pfix[1-self.user_type], user_to)
+                            self._update_comm(user_to, return_id, sent)
 
                 if self.user_type == 1: # Now we are coming from XMPP and have already looped through all recipients to remove blocks
                     if len(self._send_msg) > self._char_limit: self.reply_text = self._messages["toolong"][self.lang].format(self._char_limit)
@@ -1091,29 +2804,34 @@ class MessageSender:
                         return_id = "0" # Post just one message which mentions all non-blocked recipients
                         try:
                             self._send_msg = "*** " + (self._messages["newmsg"], self._messages["answer"])[is_reply][self.lang].format(app, self.user_from) + self._send_msg
-                            return_id = Mastodon(access_token=self._xmpp_bridge_token, api_base_url=self._ap_instance, user_agent=self._user_agent).status_post(
+                            return_id = self.config.mastodon_client().status_post(
                                 self._send_msg, in_reply_to_id = self.reply_id, visibility = "direct", language = self.lang).id
                         except MastodonError as e:
-                            LogError(self._log_file, ">> Error in posting status from XMPP Bridge", e).log()
+                            LogEvent(">> Error in posting status from XMPP Bridge", e, self.user_from, self.user_type).log()
                         finally: # Finish by populating database with communication ID's
-                            if return_id == "0": self.reply_text += self._messages["errsendfedi"][self.lang]
+                            sent = int(time.time() * 1000)
+                            if return_id == "0":
+                                self.reply_text += self._messages["errsendfedi"][self.lang]
+                                self.failed = True
                             else:
                                 if not self._silent_send: self.reply_text += self._messages["oksendfedi"][self.lang]
                                 for user_to in self._user_to_list:
-                                    if self._is_reg(1-self.user_type, user_to) and not self._is_blocked(user_to)[1]: self._update_comm(user_to, return_id)
+                                    if self._is_reg(1-self.user_type, user_to) and not self._is_blocked(user_to)[1]: self._update_comm(user_to, return_id, sent)
 
 
 ###
-# Initialize bridge database, files and check data retention and redlists to delete users if necessary (cleanup)
+# Initialize bridge database and files, and schedule the cleanup of data retention and domain lists as maintenance jobs
 ###
 
 class InitBridge:
 
+    PAGE = 100 # Users checked at once by the domain job
+
     def __init__(self, instance, type, config):
         self.instance = instance
         self.type = type
         self.config = config
-        self._database_file = config.database_file
+        self._storage = config.storage_backend()
         self._command_list = config.command_list
         self._ap_instance = config.ap_instance
         self._xmpp_instance = config.xmpp_instance
@@ -1121,10 +2839,7 @@ class InitBridge:
         self._open_file = config.open_file
         self._dred_file = config.dred_file
         self._dgreen_file = config.dgreen_file
-        self._green_mode = config.green_mode
-        self._language_list = config.language_list
-        self._retention = config.retention
-        self._comm_limit = config.comm_limit
+        self._users = ("Fediverse", "XMPP")[type]
 
     def _check_and_initialize_file(self, file_path, default_content=""):
         if not os.path.exists(file_path):
@@ -1132,68 +2847,7 @@ class InitBridge:
                 f.write(default_content)
 
     def initialize(self):
-        conn = sqlite3.connect(self._database_file, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-        c = conn.cursor() # Initialize database if tables do not exist
-        table ="""CREATE TABLE IF NOT EXISTS users(type TINYINT,
-                                         req_user VARCHAR(255),
-                                         req_date TIMESTAMP,
-                                         nb_reg SMALLINT,
-                                         lang CHAR(2),
-                                         revoke_date TIMESTAMP,
-                                         app VARCHAR(63),
-                                         acc_id VARCHAR(63));"""
-        c.execute(table)
-
-        table ="""CREATE TABLE IF NOT EXISTS blocks(type TINYINT,
-                                         blocking VARCHAR(255),
-                                         blocked VARCHAR(255),
-                                         block_date TIMESTAMP);"""
-        c.execute(table)
-
-        table ="""CREATE TABLE IF NOT EXISTS instb(type TINYINT,
-                                         blocked VARCHAR(255),
-                                         block_date TIMESTAMP);"""
-        c.execute(table)
-
-        table ="""CREATE TABLE IF NOT EXISTS comm(type TINYINT,
-                                         user VARCHAR(255),
-                                         from_u VARCHAR(255),
-                                         from_date TIMESTAMP,
-                                         id_from VARCHAR(127),
-                                         id_to VARCHAR(127));"""
-        c.execute(table)
-
-        c.execute("SELECT * FROM users WHERE type = ? AND revoke_date IS NOT NULL", (self.type,))
-        entry = c.fetchall()
-        for e in entry: # Delete all data regarding revoked users after retention period
-            if self._retention and datetime.now() - e[5] > timedelta(days=self._retention):
-                c.execute("DELETE FROM users WHERE (type, req_user) = (?, ?)", (self.type, e[1]))
-                c.execute("DELETE FROM blocks WHERE (type, blocking) = (?, ?)", (self.type, e[1]))
-                c.execute("DELETE FROM comm WHERE (type, user) = (?, ?)", (self.type, e[1]))
-                c.execute("DELETE FROM comm WHERE (type, from_u) = (?, ?)", (1-self.type, e[1]))
-
-        c.execute("SELECT * FROM comm WHERE type = ?", (self.type,))
-        entry = c.fetchall()
-        for e in entry: # Delete all communication data after retention period anyway
-            if self._comm_limit and datetime.now() - e[3] > timedelta(days=self._comm_limit):
-                c.execute("DELETE FROM comm WHERE type = ?", (self.type,))
-
-        conn.commit()
-
-        c.execute("SELECT * FROM users WHERE revoke_date IS NULL")
-        entry = c.fetchall()
-        c.execute("SELECT * FROM instb WHERE type = ?", (self.type,))
-        instb = c.fetchall()
-        c.close()
-        conn.close()
-
-        if type == 0: # Unregister Fediverse accounts from domains blocked by bot instance
-            try:
-                blocks = self.instance.instance_domain_blocks()
-                for e in entry:
-                    d = e[1].split("@")[1]
-                    if d in blocks and e[0] == 0: UserManager(self.instance, 0, e[1], False, self._language_list[0], self.config).unregister_user()
-            except MastodonError: pass
+        self._storage.create_schema() # Initialize database if tables do not exist
 
         self._check_and_initialize_file(self._start_file, self._command_list[7]) # Create start / open / redlist / greenlist files if they do not exist
         self._check_and_initialize_file(self._open_file, self._command_list[20]) # By default, bridge initializes as opened registration
@@ -1206,28 +2860,225 @@ class InitBridge:
             "# If in green list mode, only green listed domain accounts can register\n" +
             "# If not in green list mode, only acts for Fediverse users (no minimum activity required)\n" +
             "# One domain per line (each subdomain requires a line), can comment with # after each line\n")
+        self.config.reload_domains()
+
+        maintenance = self.config.maintenance() # Cleanup runs from shortly after start, then periodically while the bot runs
+        maintenance.add(f"retention of {self._users} users", self._retention)
+        maintenance.add(f"domains of {self._users} users", self._domains)
+        maintenance.add("ledger expiry", self._ledger)
+        maintenance.add("instance settings", self._instance_settings)
+        maintenance.add(f"latency of messages from {self._users} users", self._latency)
+        maintenance.start()
+
+    def _retention(self): # Delete all data regarding revoked users, and communication data, after their retention periods
+        if self.config.retention:
+            for e in self._storage.users.revoked(self.type, epoch() - self.config.retention*86400):
+                self._storage.purge_user(self.type, e.req_user)
+                yield True
+        if not self.config.comm_limit: return
+        before = epoch() - self.config.comm_limit*86400
+        oldest = self._storage.comm.oldest_date(self.type)
+        while oldest is not None and oldest < before: # An hour of messages at a time
+            self._storage.comm.expire(self.type, min(oldest + 3600, before))
+            yield True
+            oldest = self._storage.comm.oldest_date(self.type)
+
+    def _domains(self): # Unregister accounts which are in domain redlist or in instance blocklist or not in greenlist (if in greenlist mode)
+        suspended = self._suspended_domains() if self.type == 0 else set()
+        instb = {i.blocked for i in self._storage.instb.of_type(self.type)}
+        after = ""
+        while True:
+            entry = self._storage.users.page(self.type, after, self.PAGE)
+            if not entry: return
+            policy = self.config.domain_policy()
+            for e in entry:
+                d = e.req_user.split("@")[1]
+                drop = e.req_user in instb or self._suspended(d, suspended) or d not in (self._ap_instance, self._xmpp_instance) and (
+                    d in policy.red or self.config.green_mode and d not in policy.green)
+                if drop: UserManager(self.instance, self.type, e.req_user, False, self.config.language_list[0], self.config).unregister_user()
+                yield drop
+            after = entry[-1].req_user
+
+    def _suspended_domains(self): # Domains suspended by the bot instance, as SHA-256 digests: the API obfuscates some names
+        try: return {b["digest"] for b in self.instance.instance_domain_blocks() if b["severity"] == "suspend"}
+        except MastodonError as e:
+            LogEvent(">> Error in fetching domain blocks of the bot instance", e, level=logging.WARNING).log()
+            return set()
+
+    @staticmethod
+    def _suspended(domain, digests): # Blocks of a domain apply to its subdomains
+        parts = domain.split(".")
+        return bool(digests) and any(hashlib.sha256(".".join(parts[i:]).encode()).hexdigest() in digests for i in range(len(parts) - 1))
+
+    def _ledger(self): # Forget processed message ids once duplicates are no longer expected
+        if self.config.ledger_hours:
+            self._storage.ledger.expire(epoch() - self.config.ledger_hours*3600)
+            yield True
+
+    def _latency(self): # Log delivery latency of the messages bridged by this bot, as a warning beyond the SLO
+        p = latency_percentiles(self._storage, 1-self.type, self.config.latency_window)
+        if p:
+            slo = self.config.latency_slo
+            LogEvent(f">> Delivery latency of messages from {self._users} users over the last {self.config.latency_window} minutes: "
+                     f"p50 {p[1]} ms, p95 {p[2]} ms, p99 {p[3]} ms, {p[0]} messages" + (f", beyond SLO of {slo} ms" if slo and p[2] > slo else ""),
+                     level=logging.WARNING if slo and p[2] > slo else logging.INFO).log()
+        yield False
+
+    def _instance_settings(self): # Character limit and account lock of the bot, probed on start, may change
+        before = (self.config.char_limit, self.config.account_locked)
+        self.config._get_instance_settings()
+        yield (self.config.char_limit, self.config.account_locked) != before
+
+
+###
+# Bulk import of domain blocklists: Mastodon domain block exports (CSV) or plain lists of domains
+###
+
+# A Mastodon export has a header row (domain, severity, ... with or without a leading #): only suspended domains are
+# imported, silenced ones can still be reached. A plain list has a domain first on each line, # for comments. Domains are
+# normalized and deduplicated, those obfuscated in the export (with *) or invalid are skipped. The red list file is
+# replaced at once, then registered users of the new domains are unregistered in a single pass over the users
+
+IMPORT_DOMAIN = re.compile(r'(?:[a-z0-9_-]+\.)+(?:[a-z]{2,}|xn--[a-z0-9-]+)')
 
-        with open(self._dred_file) as f: # Unregister all accounts which are in domain redlist or in instance blocklist or not in greenlist (if in greenlist mode)
-            domain_redlist = list(set(line.split("#", 1)[0].strip() for line in f))
-        with open(self._dgreen_file) as f:
-            domain_greenlist = list(set(line.split("#", 1)[0].strip() for line in f))
-        for e in entry:
-            d = e[1].split("@")[1]
-            if d not in (self._ap_instance, self._xmpp_instance) and d in domain_redlist:
-                UserManager((None, self.instance)[e[0]==self.type], e[0], e[1], False, self._language_list[0], self.config).unregister_user()
-            if self._green_mode and d not in (self._ap_instance, self._xmpp_instance) and d not in domain_greenlist:
-                UserManager((None, self.instance)[e[0]==self.type], e[0], e[1], False, self._language_list[0], self.config).unregister_user()
-            if e[0] == self.type:
-                if any(e[1] == i[1] for i in instb): UserManager(self.instance, self.type, e[1], False, self._language_list[0], self.config).unregister_user()
+
+class BlocklistImport:
+
+    PAGE = 100 # Users checked at once by the purge
+
+    def __init__(self, config):
+        self.config = config
+        self._storage = config.storage_backend()
+        self._dred_file = config.dred_file
+        self._own = (config.ap_instance, config.xmpp_instance)
+
+    def read(self, path): # Domains to block in a file, deduplicated, and the number of entries skipped
+        domains, skipped = set(), 0
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            header = None # Columns of an export, empty for a plain list
+            for row in csv.reader(f):
+                first = row[0].strip() if row else ""
+                if header is None and first.lstrip("#").strip().lower() == "domain": # First row tells the format
+                    header = [c.strip().lstrip("#").strip().lower() for c in row]
+                    continue
+                if not header:
+                    first = first.split("#", 1)[0].strip()
+                    if not first: continue # Comment or empty line
+                    header = []
+                entry = dict(zip(header, row)) if header else {"domain": first}
+                if entry.get("severity", "suspend").strip().lower() != "suspend": continue
+                domain = self.normalize(entry.get("domain", ""))
+                if domain and domain not in self._own: domains.add(domain)
+                else: skipped += 1
+        return domains, skipped
+
+    @staticmethod
+    def normalize(domain): # Lower case, in ASCII (IDNA), None if not a valid domain name
+        domain = domain.strip().lower().rstrip(".")
+        if domain.startswith("*."): domain = domain[2:] # Blocks apply to subdomains anyway
+        try: domain = domain.encode("idna").decode("ascii")
+        except UnicodeError: return None
+        return domain if IMPORT_DOMAIN.fullmatch(domain) else None
+
+    def apply(self, domains, source): # Add domains to the red list file at once, returns those added and the number already listed
+        current = self.config.domain_policy().red
+        added = sorted(domains - current)
+        if added:
+            lines = []
+            if os.path.exists(self._dred_file):
+                with open(self._dred_file) as f:
+                    lines = f.readlines()
+            if lines and not lines[-1].endswith("\n"): lines[-1] += "\n"
+            lines.append(f"# Imported from {os.path.basename(source)} on {day(epoch())}\n")
+            lines += [d + "\n" for d in added]
+            directory = os.path.dirname(os.path.abspath(self._dred_file))
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".redlist-")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.writelines(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if os.path.exists(self._dred_file): os.chmod(tmp, os.stat(self._dred_file).st_mode & 0o777)
+                os.replace(tmp, self._dred_file) # The other bot process sees a complete list, old or new
+            except BaseException:
+                if os.path.exists(tmp): os.remove(tmp)
+                raise
+            self.config.reload_domains()
+        return added, len(domains) - len(added)
+
+    def affected(self, domains, user_types=(0, 1)): # Registered users of these domains, from the domain counters
+        return sum(self._storage.counters.get("domain", t, d) for t in user_types for d in domains)
+
+    def purge(self, domains, user_types=(0, 1)): # Unregister users of these domains, in one pass over the users of each type
+        for t in user_types:
+            after = ""
+            while True:
+                entry = self._storage.users.page(t, after, self.PAGE)
+                if not entry: break
+                for e in entry:
+                    drop = e.req_user.split("@")[1] in domains
+                    if drop: UserManager(None, t, e.req_user, False, e.lang or self.config.language_list[0], self.config).unregister_user()
+                    yield drop
+                after = entry[-1].req_user
 
 
 ###
 # Main sequence called from each bot after having received a message to process
 ###
 
+# Ledger of messages already processed, by sender and status or stanza id, so that a message seen again (stream
+# reconnection, redelivery after resumption) is not bridged twice. Recent keys are answered from a bounded LRU map,
+# older ones from storage, where keys are kept for hours then expired. A message is claimed while it is processed and
+# stored once sent: released if it failed, its next delivery is processed again
+
+class ProcessedLedger:
+
+    def __init__(self, storage, size, hours):
+        self._ledger = storage.ledger
+        self._size = max(size, 1)
+        self._hours = hours
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._stored = 0
+        self.duplicates = 0
+
+    def _key(self, user_type, user, msg_id):
+        return (user_type, f"{user}/{msg_id}") if msg_id and self._hours else None # No id to tell duplicates, or disabled
+
+    def claim(self, user_type, user, msg_id): # True the first time a message is seen, False for a duplicate or one in process
+        key = self._key(user_type, user, msg_id)
+        if not key: return True
+        with self._lock:
+            duplicate = key in self._recent
+            if duplicate: self._recent.move_to_end(key)
+            else:
+                self._recent[key] = True
+                if len(self._recent) > self._size: self._recent.popitem(last=False)
+        if duplicate or self._ledger.seen(*key):
+            self.duplicates += 1
+            return False
+        return True
+
+    def processed(self, user_type, user, msg_id): # Sent: never processed again
+        key = self._key(user_type, user, msg_id)
+        if not key: return
+        now = epoch()
+        self._ledger.add(*key, now)
+        with self._lock:
+            self._stored += 1
+            expire = self._stored % 1000 == 0
+        if expire: self._ledger.expire(now - self._hours*3600)
+
+    def release(self, user_type, user, msg_id): # Failed: processed again if delivered again
+        key = self._key(user_type, user, msg_id)
+        if not key: return
+        with self._lock:
+            self._recent.pop(key, None)
+
+
 class ParseSend:
 
-    def __init__(self, instance, user_type, user_from, message_input, from_id, reply_id, lang, config):
+    def __init__(self, instance, user_type, user_from, message_input, from_id, reply_id, lang, config, received=None):
         self.instance = instance
         self.user_type = user_type
         self.user_from = user_from
@@ -1236,8 +3087,28 @@ class ParseSend:
         self.reply_id = reply_id
         self.lang = lang
         self.config = config
+        self.received = received # Epoch seconds the message was posted (Fediverse) or received (XMPP), now if unknown
 
     def parse_send(self):
+        self.response = ""
+        ledger = self.config.processed_ledger()
+        if not ledger.claim(self.user_type, self.user_from, self.from_id):
+            LogEvent(">> Duplicate message ignored", self.from_id, self.user_from, self.user_type, level=logging.DEBUG).log()
+            return
+        try: failed = self._parse_send()
+        except Exception:
+            ledger.release(self.user_type, self.user_from, self.from_id)
+            raise
+        if failed: ledger.release(self.user_type, self.user_from, self.from_id) # Nothing was sent, a redelivery may do better
+        else: ledger.processed(self.user_type, self.user_from, self.from_id)
+
+    def _parse_send(self): # True if the message could not be sent to any of its recipients
+        limit = self.config.max_inbound[self.user_type]
+        if len(self.message_input) > limit: # Before any parsing, whatever the content
+            LogEvent(f">> Message of {len(self.message_input)} characters exceeds inbound limit, not parsed", self.from_id, self.user_from, self.user_type, level=logging.WARNING).log()
+            self.response = self.config.messages["toolong"][self.lang].format(limit)
+            return
+
         content = ContentParser(self.user_type, self.message_input, self.config)
         content.parse_content()
 
@@ -1249,9 +3120,11 @@ class ParseSend:
         self.response = language.reply_text + process.reply_text
 
         if not content.command_list and not (content.lang_list and not (content.xmpp_jid_list, content.ap_addr_list)[self.user_type]):
-            sender = MessageSender(self.instance, self.user_type, self.user_from, content, self.from_id, self.reply_id, process.lang, self.config)
+            sender = MessageSender(self.instance, self.user_type, self.user_from, content, self.from_id, self.reply_id, process.lang, self.config, self.received)
             sender.send()
             self.response += sender.reply_text
+            return sender.failed
+        return False
 
 
 ###
@@ -0,0 +1,43 @@
+#######################################
+# XMPP/AP Bridge - Single process bot #
+#######################################
+
+# Runs both bots in one process: the slixmpp XMPP bot on the main event loop and the Mastodon stream consumer in
+# its own thread, sharing one XMPP session, one Mastodon client and one configuration (with its caches)
+# Messages to XMPP users are sent through the running XMPP session instead of temporary connections
+
+import os
+import signal
+import asyncio
+import threading
+import importlib
+from argparse import ArgumentParser
+from lib_bridge import InitBridge, ConfigLoader, LogManager
+
+CONFIG_FILE = os.getenv("XMPP_BRIDGE_CONFIG_FILE", "/usr/local/etc/xmpp-bridge-config.yml")
+
+ap_bridge = importlib.import_module("ap-bridge") # Bot modules are named with a dash, so not importable by statement
+xmpp_bridge = importlib.import_module("xmpp-bridge")
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description = "XMPP/AP Bridge - XMPP and Mastodon bots in a single process")
+    parser.add_argument("-c", "--config", help="specify configuration file path and name")
+    args = parser.parse_args()
+    config = ConfigLoader(args.config if args.config else CONFIG_FILE)
+    config.load()
+    LogManager(config).start()
+
+    mastodon = config.mastodon_client()
+
+    InitBridge(mastodon, 0, config).initialize() # Initialize before the shared session is set, both run on their own
+    InitBridge(None, 1, config).initialize()
+
+    xmpp = ap_bridge.bridge_session(config)
+
+    threading.Thread(target=xmpp_bridge.Listener(mastodon, config).run, name="mastodon-stream", daemon=True).start() # Reconnects by itself
+
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGHUP, config.reload) # systemctl reload: both bots see the new configuration, connections kept
+    loop.run_until_complete(xmpp.run_forever()) # Reconnects by itself
@@ -3,21 +3,128 @@
 #################################
 
 import os
+import time
+import signal
+import logging
+from functools import partial
+from datetime import datetime, timedelta, timezone
 from argparse import ArgumentParser
-from mastodon import Mastodon, StreamListener, MastodonError
-from lib_bridge import UserRegistrar, LanguageManager, ParseSend, InitBridge, ConfigLoader, LogError
+from mastodon import StreamListener, MastodonError
+from lib_bridge import UserRegistrar, LanguageManager, ParseSend, InitBridge, ConfigLoader, LogManager, LogEvent, Backoff, NotificationCursor, Admission, inbound_lane, background_calls
 
 CONFIG_FILE = os.getenv("XMPP_BRIDGE_CONFIG_FILE", "/usr/local/etc/xmpp-bridge-config.yml")
 
 
+NOTIFICATION_TYPES = ["mention", "follow", "follow_request"]
+
+
 class Listener(StreamListener): # Callback function to process notifications
 
-    def on_notification(self, notification):
-        if notification.type not in ("mention", "follow", "follow_request"): return
-        if config.account_locked and notification.type == "follow": return # Don't do it twice ("follow_request" already did it)
+    def __init__(self, mastodon, config):
+        super().__init__()
+        self._mastodon = mastodon
+        self._config = config
+        self._cursor = NotificationCursor(config.cursor_file)
+        self._backoff = Backoff(1, config.reconnect_max)
+        self._caught_up = False
+        self._admission = Admission(config, 0) # Notifications are handled by the workers of their lane, the stream goes on
+        self._capture = config.traffic_capture()
+
+    def run(self): # Stream forever, reconnect in-process with jittered backoff on any error or end of stream
+        if not self._cursor.last_id: # First run, only record where we start from
+            try:
+                latest = self._mastodon.notifications(types=NOTIFICATION_TYPES, limit=1)
+                if latest: self._cursor.save(latest[0].id)
+            except MastodonError as e:
+                LogEvent(">> Error when fetching notifications for XMPP Bridge", e, level=logging.WARNING).log()
+        while True:
+            self._caught_up = False
+            started = time.monotonic()
+            try:
+                self._mastodon.stream_user(self)
+                error = "stream closed by server"
+            except Exception as e:
+                error = e
+            if time.monotonic() - started > self._backoff.cap: self._backoff.reset() # Was stable, retry promptly
+            delay = self._backoff.next()
+            LogEvent(f">> Mastodon stream of XMPP Bridge lost, will try to reconnect in {delay:.1f} seconds...", error, level=logging.WARNING).log()
+            time.sleep(delay)
+
+    def handle_heartbeat(self): # Mastodon sends a first heartbeat as soon as the stream is open
+        if not self._caught_up: self._catch_up()
 
-        user_from = notification.account.acct.lower()
-        if "@" not in user_from: user_from += "@" + config.ap_instance
+    def on_notification(self, notification):
+        if not self._caught_up: self._catch_up()
+        self._process(notification)
+
+    def _catch_up(self): # Process notifications missed since the last one processed, oldest first, before those of the stream
+        self._caught_up = True
+        if not self._cursor.last_id or not self._config.catchup_hours: return
+        try:
+            oldest = datetime.now(timezone.utc) - timedelta(hours=self._config.catchup_hours)
+            count = 0
+            while True:
+                last_id = self._cursor.latest_id
+                page = self._mastodon.notifications(min_id=last_id, types=NOTIFICATION_TYPES, limit=40)
+                for notification in sorted(page, key=lambda n: NotificationCursor.key(n.id)):
+                    if notification.created_at < oldest: self._cursor.save(notification.id) # Too old, skip
+                    else:
+                        self._process(notification, wait=True) # Waits for room in its lane rather than shed a backlog
+                        count += 1
+                if self._cursor.latest_id == last_id: break # Nothing newer
+            if count: LogEvent(f">> Processed {count} notifications received by XMPP Bridge while disconnected", level=logging.INFO).log()
+        except MastodonError as e:
+            LogEvent(">> Error when fetching missed notifications for XMPP Bridge", e, level=logging.WARNING).log()
+
+    def _process(self, notification, wait=False): # Queue each notification once, whether from the stream or from catch-up
+        if not self._cursor.start(notification.id): return
+        if notification.type in NOTIFICATION_TYPES and not (self._config.account_locked and notification.type == "follow"): # Don't do it twice ("follow_request" already did it)
+            user_from = notification.account.acct.lower()
+            if "@" not in user_from: user_from += "@" + self._config.ap_instance
+            status = notification.status if notification.type == "mention" else None
+            lane = inbound_lane(self._config, 0, user_from, status.content if status else None)
+            if self._capture: self._capture.record(0, notification.type, user_from, lane, status.content if status else None,
+                                                   sensitive=bool(status and status.sensitive), spoiler=status.spoiler_text if status and status.sensitive else None,
+                                                   media=len(status.media_attachments) if status else 0, poll=bool(status and status.poll),
+                                                   reply=bool(status and status.in_reply_to_id))
+            if self._admission.submit(lane, partial(self._run, notification, user_from), wait): return # The cursor moves once it ran
+            self._shed(notification, user_from)
+        self._cursor.done(notification.id)
+
+    def _run(self, notification, user_from):
+        try:
+            self._handle(notification, user_from)
+        except Exception as e: # Do not let one notification stop its lane, and never retry it
+            LogEvent(">> Error when processing Fediverse notification in XMPP Bridge", e, user_from, 0).log()
+        finally:
+            self._cursor.done(notification.id)
+
+    def _shed(self, notification, user_from): # Notification shed: answered by the busy worker, never from the stream
+        if notification.type == "follow_request": # So that it can be requested again
+            self._admission.busy(user_from, partial(self._refuse, "follow_request_reject", notification.account.id, user_from), always=True)
+        elif notification.type == "follow": # Else following the bot without being registered, until following again
+            self._admission.busy(user_from, partial(self._refuse, "account_remove_from_followers", notification.account.id, user_from), always=True)
+        self._admission.busy(user_from, partial(self._busy, notification, user_from))
+
+    def _refuse(self, method, account_id, user_from):
+        try:
+            with background_calls(): getattr(self._mastodon, method)(account_id)
+        except MastodonError as e:
+            LogEvent(">> Error when refusing follow of Fediverse user to XMPP Bridge", e, user_from, 0).log()
+
+    def _busy(self, notification, user_from): # Ask the sender to try again later
+        language = LanguageManager(0, user_from, self._config)
+        language.get_language()
+        try:
+            with background_calls(): # Not at the expense of replies to the events admitted
+                self._mastodon.status_post(f'@{user_from} \n{self._config.messages["busy"][language.lang]}', language = language.lang,
+                                           in_reply_to_id = notification.status.id if notification.type == "mention" else None, visibility="direct")
+        except MastodonError as e:
+            LogEvent(">> Error when replying busy to Fediverse user from XMPP Bridge", e, user_from, 0).log()
+
+    def _handle(self, notification, user_from):
+        mastodon = self._mastodon
+        config = self._config
         language = LanguageManager(0, user_from, config)
         language.get_language()
 
@@ -29,7 +136,7 @@ class Listener(StreamListener): # Callback function to process notifications
                     mastodon.follow_request_authorize(register.id) if register.success else mastodon.follow_request_reject(register.id)
                 mastodon.status_post(f'@{user_from} \n{register.reply_text}', language = register.lang, visibility="direct")
             except MastodonError as e:
-                LogError(config.log_file, f">> Error when processing Fediverse follow request to user @{user_from} from XMPP Bridge", e).log()
+                LogEvent(">> Error when processing Fediverse follow request from XMPP Bridge", e, user_from, 0).log()
 
         else: # On mention, preprocess message (html) for specifics before parsing and sending
             message_content = notification.status.content
@@ -48,14 +155,14 @@ class Listener(StreamListener): # Callback function to process notifications
             if notification.status.poll: # Poll, don't try to render but add link to original post
                 message_content += "<br /><br /><p>" + config.messages["poll"][language.lang].strip() + "</p><br /><p>" + notification.status.url + "</p>"
 
-            parser = ParseSend(mastodon, 0, user_from, message_content, from_id, reply_id, language.lang, config)
+            parser = ParseSend(mastodon, 0, user_from, message_content, from_id, reply_id, language.lang, config, notification.status.created_at.timestamp())
             parser.parse_send() # Parse message and execute command or send message
 
             if parser.response: # Reply to Fediverse sender only if error or command returns a message
                 try:
                     mastodon.status_post(f'@{user_from} \n{parser.response}', in_reply_to_id = from_id, visibility="direct")
                 except MastodonError as e:
-                    LogError(config.log_file, f">> Error when responding to Fediverse user @{user_from} from XMPP Bridge", e).log()
+                    LogEvent(">> Error when responding to Fediverse user from XMPP Bridge", e, user_from, 0).log()
 
 
 if __name__ == '__main__':
@@ -65,9 +172,13 @@ if __name__ == '__main__':
     args = parser.parse_args()
     config = ConfigLoader(args.config if args.config else CONFIG_FILE)
     config.load()
+    if config.xmpp_mode == "component": parser.error("xmpp-mode component runs only with both bots in one process, start unified-bridge.py")
+    LogManager(config).start()
 
-    mastodon = Mastodon(access_token = config.xmpp_bridge_token, api_base_url = config.ap_instance, user_agent = config.user_agent)
+    mastodon = config.mastodon_client()
 
     InitBridge(mastodon, 0, config).initialize()
 
-    mastodon.stream_user(Listener()) # This will listen forever, exit if killed or error, manage restart or reconnect from OS systemd
+    signal.signal(signal.SIGHUP, lambda signum, frame: config.reload()) # systemctl reload: new configuration, same stream
+
+    Listener(mastodon, config).run() # This will listen forever and reconnect by itself, exit if killed